@@ -0,0 +1,176 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+
+def _sum_last(data):
+    """Sum along the last axis in a fixed order. Results of :func:`numpy.sum` may differ in rounding
+    with the number of rows, which would make results depend on how samples are batched.
+    """
+    total = np.zeros(data.shape[:-1])
+    for k in range(data.shape[-1]):
+        total += data[..., k]
+    return total
+
+
+class Bootstrap(object):
+    """Bootstrap confidence intervals of means for many samples at once.
+
+    Resampling indices are drawn once for each sample size and shared by all samples with the same size,
+    so that bootstrap means of these samples are calculated with gathers over the whole batch.
+    Indices for a sample size only depend on the seed and the size, so results do not depend on
+    the order of calls, e.g., bins stacked in chunks by several processes.
+    The calculation is split into chunks of at most ``chunk_size`` bootstrap means or resampled values
+    to bound the memory usage.
+    Confidence intervals follow the conventions of ``scikits.bootstrap.ci`` with ``np.average``
+    as the statistic function.
+
+    >>> boot = Bootstrap(n_samples=1000, seed=0)
+    >>> low, high = boot.ci(np.arange(20.))
+    >>> bool(low < 9.5 < high)
+    True
+    """
+    def __init__(self, n_samples=3000, alpha=0.05, method='bca', seed=None, chunk_size=2**22, cache_size=2**24):
+        """
+        :param n_samples: Number of bootstrap samples, defaults to 3000
+        :type n_samples: int, optional
+        :param alpha: Confidence level is ``1 - alpha``, defaults to 0.05
+        :type alpha: float, optional
+        :param method: ``'bca'`` for bias-corrected and accelerated intervals,
+            ``'pi'`` for percentile intervals, defaults to 'bca'
+        :type method: str, optional
+        :param seed: Seed of random generators for reproducible results, defaults to None
+        :type seed: int, optional
+        :param chunk_size: Maximum number of bootstrap means or resampled values calculated at once,
+            defaults to 2**22
+        :type chunk_size: int, optional
+        :param cache_size: Maximum number of resampling indices kept for reuse, defaults to 2**24
+        :type cache_size: int, optional
+        """
+        if method not in ('bca', 'pi'):
+            raise ValueError('method must be in \'bca\' or \'pi\'')
+        self.n_samples = int(n_samples)
+        self.alpha = alpha
+        self.method = method
+        self.seed = seed
+        self.entropy = np.random.SeedSequence(seed).entropy
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self._indices = OrderedDict()
+        self._cached = 0
+
+    def indices(self, count):
+        """Resampling indices with shape of ``(n_samples, count)`` for samples with ``count`` values"""
+        if count in self._indices:
+            self._indices.move_to_end(count)
+            return self._indices[count]
+        rng = np.random.default_rng([self.entropy, count])
+        idx = rng.integers(0, count, size=(self.n_samples, count), dtype=np.int32 if count < 2**31 else np.int64)
+        self._indices[count] = idx
+        self._cached += idx.size
+        while self._cached > self.cache_size and len(self._indices) > 1:
+            _, old = self._indices.popitem(last=False)
+            self._cached -= old.size
+        return idx
+
+    def boot_means(self, data):
+        """Bootstrap means of samples with the same size
+
+        :param data: Samples with shape of ``(nsample, count)``
+        :type data: numpy.ndarray
+        :return: Sorted bootstrap means with shape of ``(nsample, n_samples)``
+        :rtype: numpy.ndarray
+        """
+        nsample, count = data.shape
+        idx = self.indices(count)
+        means = np.empty((nsample, self.n_samples))
+        step = max(1, self.chunk_size // self.n_samples)
+        for b in range(0, nsample, step):
+            block = data[b:b+step]
+            # np.take gathers resampled values of each mean contiguously, which are then summed in the same
+            # order whatever the size of the chunk, unlike block[:, idx] with samples along the innermost axis
+            nb = max(1, self.chunk_size // (block.shape[0] * count))
+            for s in range(0, self.n_samples, nb):
+                means[b:b+step, s:s+nb] = np.take(block, idx[s:s+nb], axis=1).sum(axis=-1) / count
+        means.sort(axis=-1)
+        return means
+
+    def _avals(self, data, means):
+        alphas = np.array([self.alpha / 2, 1 - self.alpha / 2])
+        if self.method == 'pi':
+            return np.broadcast_to(alphas, (data.shape[0], 2))
+        count = data.shape[1]
+        ostat = _sum_last(data) / count
+        z0 = ndtri(np.sum(means < ostat[:, np.newaxis], axis=-1) / self.n_samples)
+        # jackknife means with each value left out
+        jstat = (_sum_last(data)[:, np.newaxis] - data) / (count - 1)
+        jdiff = (_sum_last(jstat) / count)[:, np.newaxis] - jstat
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acc = _sum_last(jdiff ** 3) / (6.0 * _sum_last(jdiff ** 2) ** 1.5)
+            zs = z0[:, np.newaxis] + ndtri(alphas)
+            return ndtr(z0[:, np.newaxis] + zs / (1 - acc[:, np.newaxis] * zs))
+
+    def ci_same_size(self, data):
+        """Confidence intervals of samples with the same size
+
+        :param data: Samples with shape of ``(nsample, count)``
+        :type data: numpy.ndarray
+        :return: Lower and upper bounds with shape of ``(nsample, 2)``
+        :rtype: numpy.ndarray
+        """
+        data = np.asarray(data, dtype=float)
+        means = self.boot_means(data)
+        with np.errstate(invalid='ignore'):
+            nvals = np.nan_to_num(np.round((self.n_samples - 1) * self._avals(data, means))).astype(int)
+        return np.take_along_axis(means, nvals, axis=-1)
+
+    def ci(self, data):
+        """Confidence interval of the mean of a sample
+
+        :param data: A sample
+        :type data: numpy.ndarray
+        :return: Lower and upper bounds
+        :rtype: numpy.ndarray
+        """
+        return self.ci_same_size(np.asarray(data)[np.newaxis])[0]
+
+    def ci_batch(self, samples):
+        """Confidence intervals of means for a list of samples with various sizes.
+        Samples with less than 2 values get NaN.
+
+        :param samples: Samples
+        :type samples: list
+        :return: Lower and upper bounds with shape of ``(len(samples), 2)``
+        :rtype: numpy.ndarray
+        """
+        cci = np.full((len(samples), 2), np.nan)
+        counts = np.array([len(sample) for sample in samples], dtype=int)
+        for count in np.unique(counts[counts > 1]):
+            idx = np.where(counts == count)[0]
+            cci[idx] = self.ci_same_size(np.array([samples[i] for i in idx]))
+        return cci
+
+
+def ci(data, n_samples=3000, alpha=0.05, method='bca', seed=None):
+    """Bootstrap confidence interval of the mean of a sample
+
+    :param data: A sample
+    :type data: numpy.ndarray
+    :param n_samples: Number of bootstrap samples, defaults to 3000
+    :type n_samples: int, optional
+    :param alpha: Confidence level is ``1 - alpha``, defaults to 0.05
+    :type alpha: float, optional
+    :param method: ``'bca'`` or ``'pi'``, defaults to 'bca'
+    :type method: str, optional
+    :param seed: Seed of the random generator, defaults to None
+    :type seed: int, optional
+    :return: Lower and upper bounds
+    :rtype: numpy.ndarray
+    """
+    return Bootstrap(n_samples=n_samples, alpha=alpha, method=method, seed=seed).ci(data)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,15 +1,17 @@
 import numpy as np
-from seispy.geo import km2deg, extrema, skm2srad, rad2deg
+from seispy.geo import km2deg, skm2srad, rad2deg
 from seispy import distaz
 from seispy.core.depmodel import DepModel
+from seispy.core.pierceindex import PierceIndex, BinStack
+from seispy.core.ccpstack import StackData, StackStore, save_stack, load_stack
+from seispy.core.rfdepth import station_bbox, station_events, station_digests
 from seispy.setuplog import setuplog
-from scikits.bootstrap import ci
+from seispy.bootstrap import Bootstrap
 from seispy.ccppara import ccppara, CCPPara
-from seispy.signal import smooth
+from seispy.signal import smooth_rows
 from seispy.utils import check_stack_val, read_rfdep
-from scipy.interpolate import interp1d
 import pyproj
-import warnings
+from multiprocessing import Pool
 import sys
 
 
@@ -38,19 +40,11 @@ def gen_center_bin(center_lat, center_lon, len_lat, len_lon, val):
     proj = pyproj.Proj(proj='aeqd', ellps=ellps, datum=ellps, lat_0=center_lat, lon_0=center_lon)
     dx = np.arange(-len_lon_m, len_lon_m + val_m, val_m)
     dy = np.arange(-len_lat_m, len_lat_m + val_m, val_m)
-    bin_mat = np.zeros([dy.size, dx.size, 2])
-    bin_map = np.zeros([dy.size, dx.size]).astype(int)
-    n = 0
-    bin_loca = []
-    for j, dyy in enumerate(dy):
-        for i, dxx in enumerate(dx):
-            glon, glat = proj(dxx, dyy, inverse=True)
-            bin_loca.append([glat, glon])
-            bin_mat[j, i, 0] = glat
-            bin_mat[j, i, 1] = glon
-            bin_map[j, i] = n
-            n += 1 
-    return np.array(bin_loca), bin_mat, bin_map
+    dxx, dyy = np.meshgrid(dx, dy)
+    glon, glat = proj(dxx, dyy, inverse=True)
+    bin_mat = np.stack([glat, glon], axis=-1)
+    bin_map = np.arange(dy.size * dx.size).reshape(dy.size, dx.size)
+    return bin_mat.reshape(-1, 2).copy(), bin_mat, bin_map
 
 
 def bin_shape(cpara):
@@ -64,13 +58,12 @@ def bin_shape(cpara):
     return fzone
 
 
-def boot_bin_stack(data_bin, n_samples=3000):
-    warnings.filterwarnings("ignore")
+def boot_bin_stack(data_bin, n_samples=3000, seed=None):
     data_bin = data_bin[~np.isnan(data_bin)]
     count = data_bin.shape[0]
     if count > 1:
         if n_samples is not None:
-            cci = ci(data_bin, n_samples=n_samples)
+            cci = Bootstrap(n_samples, seed=seed).ci(data_bin)
         else:
             cci = np.array([np.nan, np.nan])
         mu = np.nanmean(data_bin)
@@ -80,6 +73,303 @@ def boot_bin_stack(data_bin, n_samples=3000):
     return mu, cci, count
 
 
+def boot_stack_bins(data_bins, boot=None):
+    """Stack amplitudes of bins with confidence intervals calculated with a shared :class:`seispy.bootstrap.Bootstrap`.
+    The same results as :func:`boot_bin_stack` for each bin.
+
+    :param data_bins: Amplitudes falling in each bin
+    :type data_bins: list
+    :param boot: Bootstrap instance, defaults to None for no confidence intervals
+    :type boot: :class:`seispy.bootstrap.Bootstrap`, optional
+    :return: Means, confidence intervals and counts of bins
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    data_bins = [data_bin[~np.isnan(data_bin)] for data_bin in data_bins]
+    count = np.array([data_bin.size for data_bin in data_bins])
+    mu = np.array([np.mean(data_bin) if data_bin.size > 1 else np.nan for data_bin in data_bins])
+    if boot is not None:
+        cci = boot.ci_batch(data_bins)
+    else:
+        cci = np.full((len(data_bins), 2), np.nan)
+    return mu, cci, count
+
+
+def stack_bins(rfdep, bin_loca, idxs, fzone, depth_idx, boot=None, field_lat='piercelat', field_lon='piercelon'):
+    """Stack amplitudes of pierce points falling in bins.
+    With bootstrap, amplitudes of bins are searched with :class:`seispy.core.pierceindex.PierceIndex` at each depth.
+    Otherwise, means and standard errors are calculated from sums of amplitudes accumulated with
+    :class:`seispy.core.pierceindex.BinStack`.
+
+    :param rfdep: RFdepth data
+    :type rfdep: list or :class:`seispy.core.rfdepth.RFDepthArray` or dict
+    :param bin_loca: Positions of bins with shape of (nbin, 2)
+    :type bin_loca: numpy.ndarray
+    :param idxs: Indices of stations used for each bin as a list of arrays, or for all bins as an array
+    :type idxs: list or numpy.ndarray
+    :param fzone: Radius of bins in degree at each depth
+    :type fzone: numpy.ndarray
+    :param depth_idx: Indices in ``depthrange`` of stacking depths
+    :type depth_idx: numpy.ndarray
+    :param boot: Bootstrap instance, defaults to None for no confidence intervals
+    :type boot: :class:`seispy.bootstrap.Bootstrap`, optional
+    :return: Means, confidence intervals, counts, standard errors and sums with sums of squares
+        with shape of (nbin, ndepth, 2) of bins. Standard errors and sums are None with bootstrap.
+    :rtype: tuple
+    """
+    nbin, ndep = bin_loca.shape[0], depth_idx.size
+    if isinstance(idxs, list):
+        sta_of = np.concatenate(idxs).astype(int) if nbin else np.array([], dtype=int)
+        bin_of = np.repeat(np.arange(nbin), [len(idx) for idx in idxs])
+        stations = np.unique(sta_of)
+    else:
+        stations = np.unique(np.asarray(idxs, dtype=int))
+    if boot is None:
+        bin_stack = BinStack(bin_loca[:, 0], bin_loca[:, 1], fzone, depth_idx, field_lat=field_lat, field_lon=field_lon)
+        for k in stations:
+            bin_stack.add_station(rfdep[k], bin_of[sta_of == k] if isinstance(idxs, list) else None)
+        return bin_stack.mu, np.full([nbin, ndep, 2], np.nan), bin_stack.count.astype(float), bin_stack.std_err, \
+               np.stack([bin_stack.sum, bin_stack.sumsq], axis=-1)
+    bin_mu = np.zeros([nbin, ndep])
+    bin_ci = np.zeros([nbin, ndep, 2])
+    bin_count = np.zeros([nbin, ndep])
+    pierce = PierceIndex(rfdep, stations, field_lat=field_lat, field_lon=field_lon)
+    for j, idx in enumerate(depth_idx):
+        pierce.set_depth(idx)
+        amps = pierce.query(bin_loca[:, 0], bin_loca[:, 1], fzone[j], stations=idxs)
+        bin_mu[:, j], bin_ci[:, j], bin_count[:, j] = boot_stack_bins(amps, boot)
+    return bin_mu, bin_ci, bin_count, None, None
+
+
+_worker = {}
+
+
+def _init_worker(rfdep, kwargs):
+    if isinstance(rfdep, str):
+        rfdep = read_rfdep(rfdep)
+    _worker['rfdep'] = rfdep
+    _worker['kwargs'] = kwargs
+
+
+def _run_worker(chunk):
+    return stack_bins(_worker['rfdep'], *chunk, **_worker['kwargs'])
+
+
+def stack_pool(rfdep, workers, boot=None, field_lat='piercelat', field_lon='piercelon'):
+    """A pool of processes for :func:`stack_chunks`, which can be reused by calls with the same RFdepth data and options.
+    Parameters are the same as :func:`stack_chunks`.
+
+    :return: Pool of processes
+    :rtype: :class:`multiprocessing.pool.Pool`
+    """
+    kwargs = dict(boot=boot, field_lat=field_lat, field_lon=field_lon)
+    return Pool(workers, initializer=_init_worker, initargs=(rfdep, kwargs))
+
+
+def stack_chunks(rfdep, bin_loca, idxs, fzone, depth_idx, boot=None, field_lat='piercelat', field_lon='piercelon',
+                 workers=1, chunk_size=None, log=None, pool=None):
+    """Stack bins in chunks with :func:`stack_bins`, serially or with a pool of ``workers`` processes.
+    Resampling indices of :class:`seispy.bootstrap.Bootstrap` only depend on the seed and the number of amplitudes,
+    so results are identical for any number of workers and size of chunks.
+
+    :param rfdep: RFdepth data, or path to RFdepth data which is read by each process
+    :type rfdep: str or list or :class:`seispy.core.rfdepth.RFDepthArray` or dict
+    :param workers: Number of processes, defaults to 1
+    :type workers: int, optional
+    :param chunk_size: Number of bins in a chunk, defaults to None for 4 chunks per process
+    :type chunk_size: int, optional
+    :param log: Logger, defaults to None
+    :type log: :class:`seispy.setuplog.setuplog`, optional
+    :param pool: A pool created by :func:`stack_pool` with the same ``rfdep`` and options, defaults to None
+    :type pool: :class:`multiprocessing.pool.Pool`, optional
+
+    See :func:`stack_bins` for other parameters and returns.
+    """
+    if log is None:
+        log = setuplog()
+    nbin = bin_loca.shape[0]
+    if chunk_size is None:
+        chunk_size = int(np.ceil(nbin / (4 * max(workers, 1))))
+    chunk_size = max(int(chunk_size), 1)
+    chunks = [(bin_loca[b:b+chunk_size], idxs[b:b+chunk_size] if isinstance(idxs, list) else idxs, fzone, depth_idx)
+              for b in range(0, max(nbin, 1), chunk_size)]
+    own_pool = pool is None and workers > 1 and len(chunks) > 1
+    if own_pool:
+        pool = stack_pool(rfdep, workers, boot=boot, field_lat=field_lat, field_lon=field_lon)
+    if pool is not None:
+        results = pool.imap(_run_worker, chunks)
+    else:
+        _init_worker(rfdep, dict(boot=boot, field_lat=field_lat, field_lon=field_lon))
+        results = map(_run_worker, chunks)
+    out = []
+    done = 0
+    try:
+        for chunk, result in zip(chunks, results):
+            done += chunk[0].shape[0]
+            log.CCPlog.info('{}/{} bins stacked'.format(done, nbin))
+            out.append(result)
+    finally:
+        if own_pool:
+            pool.terminate()
+        _worker.clear()
+    return tuple(None if out[0][n] is None else np.concatenate([res[n] for res in out]) for n in range(len(out[0])))
+
+
+def search_peaks(data, depths, depmin, depmax):
+    """Search the maximum positive peak within a depth range for all bins at once.
+    Peaks are local maxima as :func:`seispy.geo.extrema`, and the largest one in each bin is picked with a masked argmax.
+
+    :param data: Smoothed stacked amplitudes with shape of ``(nbin, ndepth)``
+    :type data: numpy.ndarray
+    :param depths: Depths of samples
+    :type depths: numpy.ndarray
+    :param depmin: Minimum depth of the range
+    :type depmin: float
+    :param depmax: Maximum depth of the range
+    :type depmax: float
+    :return: Depths of peaks, NaN for bins without peaks in the range
+    :rtype: numpy.ndarray
+    """
+    data = np.asarray(data, dtype=float)
+    diff = np.diff(data, axis=1)
+    ispeak = np.zeros(data.shape, dtype=bool)
+    ispeak[:, 1:-1] = (diff[:, :-1] > 0) & (diff[:, 1:] < 0)
+    with np.errstate(invalid='ignore'):
+        ispeak &= (data > 0) & (depths > depmin) & (depths < depmax)
+    peak_depth = np.full(data.shape[0], np.nan)
+    found = ispeak.any(axis=1)
+    idx = np.where(ispeak, data, -np.inf).argmax(axis=1)
+    peak_depth[found] = depths[idx[found]]
+    return peak_depth
+
+
+def peak_stats(stack_data, peak_depth, dep_start, dep_val):
+    """Stacked amplitudes, counts and confidence intervals at depths of peaks
+
+    :param stack_data: Stacked data
+    :type stack_data: :class:`seispy.core.ccpstack.StackData`
+    :param peak_depth: Depths of peaks for each bin, NaN for bins without peaks
+    :type peak_depth: numpy.ndarray
+    :param dep_start: The first stacking depth
+    :type dep_start: float
+    :param dep_val: Interval of stacking depths
+    :type dep_val: float
+    :return: Arrays of ``amp``, ``count``, ``ci_low`` and ``ci_high``, NaN for bins without peaks
+    :rtype: dict
+    """
+    found = ~np.isnan(peak_depth)
+    bins = np.where(found)[0]
+    idx = ((peak_depth[found] - dep_start) / dep_val).astype(int)
+    stats = {}
+    for key, field in zip(('amp', 'count', 'ci_low', 'ci_high'), ('mu', 'count', 'ci_low', 'ci_high')):
+        stats[key] = np.full(peak_depth.size, np.nan)
+        stats[key][bins] = getattr(stack_data, field)[bins, idx]
+    return stats
+
+
+def depth_err(mu, depths, good_depth, ref='std', ci_low=None):
+    """Errors of picked depths for all bins at once. The segment around the picked depth is bounded by the
+    nearest local minima of the stacked amplitudes above and below it, and a reference value is set by
+    ``ref``. The errors are the two depths where the stacked amplitudes in the segment cross the reference value,
+    which are linearly interpolated between samples.
+
+    :param mu: Stacked amplitudes with shape of ``(nbin, ndepth)``
+    :type mu: numpy.ndarray
+    :param depths: Stacking depths
+    :type depths: numpy.ndarray
+    :param good_depth: Picked depths for each bin, NaN for bins without picks
+    :type good_depth: numpy.ndarray
+    :param ref: ``'std'`` for the amplitude at the picked depth minus 1.645 times the standard error in the segment,
+        ``'ci'`` for the lower bound of the confidence interval at the picked depth, defaults to 'std'
+    :type ref: str, optional
+    :param ci_low: Lower bounds of confidence intervals with shape of ``(nbin, ndepth)``, required for ``ref='ci'``
+    :type ci_low: numpy.ndarray, optional
+    :return: Upper and lower depths of errors with shape of ``(nbin, 2)``, NaN for bins without two crossings
+    :rtype: numpy.ndarray
+    """
+    if ref not in ('std', 'ci'):
+        raise ValueError('Reference type should be in \'std\' and \'ci\'')
+    depths = np.asarray(depths, dtype=float)
+    good_depth = np.asarray(good_depth, dtype=float)
+    err = np.full((good_depth.size, 2), np.nan)
+    bins = np.where(~np.isnan(good_depth))[0]
+    if bins.size == 0 or depths.size < 3:
+        return err
+    mu = np.asarray(mu[bins], dtype=float)
+    ndep = depths.size
+    # the nearest stacking depth, the first one for ties as np.nanargmin
+    upper = np.clip(np.searchsorted(depths, good_depth[bins]), 1, ndep - 1)
+    idx = np.where(np.abs(depths[upper - 1] - good_depth[bins]) <= np.abs(depths[upper] - good_depth[bins]),
+                   upper - 1, upper)
+    # local minima as seispy.geo.extrema, bracketing the picked depth
+    ismin = np.zeros(mu.shape, dtype=bool)
+    ismin[:, 1:-1] = (mu[:, 1:-1] < mu[:, :-2]) & (mu[:, 1:-1] < mu[:, 2:])
+    min_pos = np.flatnonzero(ismin)
+    pos = np.arange(bins.size) * ndep + idx
+    low_pos = min_pos[np.maximum(np.searchsorted(min_pos, pos) - 1, 0)] if min_pos.size else pos
+    up_pos = min_pos[np.minimum(np.searchsorted(min_pos, pos, side='right'), min_pos.size - 1)] if min_pos.size else pos
+    found = (low_pos < pos) & (low_pos // ndep == pos // ndep) & (up_pos > pos) & (up_pos // ndep == pos // ndep)
+    rows, bins, idx = np.where(found)[0], bins[found], idx[found]
+    low_idx, up_idx = low_pos[found] % ndep, up_pos[found] % ndep
+    if bins.size == 0:
+        return err
+    # segments between minima gathered into a window of the longest segment
+    npts = up_idx - low_idx + 1
+    seg_idx = np.minimum(low_idx[:, np.newaxis] + np.arange(npts.max()), ndep - 1)
+    inseg = np.arange(seg_idx.shape[1]) < npts[:, np.newaxis]
+    seg = mu[rows[:, np.newaxis], seg_idx]
+    if ref == 'std':
+        mean = np.where(inseg, seg, 0).sum(axis=1) / npts
+        std = np.sqrt(np.where(inseg, (seg - mean[:, np.newaxis]) ** 2, 0).sum(axis=1) / npts)
+        cvalue = mu[rows, idx] - 1.645 * std / np.sqrt(npts)
+    else:
+        cvalue = np.asarray(ci_low[bins, idx], dtype=float)
+    cvalue = cvalue[:, np.newaxis]
+    amp0, amp1 = seg[:, :-1], seg[:, 1:]
+    cross = ((amp0 <= cvalue) & (cvalue < amp1)) | ((amp0 > cvalue) & (cvalue >= amp1))
+    cross &= inseg[:, 1:]
+    two = np.where(cross.sum(axis=1) == 2)[0]
+    first = np.argmax(cross[two], axis=1)
+    second = cross.shape[1] - 1 - np.argmax(cross[two, ::-1], axis=1)
+    for j, k in enumerate((first, second)):
+        a, b = seg[two, k], seg[two, k + 1]
+        da, db = depths[seg_idx[two, k]], depths[seg_idx[two, k + 1]]
+        c = cvalue[two, 0]
+        # interpolate with points sorted by amplitudes as scipy.interpolate.interp1d
+        err[bins[two], j] = np.where(a <= b, (db - da) / (b - a) * (c - a) + da, (da - db) / (a - b) * (c - b) + db)
+    return err
+
+
+def tile_stations(bbox, bin_lat, bin_lon, radius):
+    """Stations of which pierce points may fall within bins of a tile. The box of bins is enlarged by the radius
+    with margins for geocentric latitudes used by :class:`seispy.distaz.distaz`, so no station with pierce points
+    in the bins is missed.
+
+    :param bbox: Bounding boxes of pierce points of stations, see :func:`seispy.core.rfdepth.station_bbox`
+    :type bbox: numpy.ndarray
+    :param bin_lat: Latitudes of bins in the tile
+    :type bin_lat: numpy.ndarray
+    :param bin_lon: Longitudes of bins in the tile
+    :type bin_lon: numpy.ndarray
+    :param radius: The maximum radius of bins in degree
+    :type radius: float
+    :return: Mask of stations
+    :rtype: numpy.ndarray
+    """
+    pad_lat = radius * 1.01 + 1e-6
+    lat_min, lat_max = np.min(bin_lat) - pad_lat, np.max(bin_lat) + pad_lat
+    with np.errstate(invalid='ignore'):
+        inside = (bbox[:, 1] >= lat_min) & (bbox[:, 0] <= lat_max)
+        ratio = np.sin(np.radians(pad_lat)) / np.cos(np.radians(min(max(abs(lat_min), abs(lat_max)), 90.)))
+        if ratio >= 1:
+            return inside & ~np.isnan(bbox[:, 2])
+        pad_lon = np.degrees(np.arcsin(ratio)) + 1e-6
+        lon_min, lon_max = np.min(bin_lon) - pad_lon, np.max(bin_lon) + pad_lon
+        overlap = np.zeros(bbox.shape[0], dtype=bool)
+        for shift in (-360, 0, 360):
+            overlap |= (bbox[:, 3] >= lon_min + shift) & (bbox[:, 2] <= lon_max + shift)
+    return inside & overlap
+
+
 def _get_sta(rfdep):
     return np.array([[sta['stalat'], sta['stalon']] for sta in rfdep])
 
@@ -116,6 +406,7 @@ class CCP3D():
         self.bin_loca = None
         self.bin_mat = None
         self.bin_map = None
+        self.stack_sta = None
 
     def load_para(self, cfg_file):
         try:
@@ -147,37 +438,166 @@ class CCP3D():
     def _select_sta(self, bin_lat, bin_lon):
         return np.where(distaz(bin_lat, bin_lon, self.stalst[:, 0], self.stalst[:, 1]).delta <= self.dismin)[0]
 
-    def stack(self):
+    def _depth_index(self):
+        return np.array([int(j * self.stack_mul + self.cpara.stack_range[0]/self.cpara.dep_val)
+                         for j in range(self.cpara.stack_range.size)])
+
+    def stack(self, workers=1, chunk_size=None):
         """Search conversion points falling within a bin and stack them with bootstrap method.
+        Without bootstrap (``boot_samples`` is None), means and standard errors are calculated
+        from sums of amplitudes. See :func:`stack_chunks` for details.
+
+        :param workers: Number of processes stacking chunks of bins, defaults to 1
+        :type workers: int, optional
+        :param chunk_size: Number of bins in a chunk, defaults to None
+        :type chunk_size: int, optional
+        """
+        idxs = [self._select_sta(bin_info[0], bin_info[1]) for bin_info in self.bin_loca]
+        boot = None if self.cpara.boot_samples is None else Bootstrap(self.cpara.boot_samples, seed=self.cpara.boot_seed)
+        # workers read the RFdepth file themselves, which is memory-mapped in the columnar format
+        rfdep = self.cpara.depthdat if workers > 1 else self.rfdep
+        self._set_stack_data(*stack_chunks(rfdep, self.bin_loca, idxs, self.fzone, self._depth_index(), boot=boot,
+                                           workers=workers, chunk_size=chunk_size, log=self.logger))
+        self.stack_sta = self._station_info()
+
+    def _station_info(self):
+        """Names, numbers of events and digests of stations in RFdepth data, see :func:`station_digests`"""
+        return station_events(self.rfdep) + (station_digests(self.rfdep, self.cpara.depthdat),)
+
+    def _set_stack_data(self, bin_mu, bin_ci, bin_count, bin_se, bin_sum):
+        self.stack_data = StackData(self.bin_loca[:, 0], self.bin_loca[:, 1], bin_mu, ci_low=bin_ci[..., 0],
+                                    ci_high=bin_ci[..., 1], count=bin_count, std_err=bin_se,
+                                    sum=None if bin_sum is None else bin_sum[..., 0],
+                                    sumsq=None if bin_sum is None else bin_sum[..., 1])
+
+    def stack_tiles(self, fname, tile_size=50, workers=1, chunk_size=None):
+        """Stack bins by tiles and save stacked data into ``fname``, for grids too large to be stacked in memory.
+        The grid is split into tiles of ``tile_size`` by ``tile_size`` bins. Each tile is stacked with stations of which
+        pierce points fall around the tile, found from bounding boxes in RFdepth data,
+        and written into a store of memory-mapped arrays next to ``fname``. The store is then saved as a file of
+        :meth:`CCP3D.save_stack_data`, which is memory-mapped as ``stack_data``.
+        Results are the same as :meth:`CCP3D.stack`.
+
+        :param fname: file name of stacked data
+        :type fname: str
+        :param tile_size: Number of bins along each side of tiles, defaults to 50
+        :type tile_size: int, optional
+        :param workers: Number of processes stacking chunks of bins, defaults to 1
+        :type workers: int, optional
+        :param chunk_size: Number of bins in a chunk, defaults to None
+        :type chunk_size: int, optional
         """
-        for i, bin_info in enumerate(self.bin_loca):
-            boot_stack = {}
-            bin_mu = np.zeros(self.cpara.stack_range.size)
-            bin_ci = np.zeros([self.cpara.stack_range.size, 2])
-            bin_count = np.zeros(self.cpara.stack_range.size)
-            self.logger.CCPlog.info('{}/{} bin at lat: {:.3f} lon: {:.3f}'.format(i + 1, self.bin_loca.shape[0],
-                                                                                  bin_info[0], bin_info[1]))
-            idxs = self._select_sta(bin_info[0], bin_info[1])
-            for j, dep in enumerate(self.cpara.stack_range):
-                idx = int(j * self.stack_mul + self.cpara.stack_range[0]/self.cpara.dep_val)
-                bin_dep_amp = np.array([])
-                for k in idxs:
-                    stop_idx = np.where(self.rfdep[k]['stopindex'] >= idx)[0]
-                    fall_idx = np.where(distaz(self.rfdep[k]['piercelat'][stop_idx, idx], self.rfdep[k]['piercelon'][stop_idx, idx],
-                                        bin_info[0], bin_info[1]).delta < self.fzone[j])[0]
-                    bin_dep_amp = np.append(bin_dep_amp, self.rfdep[k]['moveout_correct'][stop_idx[fall_idx], idx])
-                bin_mu[j], bin_ci[j], bin_count[j] = boot_bin_stack(bin_dep_amp, n_samples=self.cpara.boot_samples)
-            boot_stack['bin_lat'] = bin_info[0]
-            boot_stack['bin_lon'] = bin_info[1]
-            boot_stack['mu'] = bin_mu
-            boot_stack['ci'] = bin_ci
-            boot_stack['count'] = bin_count
-            self.stack_data.append(boot_stack)
- 
+        if not fname.endswith('.npz'):
+            fname += '.npz'
+        boot = None if self.cpara.boot_samples is None else Bootstrap(self.cpara.boot_samples, seed=self.cpara.boot_seed)
+        depth_idx = self._depth_index()
+        bbox = station_bbox(self.rfdep)
+        store = StackStore(fname[:-4] + '.tiles', self.bin_loca[:, 0], self.bin_loca[:, 1], depth_idx.size,
+                           sums=boot is None)
+        nlat, nlon = self.bin_map.shape
+        tiles = [(i, j) for i in range(0, nlat, tile_size) for j in range(0, nlon, tile_size)]
+        # workers read the RFdepth file themselves, which is memory-mapped in the columnar format
+        pool = stack_pool(self.cpara.depthdat, workers, boot=boot) if workers > 1 else None
+        try:
+            for n, (i, j) in enumerate(tiles):
+                bins = self.bin_map[i:i+tile_size, j:j+tile_size].ravel()
+                tile_loca = self.bin_loca[bins]
+                cand = np.where(tile_stations(bbox, tile_loca[:, 0], tile_loca[:, 1], np.max(self.fzone)))[0]
+                idxs = [cand[distaz(lat, lon, self.stalst[cand, 0], self.stalst[cand, 1]).delta <= self.dismin]
+                        for lat, lon in tile_loca]
+                self.logger.CCPlog.info('Stacking tile {}/{} with {} stations'.format(n + 1, len(tiles), cand.size))
+                store.write(bins, *stack_chunks(self.rfdep, tile_loca, idxs, self.fzone, depth_idx, boot=boot,
+                                                workers=workers, chunk_size=chunk_size, log=self.logger, pool=pool))
+            self.logger.CCPlog.info('Saving stacked data to {}'.format(fname))
+            self.stack_sta = self._station_info()
+            store.save(fname, self.cpara, **self._grid_arrays())
+        finally:
+            if pool is not None:
+                pool.terminate()
+            store.remove()
+        self.stack_data, _, _ = load_stack(fname)
+
+    def update_stack(self, fname, workers=1, chunk_size=None):
+        """Add new stations in RFdepth data to stacked data saved by :meth:`CCP3D.save_stack_data`,
+        so that only bins around new stations are changed. Without bootstrap, amplitudes of new stations
+        are accumulated into sums of amplitudes saved in ``fname``. With bootstrap, confidence intervals need all
+        amplitudes in a bin, so bins around new stations are stacked again with all stations.
+        All bins are stacked if parameters of stacking differ or stations in ``fname`` are removed or changed,
+        which are found by digests of stations, see :func:`seispy.core.rfdepth.station_digests`.
+        Results are the same as :meth:`CCP3D.stack`, please save them with :meth:`CCP3D.save_stack_data`.
+
+        :param fname: file name of stacked data
+        :type fname: str
+        :param workers: Number of processes stacking chunks of bins, defaults to 1
+        :type workers: int, optional
+        :param chunk_size: Number of bins in a chunk, defaults to None
+        :type chunk_size: int, optional
+        """
+        stack_data, cpara, arrays = load_stack(fname, mmap=False)
+        names, events, digests = self._station_info()
+        reason = self._update_conflict(stack_data, cpara, arrays, names, digests)
+        if reason is not None:
+            self.logger.CCPlog.warning('{}, stacking all bins'.format(reason))
+            self.stack(workers=workers, chunk_size=chunk_size)
+            return
+        self.stack_data = stack_data
+        self.stack_sta = (names, events, digests)
+        new_sta = np.where(~np.isin(names, arrays['stations']))[0]
+        if new_sta.size == 0:
+            self.logger.CCPlog.info('No new stations in {}'.format(self.cpara.depthdat))
+            return
+        # bins around new stations with the same criterion as CCP3D._select_sta
+        near = np.array([distaz(self.bin_loca[:, 0], self.bin_loca[:, 1], self.stalst[k, 0], self.stalst[k, 1]).delta
+                         <= self.dismin for k in new_sta])
+        bins = np.where(near.any(axis=0))[0]
+        self.logger.CCPlog.info('Adding {} new stations to {} bins'.format(new_sta.size, bins.size))
+        depth_idx = self._depth_index()
+        if self.cpara.boot_samples is None:
+            bin_stack = BinStack(self.bin_loca[bins, 0], self.bin_loca[bins, 1], self.fzone, depth_idx)
+            bin_stack.sum[:] = stack_data.sum[bins]
+            bin_stack.sumsq[:] = stack_data.sumsq[bins]
+            bin_stack.count[:] = stack_data.count[bins]
+            for k, sta_near in zip(new_sta, near):
+                bin_stack.add_station(self.rfdep[k], np.where(sta_near[bins])[0])
+            stack_data.mu[bins] = bin_stack.mu
+            stack_data.std_err[bins] = bin_stack.std_err
+            stack_data.count[bins] = bin_stack.count
+            stack_data.sum[bins] = bin_stack.sum
+            stack_data.sumsq[bins] = bin_stack.sumsq
+        else:
+            idxs = [self._select_sta(bin_info[0], bin_info[1]) for bin_info in self.bin_loca[bins]]
+            boot = Bootstrap(self.cpara.boot_samples, seed=self.cpara.boot_seed)
+            rfdep = self.cpara.depthdat if workers > 1 else self.rfdep
+            bin_mu, bin_ci, bin_count, _, _ = stack_chunks(rfdep, self.bin_loca[bins], idxs, self.fzone, depth_idx,
+                                                           boot=boot, workers=workers, chunk_size=chunk_size,
+                                                           log=self.logger)
+            stack_data.mu[bins] = bin_mu
+            stack_data.ci_low[bins] = bin_ci[..., 0]
+            stack_data.ci_high[bins] = bin_ci[..., 1]
+            stack_data.count[bins] = bin_count
+
+    def _update_conflict(self, stack_data, cpara, arrays, names, digests):
+        """Reason why stacked data in a file cannot be updated with RFdepth data, None if it can be"""
+        if 'station_digests' not in arrays:
+            return 'No digests of stations recorded with the stacked data'
+        if stack_data.bin_lat.size != self.bin_loca.shape[0]:
+            return 'Bins of the stacked data differ'
+        old_para, new_para = cpara.to_dict(), self.cpara.to_dict()
+        for key in ('center_bin', 'stack_range', 'bin_radius', 'domperiod', 'shape', 'dep_val', 'stack_val',
+                    'boot_samples', 'boot_seed'):
+            if old_para.get(key) != new_para.get(key):
+                return 'Parameter {} of the stacked data differs'.format(key)
+        if self.cpara.boot_samples is None and stack_data.sum is None:
+            return 'No sums of amplitudes in the stacked data'
+        sta_idx = {name: k for k, name in enumerate(names)}
+        for name, digest in zip(arrays['stations'], arrays['station_digests']):
+            if name not in sta_idx or digests[sta_idx[name]] != digest:
+                return 'Station {} is removed or changed'.format(name)
+        return None
+
     def save_stack_data(self, fname):
-        """Save stacked data and parameters to local as a npz file. To load the file, please use data = np.load(fname, allow_pickle=True).
-        data['cpara'] is the parameters when CCP stacking.
-        data['stack_data'] is the result of stacked data.
+        """Save stacked data, parameters and the grid of bins to local as a npz file of plain arrays.
+        To load the file, please use :meth:`CCP3D.read_stack_data` or :func:`seispy.core.ccpstack.load_stack`.
 
         :param fname: file name of stacked data
         :type fname: str
@@ -185,62 +605,42 @@ class CCP3D():
         if not isinstance(fname, str):
             self.logger.CCPlog.error('fname should be in \'str\'')
             raise ValueError('fname should be in \'str\'')
-        np.savez(fname, cpara=self.cpara, stack_data=self.stack_data)
-    
-    def _search_peak(self, tr, peak_410_min=380, peak_410_max=440, peak_660_min=630, peak_660_max=690):
-        tr = smooth(tr, half_len=4)
-        idx_all = extrema(tr)
-        idx_ex = np.where(tr[idx_all] > 0)[0]
-        #idx = idx_all[idx_ex]
-        peak = tr[idx_all[idx_ex]]
-        peak_depth = idx_all[idx_ex] * self.cpara.stack_val + self.cpara.stack_range[0]
-        idx_410 = np.where((peak_depth>peak_410_min) & (peak_depth<peak_410_max))[0]
-        try:
-            idx_410_max = idx_410[np.nanargmax(peak[idx_410])]
-            dep_410 = peak_depth[idx_410_max]
-        except:
-            dep_410 = np.nan
-        idx_660 = np.where((peak_depth>peak_660_min) & (peak_depth<peak_660_max))[0]
-        try:
-            idx_660_max = idx_660[np.nanargmax(peak[idx_660])]
-            dep_660 = peak_depth[idx_660_max]
-        except:
-            dep_660 = np.nan
-        return dep_410, dep_660
+        save_stack(fname, self.stack_data, self.cpara, **self._grid_arrays())
 
+    def _grid_arrays(self):
+        """The grid of bins and stations in the stacked data, saved with stacked data"""
+        arrays = {'bin_mat': self.bin_mat, 'bin_map': self.bin_map}
+        if self.stack_sta is not None:
+            arrays['stations'], arrays['station_events'], arrays['station_digests'] = self.stack_sta
+        return arrays
+    
     def search_good_410_660(self, peak_410_min=380, peak_410_max=440, peak_660_min=630, peak_660_max=690):
-        self.good_410_660 = np.zeros_like(self.bin_loca)
-        for i, boot_stack in enumerate(self.stack_data):
-            self.good_410_660[i, 0], self.good_410_660[i, 1] = self._search_peak(boot_stack['mu'], peak_410_min, peak_410_max, peak_660_min, peak_660_max)
+        tr = smooth_rows(self.stack_data.mu, half_len=4)
+        depths = np.arange(tr.shape[1]) * self.cpara.stack_val + self.cpara.stack_range[0]
+        self.good_410_660 = np.column_stack([search_peaks(tr, depths, peak_410_min, peak_410_max),
+                                             search_peaks(tr, depths, peak_660_min, peak_660_max)])
 
     def save_good_410_660(self, fname):
+        peaks = [peak_stats(self.stack_data, self.good_410_660[:, i], self.cpara.stack_range[0], self.cpara.stack_val)
+                 for i in range(2)]
         with open(fname, 'w') as f:
             for i, good_peak in enumerate(self.good_410_660):
-                if np.isnan(good_peak[0]):
-                    ci_410 = np.array([np.nan, np.nan])
-                    count_410 = np.nan
-                else:
-                    idx = int((good_peak[0]-self.cpara.stack_range[0]) / self.cpara.stack_val)
-                    ci_410 = self.stack_data[i]['ci'][idx]
-                    count_410 = self.stack_data[i]['count'][idx]
-                if np.isnan(good_peak[1]):
-                    ci_660 = np.array([np.nan, np.nan])
-                    count_660 = np.nan
-                else:
-                    idx = int((good_peak[1]-self.cpara.stack_range[0]) / self.cpara.stack_val)
-                    ci_660 = self.stack_data[i]['ci'][idx]
-                    count_660 = self.stack_data[i]['count'][idx]
-                f.write('{:.3f} {:.3f} {:.0f} {:.4f} {:.4f} {:.0f} {:.0f} {:.4f} {:.4f} {:.0f}\n'.format(   
-                        self.bin_loca[i, 0], self.bin_loca[i, 1], good_peak[0], ci_410[0], ci_410[1], count_410,
-                        good_peak[1], ci_660[0], ci_660[1], count_660))
+                f.write('{:.3f} {:.3f} {:.0f} {:.4f} {:.4f} {:.0f} {:.0f} {:.4f} {:.4f} {:.0f}\n'.format(
+                        self.bin_loca[i, 0], self.bin_loca[i, 1], good_peak[0], peaks[0]['ci_low'][i],
+                        peaks[0]['ci_high'][i], peaks[0]['count'][i], good_peak[1], peaks[1]['ci_low'][i],
+                        peaks[1]['ci_high'][i], peaks[1]['count'][i]))
 
     @classmethod
     def read_stack_data(cls, stack_data_path, cfg_file=None, good_depth_path=None, ismtz=False):
         ccp = cls(cfg_file)
-        data = np.load(stack_data_path, allow_pickle=True)
-        ccp.stack_data = data['stack_data']
-        ccp.cpara = data['cpara'].any()
-        ccp.bin_loca, ccp.bin_mat, ccp.bin_map = gen_center_bin(*ccp.cpara.center_bin)
+        ccp.stack_data, ccp.cpara, arrays = load_stack(stack_data_path)
+        if 'bin_mat' in arrays:
+            ccp.bin_loca = np.column_stack((ccp.stack_data.bin_lat, ccp.stack_data.bin_lon))
+            ccp.bin_mat, ccp.bin_map = arrays['bin_mat'], arrays['bin_map']
+        else:
+            ccp.bin_loca, ccp.bin_mat, ccp.bin_map = gen_center_bin(*ccp.cpara.center_bin)
+        if 'station_digests' in arrays:
+            ccp.stack_sta = (arrays['stations'], arrays['station_events'], arrays['station_digests'])
         if good_depth_path is not None:
             if ismtz:
                 ccp.good_410_660[:, 0] =  np.loadtxt(good_depth_path, usecols=[2])
@@ -250,48 +650,18 @@ class CCP3D():
         return ccp
 
     def get_depth_err(self, type='std'):
-        moho_err = np.zeros([self.bin_loca.shape[0], 2])
         self.logger.CCPlog.info('Computing errors of selected depth')
         if self.good_depth.size == 0:
             self.logger.CCPlog.error('Please load good depths before.')
             sys.exit(1)
-        if np.isnan(self.stack_data['ci']).all() and type == 'ci':
+        if type not in ('std', 'ci'):
+            self.logger.CCPlog.error('Reference type should be in \'std\' and \'ci\'')
+            sys.exit(1)
+        if np.isnan(self.stack_data.ci_low).all() and type == 'ci':
             self.logger.CCPlog.warning('No confidence intervals in stack data, using standard division instead.')
             type = 'std'
-        for i, _ in enumerate(self.bin_loca):
-            if np.isnan(self.good_depth[i]):
-                moho_err[i, 0], moho_err[i, 1] = np.nan, np.nan
-            else:
-                idx = np.nanargmin(np.abs(self.cpara.stack_range-self.good_depth[i]))
-                mu = self.stack_data[i]['mu']
-                min_idxes = extrema(mu, opt='min')
-                try:
-                    low_idx = min_idxes[np.max(np.where((min_idxes - idx) < 0)[0])]
-                    up_idx = min_idxes[np.min(np.where((min_idxes - idx) > 0)[0])]
-                except:
-                    moho_err[i, 0], moho_err[i, 1] = np.nan, np.nan
-                    continue
-                if type == 'std':
-                    cvalue = mu[idx] - 1.645 * np.std(mu[low_idx:up_idx+1])/np.sqrt(up_idx-low_idx+1)
-                elif type == 'ci':
-                    cvalue = self.stack_data[i]['ci'][idx, 0]
-                else:
-                    self.logger.error('Reference type should be in \'std\' and \'ci\'')
-                    sys.exit(1)
-                moho_err[i, 0], moho_err[i, 1] = self._get_err(mu[low_idx:up_idx+1],
-                                    self.cpara.stack_range[low_idx:up_idx+1], cvalue)
-        return moho_err
-
-    def _get_err(self, tr, dep, cvalue):
-        result = np.array([])
-        for i, amp in enumerate(tr[:-1]):
-            if (amp <= cvalue < tr[i+1]) or (amp > cvalue >= tr[i+1]):
-                result = np.append(result, interp1d([amp, tr[i+1]], 
-                                  [dep[i], dep[i+1]])(cvalue))
-        if len(result) == 2:
-            return result[0], result[1]
-        else:
-            return np.nan, np.nan
+        return depth_err(self.stack_data.mu, self.cpara.stack_range, self.good_depth,
+                         ref=type, ci_low=self.stack_data.ci_low)
 
 if __name__ == '__main__':
     bin_loca = gen_center_bin(48.5, 100, 5, 8, km2deg(55))
@@ -11,6 +11,7 @@ class CCPPara(object):
         self.rfpath = expanduser('~')
         self.rayp_lib = None
         self.depthdat = 'RFdepth.npy'
+        self.rfdep_format = 'npy'
         self.stackfile = 'ccp.dat'
         self.stalist = 'sta.lst'
         self.peakfile = 'good_410_660.dat'
@@ -29,12 +30,36 @@ class CCPPara(object):
         self.dep_val = 1
         self.stack_val = 1
         self.boot_samples = None
+        self.boot_seed = None
         self.phase = 1
     
     def __str__(self):
         head = ['{}: {}'.format(k, v) for k, v in self.__dict__.items()]
         return '\n'.join(head)
 
+    def to_dict(self):
+        """Parameters as a dict of JSON serializable values"""
+        para = {}
+        for key, value in self.__dict__.items():
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, np.generic):
+                value = value.item()
+            elif isinstance(value, (list, tuple)):
+                value = [v.item() if isinstance(v, np.generic) else v for v in value]
+            para[key.lstrip('_')] = value
+        return para
+
+    @classmethod
+    def from_dict(cls, para):
+        """Parameters from a dict created by :meth:`CCPPara.to_dict`"""
+        cpara = cls()
+        for key, value in para.items():
+            if isinstance(getattr(cpara, key, None), np.ndarray):
+                value = np.array(value)
+            setattr(cpara, key, value)
+        return cpara
+
     @property
     def bin_radius(self):
         return self._bin_radius
@@ -75,6 +100,13 @@ def ccppara(cfg_file):
     else:
         cpara.rayp_lib = rayp_lib
     cpara.depthdat = cf.get('FileIO', 'depthdat')
+    if cf.has_option('FileIO', 'rfdep_format'):
+        rfdep_format = cf.get('FileIO', 'rfdep_format').lower()
+        if rfdep_format == '':
+            rfdep_format = 'npy'
+        elif rfdep_format not in ('npy', 'columnar'):
+            raise ValueError('rfdep_format must be in \'npy\' or \'columnar\'')
+        cpara.rfdep_format = rfdep_format
     cpara.stackfile = cf.get('FileIO', 'stackfile')
     cpara.stalist = cf.get('FileIO', 'stalist')
     cpara.stack_sta_list = cf.get('FileIO', 'stack_sta_list')
@@ -150,5 +182,9 @@ def ccppara(cfg_file):
         cpara.boot_samples = cf.getint('stack', 'boot_samples')
     except:
         cpara.boot_samples = None
+    try:
+        cpara.boot_seed = cf.getint('stack', 'boot_seed')
+    except:
+        cpara.boot_seed = None
 
     return cpara
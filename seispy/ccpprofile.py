@@ -7,19 +7,50 @@ from seispy.distaz import distaz
 from seispy.core.depmodel import DepModel
 from seispy.rf2depth_makedata import Station
 from seispy.ccppara import ccppara, CCPPara
-from scikits.bootstrap import ci
-from seispy.ccp3d import boot_bin_stack
+from seispy.ccp3d import stack_chunks
+from seispy.core.ccpstack import StackData, save_stack
+from seispy.bootstrap import Bootstrap
 from seispy.utils import check_stack_val, read_rfdep
 from scipy.interpolate import interp1d
 from os.path import exists, dirname, basename, join
+from multiprocessing import Pool
+from copy import copy, deepcopy
 import sys
 
 
 def prof_range(lat, lon):
-    dis = [0]
-    for i in range(lat.size-1):
-        dis.append(distaz(lat[i], lon[i], lat[i+1], lon[i+1]).degreesToKilometers())
-    return np.cumsum(dis)
+    """Cumulative distances in km along a line through points
+
+    :param lat: Latitudes of points
+    :type lat: numpy.ndarray
+    :param lon: Longitudes of points
+    :type lon: numpy.ndarray
+    :return: Distances between each point and the first one along the line
+    :rtype: numpy.ndarray
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    dis = distaz(lat[:-1], lon[:-1], lat[1:], lon[1:]).degreesToKilometers()
+    return np.cumsum(np.append(0, dis))
+
+
+def bin_sta_dist(bin_lat, bin_lon, stalat, stalon):
+    """Great circle distances between bins and stations
+
+    :param bin_lat: Latitudes of bins
+    :type bin_lat: numpy.ndarray
+    :param bin_lon: Longitudes of bins
+    :type bin_lon: numpy.ndarray
+    :param stalat: Latitudes of stations
+    :type stalat: numpy.ndarray
+    :param stalon: Longitudes of stations
+    :type stalon: numpy.ndarray
+    :return: Distances in degree with shape of ``(nbin, nsta)``
+    :rtype: numpy.ndarray
+    """
+    shape = (np.size(bin_lat), np.size(stalat))
+    bin_lat, bin_lon = [np.broadcast_to(np.reshape(v, (-1, 1)), shape).ravel() for v in (bin_lat, bin_lon)]
+    stalat, stalon = [np.broadcast_to(np.reshape(v, (1, -1)), shape).ravel() for v in (stalat, stalon)]
+    return distaz(bin_lat, bin_lon, stalat, stalon).delta.reshape(shape)
 
 
 def create_center_bin_profile(stations, val=5, method='linear'):
@@ -139,6 +170,11 @@ class CCPProfile():
         """Initialize bins of profile
         """
         self.read_rfdep()
+        self.initial_bins()
+
+    def initial_bins(self):
+        """Initialize bins and select stations with loaded RFdepth data
+        """
         if exists(self.cpara.stack_sta_list):
             self.stations = Station(self.cpara.stack_sta_list)
         if self.cpara.adaptive:
@@ -152,7 +188,28 @@ class CCPProfile():
         self.fzone = bin_shape(self.cpara)
         self._get_sta()
         self._select_sta()
-    
+
+    def profile(self, line, stackfile):
+        """A profile along another line sharing parameters and RFdepth data with this one.
+        A station list in ``stack_sta_list`` is shared if it exists, otherwise it is not written by the new profile.
+
+        :param line: Latitude and longitude of the start and end points
+        :type line: list or numpy.ndarray
+        :param stackfile: File name of stacked data
+        :type stackfile: str
+        :return: The new profile
+        :rtype: :class:`CCPProfile`
+        """
+        prof = CCPProfile(log=self.logger)
+        prof.cpara = deepcopy(self.cpara)
+        prof.cpara.line = np.asarray(line, dtype=float)
+        prof.cpara.stackfile = stackfile
+        if not exists(self.cpara.stack_sta_list):
+            prof.cpara.stack_sta_list = ''
+        prof.stack_mul = self.stack_mul
+        prof.rfdep = self.rfdep
+        return prof
+
     def _get_sta(self):
         """Read station info from rfdep
         """
@@ -178,9 +235,8 @@ class CCPProfile():
             x_s = np.cumsum((dep_mod.dz / dep_mod.R) / np.sqrt((1. / (skm2srad(0.085) ** 2. * (dep_mod.R / dep_mod.vs) ** -2)) - 1))
             dis = self.fzone[-1] + rad2deg(x_s[-1]) + 0.3
             # self.idxs = self._proj_sta(dis)
-            self.idxs = []
-            for i, bin_info in enumerate(self.bin_loca):
-                self.idxs.append(np.where(distaz(bin_info[0], bin_info[1], self.stalst[:, 0], self.stalst[:, 1]).delta <= dis)[0])
+            bin_dis = bin_sta_dist(self.bin_loca[:, 0], self.bin_loca[:, 1], self.stalst[:, 0], self.stalst[:, 1])
+            self.idxs = [np.where(dis_row <= dis)[0] for dis_row in bin_dis]
         elif self.cpara.width is not None and self.cpara.shape == 'rect':
             self.logger.CCPlog.info('Select stations within {} km perpendicular to the profile'.format(self.cpara.width))
             self.idxs = self._proj_sta(self.cpara.width)
@@ -221,53 +277,63 @@ class CCPProfile():
         return final_idx
 
     def _pierce_project(self, rfsta):
-        rfsta['projlat'] = np.zeros_like(rfsta['piercelat'])
-        rfsta['projlon'] = np.zeros_like(rfsta['piercelon'])
-        for i, dep in enumerate(self.cpara.depth_axis):
-            rfsta['projlat'][:, i], rfsta['projlon'][:, i] = geoproject(rfsta['piercelat'][:, i], rfsta['piercelon'][:, i], *self.cpara.line)
+        """Project pierce points of all events and depths onto the profile in one call.
+        Projections are kept in ``rfsta`` with the profile line, and reused for the same line.
+        """
+        line = tuple(float(v) for v in self.cpara.line)
+        if rfsta.get('projline') == line:
+            return
+        rfsta['projlat'], rfsta['projlon'] = geoproject(rfsta['piercelat'], rfsta['piercelon'], *line)
+        rfsta['projline'] = line
+
+    def _stack_para(self):
+        """Fields of pierce points, stations of bins, indices of stacking depths and bootstrap for stacking"""
+        if self.cpara.shape == 'circle' or self.cpara.adaptive:
+            field_lat, field_lon = 'piercelat', 'piercelon'
+        else:
+            field_lat, field_lon = 'projlat', 'projlon'
+        if self.cpara.shape == 'circle' and not exists(self.cpara.stack_sta_list):
+            idxs = self.idxs
+        else:
+            idxs = np.asarray(self.idxs, dtype=int)
+        depth_idx = np.array([int(j * self.stack_mul + self.cpara.stack_range[0]/self.cpara.dep_val)
+                              for j in range(self.cpara.stack_range.size)])
+        boot = None if self.cpara.boot_samples is None else Bootstrap(self.cpara.boot_samples, seed=self.cpara.boot_seed)
+        return field_lat, field_lon, idxs, depth_idx, boot
 
-    def stack(self):
-        """Stack RFs in bins
+    def _set_stack_data(self, bin_mu, bin_ci, bin_count, bin_se, bin_sum):
+        self.stack_data = StackData(self.bin_loca[:, 0], self.bin_loca[:, 1], bin_mu, ci_low=bin_ci[..., 0],
+                                    ci_high=bin_ci[..., 1], count=bin_count, std_err=bin_se,
+                                    profile_dis=self.profile_range,
+                                    sum=None if bin_sum is None else bin_sum[..., 0],
+                                    sumsq=None if bin_sum is None else bin_sum[..., 1])
+
+    def stack(self, workers=1, chunk_size=None):
+        """Stack RFs in bins. Without bootstrap (``boot_samples`` is None), means and standard errors are calculated
+        from sums of amplitudes. See :func:`seispy.ccp3d.stack_chunks` for details.
+
+        :param workers: Number of processes stacking chunks of bins, defaults to 1
+        :type workers: int, optional
+        :param chunk_size: Number of bins in a chunk, defaults to None
+        :type chunk_size: int, optional
         """
-        if self.cpara.shape == 'circle' or self.cpara.adaptive: 
-            field_lat = 'piercelat'
-            field_lon = 'piercelon'
-        elif self.cpara.shape == 'rect':
-            field_lat = 'projlat'
-            field_lon = 'projlon'
+        field_lat, field_lon, idxs, depth_idx, boot = self._stack_para()
+        if workers > 1 and field_lat == 'piercelat':
+            # workers read the RFdepth file themselves, which is memory-mapped in the columnar format
+            rfdep = self.cpara.depthdat
+        elif workers > 1:
+            # projected pierce points only exist in memory
+            rfdep = {k: {key: self.rfdep[k][key] for key in ('bazi', 'stopindex', 'moveout_correct', field_lat, field_lon)}
+                     for k in np.unique(np.concatenate(idxs) if isinstance(idxs, list) else idxs)}
         else:
-            pass
-        for i, bin_info in enumerate(self.bin_loca):
-            boot_stack = {}
-            bin_mu = np.zeros(self.cpara.stack_range.size)
-            bin_ci = np.zeros([self.cpara.stack_range.size, 2])
-            bin_count = np.zeros(self.cpara.stack_range.size)
-            self.logger.CCPlog.info('{}/{} bin from {:.2f} km at lat: {:.3f} lon: {:.3f}'.format(i + 1, self.bin_loca.shape[0], self.profile_range[i], bin_info[0], bin_info[1]))
-            if self.cpara.shape == 'circle' and not exists(self.cpara.stack_sta_list):
-                idxs = self.idxs[i]
-            else:
-                idxs = self.idxs
-            for j, dep in enumerate(self.cpara.stack_range):
-                idx = int(j * self.stack_mul + self.cpara.stack_range[0]/self.cpara.dep_val)
-                bin_dep_amp = np.array([])
-                for k in idxs:
-                    stop_idx = np.where(self.rfdep[k]['stopindex'] >= idx)[0]
-                    fall_idx = np.where(distaz(self.rfdep[k][field_lat][stop_idx, idx], self.rfdep[k][field_lon][stop_idx, idx],
-                                        bin_info[0], bin_info[1]).delta < self.fzone[j])[0]
-                    bin_dep_amp = np.append(bin_dep_amp, self.rfdep[k]['moveout_correct'][stop_idx[fall_idx], idx])
-                bin_mu[j], bin_ci[j], bin_count[j] = boot_bin_stack(bin_dep_amp, n_samples=self.cpara.boot_samples)
-            boot_stack['bin_lat'] = bin_info[0]
-            boot_stack['bin_lon'] = bin_info[1]
-            boot_stack['profile_dis'] = self.profile_range[i]
-            boot_stack['mu'] = bin_mu
-            boot_stack['ci'] = bin_ci
-            boot_stack['count'] = bin_count
-            self.stack_data.append(boot_stack)   
+            rfdep = self.rfdep
+        self._set_stack_data(*stack_chunks(rfdep, self.bin_loca, idxs, self.fzone, depth_idx, boot=boot,
+                                           field_lat=field_lat, field_lon=field_lon, workers=workers,
+                                           chunk_size=chunk_size, log=self.logger))
 
     def save_stack_data(self, format='npz'):
-        """If format is \'npz\', saving stacked data and parameters to local as a npz file. To load the file, please use data = np.load(fname, allow_pickle=True).
-        data['cpara'] is the parameters when CCP stacking.
-        data['stack_data'] is the result of stacked data.
+        """If format is \'npz\', saving stacked data and parameters to local as a npz file of plain arrays.
+        To load the file, please use :func:`seispy.core.ccpstack.load_stack`.
 
         If format is \'dat\' the stacked data will be save into a txt file with 8 columns, including bin_lat, bin_lon, profile_dis, depth, amp, ci_low, ci_high and count.
         where bin_lat and bin_lon represent the position of each bin; profile_dis represents the distance in km between each bin and the start point of the profile; depth represents depth of each bin; amp means the stacked amplitude; ci_low and ci_high mean confidence interval with bootstrap method; count represents stacking number of each bin.
@@ -281,7 +347,7 @@ class CCPProfile():
             self.logger.CCPlog.error('fname should be in \'str\'')
             raise ValueError('fname should be in \'str\'')
         if format == 'npz':
-            np.savez(self.cpara.stackfile, cpara=self.cpara, stack_data=self.stack_data)
+            save_stack(self.cpara.stackfile, self.stack_data, self.cpara)
         elif format == 'dat':
             with open(self.cpara.stackfile, 'w') as f:
                 for i, bin in enumerate(self.stack_data):
@@ -304,6 +370,101 @@ class CCPProfile():
                             )
 
 
+
+def read_profile_list(fname):
+    """Read profiles from a text file. Each line includes latitude and longitude of the start and end points
+    and the file name of stacked data, i.e., ``lat1 lon1 lat2 lon2 stackfile``. Lines starting with ``#`` are ignored.
+
+    :param fname: Path to the file
+    :type fname: str
+    :return: Lines and file names of profiles
+    :rtype: list
+    """
+    profiles = []
+    with open(fname) as f:
+        for line in f:
+            items = line.split('#')[0].split()
+            if not items:
+                continue
+            if len(items) != 5:
+                raise ValueError('Profiles should be in \'lat1 lon1 lat2 lon2 stackfile\': {}'.format(line.strip()))
+            profiles.append((np.array(items[0:4], dtype=float), items[4]))
+    return profiles
+
+
+_profile_worker = {}
+
+
+def _init_profile_worker(profs, depthdat):
+    rfdep = read_rfdep(depthdat, mmap_mode='r')
+    for prof in profs:
+        prof.rfdep = rfdep
+    _profile_worker['profs'] = profs
+
+
+def _run_profile(i):
+    prof = _profile_worker['profs'][i]
+    prof.initial_bins()
+    prof.stack()
+    return prof.bin_loca, prof.profile_range, prof.stack_data
+
+
+def stack_profiles(ccp, profiles, workers=1, format='npz'):
+    """Stack many profiles through the same RFdepth data in one process. RFdepth data are loaded once.
+    Bins of circle profiles are stacked together with :func:`seispy.ccp3d.stack_chunks`,
+    so pierce points are indexed once for all profiles and chunks of bins are stacked by ``workers`` processes.
+    Rect profiles are stacked by ``workers`` processes in parallel across profiles, because pierce points are
+    projected onto each profile, and each process reads the RFdepth file ``depthdat`` itself.
+    Each profile is saved to the same file as a standalone run.
+
+    :param ccp: A profile with parameters shared by all profiles
+    :type ccp: :class:`CCPProfile`
+    :param profiles: Lines and file names of profiles, see :func:`read_profile_list`
+    :type profiles: list
+    :param workers: Number of processes, defaults to 1
+    :type workers: int, optional
+    :param format: Format of stacked data, see :meth:`CCPProfile.save_stack_data`, defaults to 'npz'
+    :type format: str, optional
+    :return: Stacked profiles
+    :rtype: list
+    """
+    if ccp.cpara.adaptive:
+        raise ValueError('Bins of adaptive profiles are set by stations, which cannot be stacked along multiple lines')
+    if not hasattr(ccp, 'rfdep'):
+        ccp.read_rfdep()
+    profs = [ccp.profile(line, stackfile) for line, stackfile in profiles]
+    if ccp.cpara.shape == 'circle':
+        for prof in profs:
+            prof.initial_bins()
+        field_lat, field_lon, idxs, depth_idx, boot = profs[0]._stack_para()
+        if isinstance(idxs, list):
+            idxs = [idx for prof in profs for idx in prof.idxs]
+        bin_loca = np.concatenate([prof.bin_loca for prof in profs])
+        results = stack_chunks(ccp.rfdep, bin_loca, idxs, profs[0].fzone, depth_idx, boot=boot,
+                               field_lat=field_lat, field_lon=field_lon, workers=workers, log=ccp.logger)
+        bounds = np.cumsum([0] + [prof.bin_loca.shape[0] for prof in profs])
+        for prof, b, e in zip(profs, bounds[:-1], bounds[1:]):
+            prof._set_stack_data(*[None if res is None else res[b:e] for res in results])
+    elif workers > 1 and len(profs) > 1:
+        # workers read the RFdepth file themselves, which is memory-mapped in the columnar format
+        bare = [copy(prof) for prof in profs]
+        for prof in bare:
+            prof.rfdep = None
+        pool = Pool(workers, initializer=_init_profile_worker, initargs=(bare, ccp.cpara.depthdat))
+        try:
+            for prof, (bin_loca, profile_range, stack_data) in zip(profs, pool.imap(_run_profile, range(len(profs)))):
+                prof.bin_loca, prof.profile_range, prof.stack_data = bin_loca, profile_range, stack_data
+        finally:
+            pool.terminate()
+    else:
+        for prof in profs:
+            prof.initial_bins()
+            prof.stack()
+    for i, prof in enumerate(profs):
+        ccp.logger.CCPlog.info('Profile {}/{}'.format(i + 1, len(profs)))
+        prof.save_stack_data(format=format)
+    return profs
+
 if __name__ == '__main__':
     bin_loca, _ = init_profile(27.5, 94, 36.5, 92, 5)
     print(bin_loca.shape)
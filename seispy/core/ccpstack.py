@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+from os.path import join
+
+import numpy as np
+
+from seispy.ccppara import CCPPara
+from seispy.utils import load_npz_mmap
+
+
+FORMAT_NAME = 'seispy-ccpstack'
+FORMAT_VERSION = 1
+BIN_FIELDS = ('mu', 'ci_low', 'ci_high', 'count', 'std_err', 'sum', 'sumsq')
+POS_FIELDS = ('bin_lat', 'bin_lon', 'profile_dis')
+
+
+class StackData(object):
+    """Columnar stacked data of CCP bins.
+
+    Stacked amplitudes, confidence intervals, counts and standard errors are arrays with shape of ``(nbin, ndepth)``,
+    positions of bins are arrays with shape of ``(nbin,)``. Downstream processing can use slices of these arrays,
+    e.g., ``stack_data.mu[:, idx]``. The same access as the list of dicts is also supported:
+
+    >>> stack_data = StackData([30., 31.], [100., 100.], np.zeros((2, 3)))
+    >>> stack_data[1]['ci'].shape
+    (3, 2)
+    >>> [bin_stack['bin_lat'] for bin_stack in stack_data]
+    [30.0, 31.0]
+    """
+    def __init__(self, bin_lat, bin_lon, mu, ci_low=None, ci_high=None, count=None, std_err=None, profile_dis=None,
+                 sum=None, sumsq=None):
+        self.bin_lat = np.asanyarray(bin_lat)
+        self.bin_lon = np.asanyarray(bin_lon)
+        self.mu = np.asanyarray(mu)
+        self.ci_low = np.full(self.mu.shape, np.nan) if ci_low is None else np.asanyarray(ci_low)
+        self.ci_high = np.full(self.mu.shape, np.nan) if ci_high is None else np.asanyarray(ci_high)
+        self.count = np.zeros(self.mu.shape) if count is None else np.asanyarray(count)
+        self.std_err = None if std_err is None else np.asanyarray(std_err)
+        self.profile_dis = None if profile_dis is None else np.asanyarray(profile_dis)
+        # sums of amplitudes and their squares, with which new stations can be added to bins
+        self.sum = None if sum is None else np.asanyarray(sum)
+        self.sumsq = None if sumsq is None else np.asanyarray(sumsq)
+
+    @classmethod
+    def from_list(cls, stack_data):
+        """Convert the list of dicts of stacked data into the columnar format"""
+        if len(stack_data) == 0:
+            return cls(np.array([]), np.array([]), np.zeros((0, 0)))
+        para = {key: np.array([bin_stack[key] for bin_stack in stack_data])
+                for key in ('bin_lat', 'bin_lon', 'mu', 'count', 'std_err', 'profile_dis') if key in stack_data[0]}
+        ci = np.array([bin_stack['ci'] for bin_stack in stack_data])
+        return cls(ci_low=ci[..., 0], ci_high=ci[..., 1], **para)
+
+    @property
+    def ci(self):
+        """Confidence intervals with shape of ``(nbin, ndepth, 2)``"""
+        return np.stack([self.ci_low, self.ci_high], axis=-1)
+
+    @property
+    def fields(self):
+        return {key: self.__dict__[key] for key in BIN_FIELDS + POS_FIELDS if self.__dict__[key] is not None}
+
+    def __len__(self):
+        return self.bin_lat.size
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """Stacked data of the ``i``-th bin as a dict"""
+        bin_stack = {'bin_lat': self.bin_lat[i], 'bin_lon': self.bin_lon[i], 'mu': self.mu[i],
+                     'ci': np.column_stack((self.ci_low[i], self.ci_high[i])), 'count': self.count[i]}
+        if self.profile_dis is not None:
+            bin_stack['profile_dis'] = self.profile_dis[i]
+        if self.std_err is not None:
+            bin_stack['std_err'] = self.std_err[i]
+        return bin_stack
+
+
+def save_stack(fname, stack_data, cpara, **arrays):
+    """Save stacked data into an uncompressed ``.npz`` file of plain arrays, which can be memory-mapped.
+    Parameters are saved as a JSON string.
+
+    :param fname: File name
+    :type fname: str
+    :param stack_data: Stacked data
+    :type stack_data: :class:`StackData` or list
+    :param cpara: Parameters of CCP stacking
+    :type cpara: :class:`seispy.ccppara.CCPPara`
+    :param arrays: Other arrays to save, e.g., the grid of bins
+    """
+    if not isinstance(stack_data, StackData):
+        stack_data = StackData.from_list(stack_data)
+    meta = {'format': FORMAT_NAME, 'version': FORMAT_VERSION}
+    np.savez(fname, format=np.array(json.dumps(meta)), cpara=np.array(json.dumps(cpara.to_dict())),
+             **stack_data.fields, **arrays)
+
+
+def load_stack(fname, mmap=True):
+    """Load stacked data saved by :func:`save_stack` or the list of dicts pickled by previous versions.
+
+    :param fname: File name
+    :type fname: str
+    :param mmap: Memory-map arrays in the file, defaults to True
+    :type mmap: bool, optional
+    :return: Stacked data, parameters of CCP stacking and other arrays in the file
+    :rtype: (:class:`StackData`, :class:`seispy.ccppara.CCPPara`, dict)
+    """
+    with np.load(fname) as data:
+        meta = json.loads(str(data['format'])) if 'format' in data.files else None
+    if meta is None:
+        with np.load(fname, allow_pickle=True) as data:
+            arrays = {key: data[key] for key in data.files if key not in ('stack_data', 'cpara')}
+            return StackData.from_list(data['stack_data']), data['cpara'].any(), arrays
+    if meta.get('format') != FORMAT_NAME:
+        raise ValueError('{} is not a file of CCP stacked data'.format(fname))
+    if meta.get('version', 0) > FORMAT_VERSION:
+        raise ValueError('Unsupported version {} of CCP stacked data'.format(meta['version']))
+    if mmap:
+        arrays = load_npz_mmap(fname)
+    else:
+        with np.load(fname) as data:
+            arrays = {key: data[key] for key in data.files}
+    arrays.pop('format')
+    cpara = CCPPara.from_dict(json.loads(str(arrays.pop('cpara'))))
+    fields = {key: arrays.pop(key) for key in BIN_FIELDS + POS_FIELDS if key in arrays}
+    return StackData(**fields), cpara, arrays
+
+
+class StackStore(object):
+    """Stacked data of bins written on disk by tiles of bins.
+
+    Fields with shape of ``(nbin, ndepth)`` are memory-mapped ``.npy`` files in a directory,
+    so the memory usage only depends on the size of tiles written at once.
+    The store is saved into a file of :func:`save_stack` by streaming the memory-mapped arrays.
+    """
+    def __init__(self, path, bin_lat, bin_lon, ndep, sums=True):
+        """
+        :param path: Directory of the store
+        :type path: str
+        :param bin_lat: Latitudes of all bins
+        :type bin_lat: numpy.ndarray
+        :param bin_lon: Longitudes of all bins
+        :type bin_lon: numpy.ndarray
+        :param ndep: Number of stacking depths
+        :type ndep: int
+        :param sums: Store standard errors and sums of amplitudes of bins, defaults to True
+        :type sums: bool, optional
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.bin_lat = np.asarray(bin_lat, dtype=float)
+        self.bin_lon = np.asarray(bin_lon, dtype=float)
+        shape = (self.bin_lat.size, ndep)
+        self.fields = {}
+        for key in BIN_FIELDS:
+            if key in ('std_err', 'sum', 'sumsq') and not sums:
+                continue
+            self.fields[key] = np.lib.format.open_memmap(join(path, key + '.npy'), mode='w+', dtype=float, shape=shape)
+
+    def write(self, bins, bin_mu, bin_ci, bin_count, bin_se=None, bin_sum=None):
+        """Write stacked data of a tile of bins
+
+        :param bins: Indices of bins in the tile
+        :type bins: numpy.ndarray
+        :param bin_mu: Means with shape of ``(nbin_tile, ndepth)``
+        :type bin_mu: numpy.ndarray
+        :param bin_ci: Confidence intervals with shape of ``(nbin_tile, ndepth, 2)``
+        :type bin_ci: numpy.ndarray
+        :param bin_count: Counts with shape of ``(nbin_tile, ndepth)``
+        :type bin_count: numpy.ndarray
+        :param bin_se: Standard errors with shape of ``(nbin_tile, ndepth)``, defaults to None
+        :type bin_se: numpy.ndarray, optional
+        :param bin_sum: Sums and sums of squares with shape of ``(nbin_tile, ndepth, 2)``, defaults to None
+        :type bin_sum: numpy.ndarray, optional
+        """
+        self.fields['mu'][bins] = bin_mu
+        self.fields['ci_low'][bins] = bin_ci[..., 0]
+        self.fields['ci_high'][bins] = bin_ci[..., 1]
+        self.fields['count'][bins] = bin_count
+        if 'std_err' in self.fields:
+            self.fields['std_err'][bins] = np.nan if bin_se is None else bin_se
+            self.fields['sum'][bins] = np.nan if bin_sum is None else bin_sum[..., 0]
+            self.fields['sumsq'][bins] = np.nan if bin_sum is None else bin_sum[..., 1]
+
+    @property
+    def stack_data(self):
+        return StackData(self.bin_lat, self.bin_lon, **self.fields)
+
+    def save(self, fname, cpara, **arrays):
+        """Save the store into a file with :func:`save_stack`. Arrays are written in blocks by :func:`numpy.savez`."""
+        for value in self.fields.values():
+            value.flush()
+        save_stack(fname, self.stack_data, cpara, **arrays)
+
+    def remove(self):
+        """Remove files of the store"""
+        self.fields = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
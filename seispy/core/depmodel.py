@@ -194,8 +194,18 @@ class DepModel(object):
 
         self.R = 6371.0 - self.depths_elev
 
+    def elev2depth(self, values):
+        """Interpolate values defined at ``depths_elev`` back to ``depths``.
 
-
+        :param values: Array with the last axis along ``depths_elev``
+        :type values: numpy.ndarray
+        :return: Array with the last axis along ``depths``
+        :rtype: numpy.ndarray
+        """
+        if self.elevation == 0:
+            return values
+        return interp1d(self.depths_elev, values, bounds_error=False,
+                        fill_value=(np.nan, values[..., -1]))(self.depths)
 
 
     def plot_model(self, show=True):
@@ -231,7 +241,7 @@ class DepModel(object):
             radius = 6371.
         tps = np.cumsum((np.sqrt((radius / self.vs) ** 2 - rayps ** 2) -
                          np.sqrt((radius / self.vp) ** 2 - raypp ** 2)) *
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
 
     def tpppds(self, rayps, raypp, sphere=True):
@@ -241,7 +251,7 @@ class DepModel(object):
             radius = 6371.
         tps = np.cumsum((np.sqrt((radius / self.vs) ** 2 - rayps ** 2) +
                          np.sqrt((radius / self.vp) ** 2 - raypp ** 2)) *
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
 
     def tpspds(self, rayps, sphere=True):
@@ -250,7 +260,7 @@ class DepModel(object):
         else:
             radius = 6371.
         tps = np.cumsum(2 * np.sqrt((radius / self.vs) ** 2 - rayps ** 2) *
-                        (self.dz / radius))
+                        (self.dz / radius), axis=-1)
         return tps
 
     def radius_s(self, rayp, phase='P', sphere=True):
@@ -282,7 +292,7 @@ class DepModel(object):
             radius = self.R
         else:
             radius = 6371.
-        hor_dis = np.cumsum((self.dz / radius) / np.sqrt((1. / (rayp ** 2. * (radius / vel) ** -2)) - 1))
+        hor_dis = np.cumsum((self.dz / radius) / np.sqrt((1. / (rayp ** 2. * (radius / vel) ** -2)) - 1), axis=-1)
         #hor_dis = np.sqrt((1. / (rayp ** 2. * (radius / vel) ** -2)) - 1)
         return hor_dis
 
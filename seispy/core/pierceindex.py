@@ -0,0 +1,220 @@
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from seispy.distaz import distaz
+
+
+def geo2xyz(lat, lon):
+    """Cartesian coordinates on the unit sphere with geocentric colatitudes,
+    the same as those used in :class:`seispy.distaz.distaz`
+
+    :param lat: Latitude in degree
+    :type lat: numpy.ndarray or float
+    :param lon: Longitude in degree
+    :type lon: numpy.ndarray or float
+    :return: Coordinates with shape of (n, 3)
+    :rtype: numpy.ndarray
+    """
+    rad = 2. * math.pi / 360.0
+    sph = 1.0 / 298.257
+    colat = math.pi / 2.0 - np.arctan((1. - sph) * (1. - sph) * np.tan(np.atleast_1d(lat) * rad))
+    lon = np.atleast_1d(lon) * rad
+    return np.column_stack([np.sin(colat) * np.cos(lon), np.sin(colat) * np.sin(lon), np.cos(colat)])
+
+
+def chord_radius(delta):
+    """Chord length on the unit sphere of a great circle distance in degree,
+    slightly enlarged so that points on the edge are not missed due to rounding errors.
+    """
+    return 2 * np.sin(np.radians(delta) / 2) * (1 + 1e-6) + 1e-9
+
+
+class PierceIndex(object):
+    """Spatial index of pierce points of all events at a depth for searching events falling in bins.
+
+    Pierce points at a depth are indexed with a :class:`scipy.spatial.cKDTree` on the unit sphere.
+    Candidates within the chord-equivalent radius of a bin are checked with :class:`seispy.distaz.distaz`
+    and sorted by stations and events, so the selection and the order of amplitudes are the same as
+    looping over stations and events.
+
+    >>> rfdep = [{'bazi': np.zeros(2), 'stopindex': np.array([1, 0]), 'moveout_correct': np.array([[1., 2.], [3., 4.]]),
+    ...           'piercelat': np.array([[30., 30.], [30., 31.]]), 'piercelon': np.array([[100., 100.], [100., 100.]])}]
+    >>> pierce = PierceIndex(rfdep, [0])
+    >>> pierce.set_depth(1)
+    >>> pierce.query([30.], [100.], 0.5)[0]
+    array([2.])
+    """
+    def __init__(self, rfdep, stations, field_lat='piercelat', field_lon='piercelon'):
+        """
+        :param rfdep: RFdepth data, or a dict of stations indexed by the indices in ``stations``
+        :type rfdep: list or :class:`seispy.core.rfdepth.RFDepthArray` or dict
+        :param stations: Indices of stations to be indexed
+        :type stations: list or numpy.ndarray
+        :param field_lat: Field of latitudes of pierce points, defaults to 'piercelat'
+        :type field_lat: str, optional
+        :param field_lon: Field of longitudes of pierce points, defaults to 'piercelon'
+        :type field_lon: str, optional
+        """
+        self.rfdep = rfdep
+        self.stations = np.asarray(stations, dtype=int).ravel()
+        self.field_lat = field_lat
+        self.field_lon = field_lon
+        counts = [len(rfdep[k]['bazi']) for k in self.stations]
+        self.sta = np.repeat(self.stations, counts)
+        self.stopindex = np.concatenate([np.asarray(rfdep[k]['stopindex']) for k in self.stations]) \
+                         if self.stations.size else np.array([], dtype=int)
+        self.tree = None
+
+    def _column(self, field, idx):
+        if self.stations.size == 0:
+            return np.array([])
+        return np.concatenate([np.asarray(self.rfdep[k][field][:, idx]) for k in self.stations])
+
+    def set_depth(self, idx):
+        """Build the index of pierce points at the ``idx``-th depth of ``depthrange``
+
+        :param idx: Index of the depth
+        :type idx: int
+        """
+        lat = self._column(self.field_lat, idx)
+        lon = self._column(self.field_lon, idx)
+        valid = np.where((self.stopindex >= idx) & np.isfinite(lat) & np.isfinite(lon))[0]
+        self.evt = valid
+        self.lat = lat[valid]
+        self.lon = lon[valid]
+        self.amp = self._column('moveout_correct', idx)[valid]
+        self.tree = cKDTree(geo2xyz(self.lat, self.lon)) if valid.size else None
+
+    def query(self, bin_lat, bin_lon, radius, stations=None):
+        """Amplitudes of events of which pierce points fall within ``radius`` of bins
+
+        :param bin_lat: Latitudes of bins
+        :type bin_lat: numpy.ndarray
+        :param bin_lon: Longitudes of bins
+        :type bin_lon: numpy.ndarray
+        :param radius: Radius of bins in degree
+        :type radius: float
+        :param stations: Indices of stations used for each bin, in the order of stacking.
+            A list of arrays for each bin or an array for all bins. Defaults to None for all stations.
+        :type stations: list or numpy.ndarray, optional
+        :return: Amplitudes for each bin
+        :rtype: list
+        """
+        bin_lat = np.atleast_1d(bin_lat)
+        bin_lon = np.atleast_1d(bin_lon)
+        if self.tree is None:
+            return [np.array([]) for _ in range(bin_lat.size)]
+        cands = self.tree.query_ball_point(geo2xyz(bin_lat, bin_lon), chord_radius(radius))
+        rank = np.full(self.stations.max() + 1 if self.stations.size else 0, -1)
+        amps = []
+        for i, cand in enumerate(cands):
+            cand = np.array(cand, dtype=int)
+            if stations is not None:
+                sta_idx = np.asarray(stations[i] if isinstance(stations, list) else stations, dtype=int)
+                indexed = sta_idx < rank.size
+                rank[:] = -1
+                rank[sta_idx[indexed]] = np.arange(sta_idx.size)[indexed]
+                sta_rank = rank[self.sta[self.evt[cand]]]
+                cand = cand[sta_rank >= 0]
+                cand = cand[np.lexsort((cand, sta_rank[sta_rank >= 0]))]
+            else:
+                cand.sort()
+            if cand.size:
+                cand = cand[distaz(self.lat[cand], self.lon[cand], bin_lat[i], bin_lon[i]).delta < radius]
+            amps.append(self.amp[cand])
+        return amps
+
+
+class BinStack(object):
+    """Sufficient statistics of amplitudes falling in bins, accumulated in one pass over stations.
+
+    Bins are indexed with a :class:`scipy.spatial.cKDTree`, so pierce points of each station are mapped to all bins
+    within the radius at once, and ``sum``, ``sumsq`` and ``count`` with shape of ``(nbin, ndepth)`` are
+    accumulated with :func:`numpy.add.at`. The memory usage does not depend on the number of RFs.
+    Events are selected with the same criterion as :class:`PierceIndex`.
+
+    >>> rfdep = [{'stopindex': np.array([1, 0]), 'moveout_correct': np.array([[1., 2.], [3., 4.]]),
+    ...           'piercelat': np.array([[30., 30.], [30., 31.]]), 'piercelon': np.array([[100., 100.], [100., 100.]])}]
+    >>> stack = BinStack([30.], [100.], [0.5, 0.5], [0, 1])
+    >>> stack.add_station(rfdep[0])
+    >>> stack.count
+    array([[2, 1]])
+    """
+    def __init__(self, bin_lat, bin_lon, radius, depth_idx, field_lat='piercelat', field_lon='piercelon'):
+        """
+        :param bin_lat: Latitudes of bins
+        :type bin_lat: numpy.ndarray
+        :param bin_lon: Longitudes of bins
+        :type bin_lon: numpy.ndarray
+        :param radius: Radius of bins in degree at each stacking depth
+        :type radius: numpy.ndarray
+        :param depth_idx: Indices in ``depthrange`` of stacking depths
+        :type depth_idx: numpy.ndarray
+        :param field_lat: Field of latitudes of pierce points, defaults to 'piercelat'
+        :type field_lat: str, optional
+        :param field_lon: Field of longitudes of pierce points, defaults to 'piercelon'
+        :type field_lon: str, optional
+        """
+        self.bin_lat = np.asarray(bin_lat, dtype=float)
+        self.bin_lon = np.asarray(bin_lon, dtype=float)
+        self.radius = np.asarray(radius, dtype=float)
+        self.depth_idx = np.asarray(depth_idx, dtype=int)
+        self.field_lat = field_lat
+        self.field_lon = field_lon
+        self.tree = cKDTree(geo2xyz(self.bin_lat, self.bin_lon))
+        shape = (self.bin_lat.size, self.depth_idx.size)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.count = np.zeros(shape, dtype=int)
+
+    def add_station(self, rfsta, bins=None):
+        """Accumulate amplitudes of a station
+
+        :param rfsta: RFdepth data of a station
+        :type rfsta: dict
+        :param bins: Indices of bins which the station contributes to, defaults to None for all bins
+        :type bins: numpy.ndarray, optional
+        """
+        lat = np.asarray(rfsta[self.field_lat][:, self.depth_idx])
+        lon = np.asarray(rfsta[self.field_lon][:, self.depth_idx])
+        amp = np.asarray(rfsta['moveout_correct'][:, self.depth_idx], dtype=float)
+        valid = (np.asarray(rfsta['stopindex'])[:, np.newaxis] >= self.depth_idx) & \
+                np.isfinite(lat) & np.isfinite(lon) & ~np.isnan(amp)
+        ev, dep = np.nonzero(valid)
+        if ev.size == 0:
+            return
+        cands = self.tree.query_ball_point(geo2xyz(lat[ev, dep], lon[ev, dep]), chord_radius(self.radius[dep]))
+        point = np.repeat(np.arange(ev.size), [len(cand) for cand in cands])
+        if point.size == 0:
+            return
+        bin_idx = np.concatenate(cands).astype(int)
+        if bins is not None:
+            allowed = np.zeros(self.bin_lat.size, dtype=bool)
+            allowed[bins] = True
+            point, bin_idx = point[allowed[bin_idx]], bin_idx[allowed[bin_idx]]
+        ev, dep = ev[point], dep[point]
+        fall = distaz(lat[ev, dep], lon[ev, dep], self.bin_lat[bin_idx], self.bin_lon[bin_idx]).delta < self.radius[dep]
+        ev, dep, bin_idx = ev[fall], dep[fall], bin_idx[fall]
+        np.add.at(self.sum, (bin_idx, dep), amp[ev, dep])
+        np.add.at(self.sumsq, (bin_idx, dep), amp[ev, dep] ** 2)
+        np.add.at(self.count, (bin_idx, dep), 1)
+
+    @property
+    def mu(self):
+        """Means of bins. Bins with less than 2 amplitudes are NaN as :func:`seispy.ccp3d.boot_bin_stack`"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.sum / self.count, np.nan)
+
+    @property
+    def std_err(self):
+        """Standard errors of means of bins"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (self.sumsq - self.sum ** 2 / self.count) / (self.count - 1)
+            return np.where(self.count > 1, np.sqrt(np.maximum(var, 0) / self.count), np.nan)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
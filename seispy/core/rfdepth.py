@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import shutil
+from os.path import join, isdir, isfile
+
+import numpy as np
+
+
+FORMAT_NAME = 'seispy-rfdepth'
+FORMAT_VERSION = 1
+EVENT_FIELDS = ('bazi', 'rayp', 'stopindex')
+MATRIX_FIELDS = ('moveout_correct', 'piercelat', 'piercelon')
+
+
+def rfdep_dir(path):
+    """Directory of the columnar RFdepth format for ``depthdat`` in configure file"""
+    if path.endswith('.npy'):
+        return path[:-4]
+    return path
+
+
+def is_columnar(path):
+    """Check if the path is an RFdepth in columnar format"""
+    return isdir(path) and isfile(join(path, 'format.json'))
+
+
+def columnar_paths(path):
+    """Existing directories of the columnar format for ``path``"""
+    return [dname for dname in dict.fromkeys((path, rfdep_dir(path))) if is_columnar(dname)]
+
+
+def pickled_paths(path):
+    """Existing files of the pickled ``.npy`` format for ``path``"""
+    return [fname for fname in dict.fromkeys((path, path + '.npy')) if isfile(fname)]
+
+
+def hash_path(path):
+    """File of hashes of inputs of stations written by :func:`seispy.rf2depth_makedata.makedata` for ``path``"""
+    return rfdep_dir(path) + '.hash.json'
+
+
+def _bbox(lat, lon):
+    """Bounding box of pierce points as (min_lat, max_lat, min_lon, max_lon)"""
+    with np.errstate(invalid='ignore'):
+        if lat.size == 0 or np.all(np.isnan(lat)):
+            return np.array([np.nan] * 4)
+        return np.array([np.nanmin(lat), np.nanmax(lat), np.nanmin(lon), np.nanmax(lon)])
+
+
+
+def station_bbox(rfdep):
+    """Bounding boxes of pierce points of all stations as (min_lat, max_lat, min_lon, max_lon).
+    Boxes in the columnar format are read from the station table without loading pierce points.
+
+    :param rfdep: RFdepth data
+    :type rfdep: list or :class:`RFDepthArray`
+    :return: Bounding boxes with shape of ``(nsta, 4)``, NaN for stations without pierce points
+    :rtype: numpy.ndarray
+    """
+    if isinstance(rfdep, RFDepthArray):
+        return rfdep.bbox
+    return np.array([_bbox(np.asarray(sta['piercelat']), np.asarray(sta['piercelon'])) for sta in rfdep]).reshape(-1, 4)
+
+
+def station_events(rfdep):
+    """Names of all stations and numbers of their events.
+    Numbers in the columnar format are read from offsets without loading fields of events.
+
+    :param rfdep: RFdepth data
+    :type rfdep: list or :class:`RFDepthArray`
+    :return: Names and numbers of events of stations
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    if isinstance(rfdep, RFDepthArray):
+        return rfdep.station.astype(str), np.diff(rfdep.offset)
+    return (np.array([str(sta['station']) for sta in rfdep], dtype=str),
+            np.array([len(sta['stopindex']) for sta in rfdep], dtype=int))
+
+
+def station_digests(rfdep, path=None):
+    """Digests of stations for finding stations changed between two RFdepth data.
+    Hashes of inputs recorded in :func:`hash_path` of ``path`` are used if available,
+    otherwise digests of the position and back-azimuths, ray parameters and stop indices of events of the station.
+
+    :param rfdep: RFdepth data
+    :type rfdep: list or :class:`RFDepthArray`
+    :param path: Path to the RFdepth data, defaults to None
+    :type path: str, optional
+    :return: Digests of stations
+    :rtype: numpy.ndarray
+    """
+    recorded = {}
+    if path is not None and isfile(hash_path(path)):
+        with open(hash_path(path)) as f:
+            recorded = json.load(f).get('stations', {})
+    digests = []
+    for k, name in enumerate(station_events(rfdep)[0]):
+        if name in recorded:
+            digests.append('input:' + recorded[name])
+            continue
+        sta = rfdep[k]
+        sha = hashlib.sha1()
+        sha.update(np.array([sta['stalat'], sta['stalon']], dtype=np.float32).tobytes())
+        for key in ('bazi', 'rayp'):
+            sha.update(np.asarray(sta[key], dtype=np.float32).tobytes())
+        sha.update(np.asarray(sta['stopindex'], dtype=np.int64).tobytes())
+        digests.append('data:' + sha.hexdigest())
+    return np.array(digests, dtype=str)
+
+
+class RFDepthArray(object):
+    """Ragged columnar RFdepth data of all stations.
+
+    Fields of all events are concatenated along the first axis and the events of the ``k``-th
+    station are in ``offset[k]:offset[k+1]``. Arrays can be memory-mapped, so that only
+    pierce points and amplitudes actually used are read from disk.
+
+    The same access as the list of dicts saved by :func:`seispy.rf2depth_makedata.makedata` is supported:
+
+    >>> rfdep = RFDepthArray.from_list([{'station': 'XX.A', 'stalat': 30., 'stalon': 100.,
+    ...     'depthrange': np.arange(3.), 'bazi': np.array([10., 20.]), 'rayp': np.array([6., 7.]),
+    ...     'moveout_correct': np.zeros((2, 3)), 'piercelat': np.ones((2, 3)) * 30.,
+    ...     'piercelon': np.ones((2, 3)) * 100., 'stopindex': np.array([2, 2])}])
+    >>> rfdep[0]['piercelat'].shape
+    (2, 3)
+    >>> [sta['station'] for sta in rfdep]
+    ['XX.A']
+    """
+    def __init__(self, station, stalat, stalon, depthrange, offset, fields, bbox=None):
+        self.station = np.asarray(station)
+        self.stalat = np.asarray(stalat)
+        self.stalon = np.asarray(stalon)
+        self.depthrange = np.asarray(depthrange)
+        self.offset = np.asarray(offset)
+        self.fields = fields
+        if bbox is None:
+            bbox = np.array([_bbox(fields['piercelat'][self.offset[k]:self.offset[k+1]],
+                                   fields['piercelon'][self.offset[k]:self.offset[k+1]])
+                             for k in range(self.station.size)]).reshape(-1, 4)
+        self.bbox = bbox
+        self._cache = {}
+
+    @classmethod
+    def from_list(cls, rfdep, dtype='float32', pierce_dtype='float64'):
+        """Convert the list of dicts into the columnar format
+
+        :param rfdep: RFdepth data as a list of dicts
+        :type rfdep: list or numpy.ndarray
+        :param dtype: Data type of amplitudes, defaults to 'float32'
+        :type dtype: str, optional
+        :param pierce_dtype: Data type of pierce points, defaults to 'float64'.
+            Pierce points in float32 change the selection of events close to the edge of bins,
+            because :class:`seispy.distaz.distaz` follows the precision of inputs.
+        :type pierce_dtype: str, optional
+        """
+        offset = np.cumsum([0] + [len(sta['bazi']) for sta in rfdep]).astype(np.int64)
+        ndep = len(rfdep[0]['depthrange']) if len(rfdep) else 0
+        fields = {}
+        for key in EVENT_FIELDS:
+            fields[key] = np.concatenate([np.asarray(sta[key]) for sta in rfdep]) if len(rfdep) else np.array([])
+        fields['stopindex'] = fields['stopindex'].astype(np.int64)
+        for key in MATRIX_FIELDS:
+            this_dtype = dtype if key == 'moveout_correct' else pierce_dtype
+            fields[key] = np.concatenate([np.asarray(sta[key], dtype=this_dtype).reshape(-1, ndep) for sta in rfdep]) \
+                          if len(rfdep) else np.zeros((0, ndep), dtype=this_dtype)
+        return cls([sta['station'] for sta in rfdep],
+                   np.array([sta['stalat'] for sta in rfdep], dtype=float),
+                   np.array([sta['stalon'] for sta in rfdep], dtype=float),
+                   rfdep[0]['depthrange'] if len(rfdep) else np.array([]),
+                   offset, fields)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load RFdepth in columnar format
+
+        :param path: Directory of the RFdepth data
+        :type path: str
+        :param mmap_mode: Memory-map mode passed to :func:`numpy.load`, defaults to 'r'
+        :type mmap_mode: str, optional
+        """
+        with open(join(path, 'format.json')) as f:
+            meta = json.load(f)
+        if meta.get('format') != FORMAT_NAME:
+            raise ValueError('{} is not an RFdepth directory'.format(path))
+        if meta.get('version', 0) > FORMAT_VERSION:
+            raise ValueError('Unsupported version {} of RFdepth format'.format(meta['version']))
+        table = np.load(join(path, 'stations.npy'))
+        fields = {key: np.load(join(path, key + '.npy'), mmap_mode=mmap_mode)
+                  for key in EVENT_FIELDS + MATRIX_FIELDS}
+        bbox = np.column_stack([table['min_lat'], table['max_lat'], table['min_lon'], table['max_lon']])
+        return cls(table['station'], table['stalat'], table['stalon'],
+                   np.load(join(path, 'depthrange.npy')),
+                   np.load(join(path, 'offset.npy')), fields, bbox=bbox)
+
+    def save(self, path):
+        """Save RFdepth in columnar format into a directory of ``.npy`` files
+
+        :param path: Directory of the RFdepth data
+        :type path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        table = np.zeros(self.station.size, dtype=[('station', 'U{}'.format(max(self.station.dtype.itemsize // 4, 1))),
+                                                   ('stalat', 'f8'), ('stalon', 'f8'),
+                                                   ('min_lat', 'f8'), ('max_lat', 'f8'),
+                                                   ('min_lon', 'f8'), ('max_lon', 'f8')])
+        table['station'] = self.station
+        table['stalat'] = self.stalat
+        table['stalon'] = self.stalon
+        for i, key in enumerate(('min_lat', 'max_lat', 'min_lon', 'max_lon')):
+            table[key] = self.bbox[:, i]
+        np.save(join(path, 'stations.npy'), table)
+        np.save(join(path, 'depthrange.npy'), self.depthrange)
+        np.save(join(path, 'offset.npy'), self.offset)
+        for key in EVENT_FIELDS + MATRIX_FIELDS:
+            np.save(join(path, key + '.npy'), self.fields[key])
+        with open(join(path, 'format.json'), 'w') as f:
+            json.dump({'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                       'sta_num': int(self.station.size), 'ev_num': int(self.offset[-1]),
+                       'dtype': str(self.fields['moveout_correct'].dtype)}, f)
+
+    def __len__(self):
+        return self.station.size
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __getitem__(self, k):
+        """Fields of the ``k``-th station as a dict. Arrays are views of the concatenated fields.
+        Fields added to the dict (e.g., projected pierce points) are kept for later access.
+        """
+        k = int(k)
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('station index out of range')
+        if k not in self._cache:
+            b, e = self.offset[k], self.offset[k+1]
+            sta = {'station': str(self.station[k]), 'stalat': self.stalat[k],
+                   'stalon': self.stalon[k], 'depthrange': self.depthrange}
+            for key in EVENT_FIELDS + MATRIX_FIELDS:
+                sta[key] = self.fields[key][b:e]
+            self._cache[k] = sta
+        return self._cache[k]
+
+    def station_index(self, k):
+        """Indices of events of the ``k``-th station in the concatenated fields"""
+        return np.arange(self.offset[k], self.offset[k+1])
+
+
+def save_rfdep(path, rfdep, rfdep_format='npy', dtype='float32'):
+    """Save RFdepth data
+
+    :param path: Path to the output. For the columnar format, the suffix of ``.npy`` is removed
+        and a directory is created.
+    :type path: str
+    :param rfdep: RFdepth data as a list of dicts
+    :type rfdep: list
+    :param rfdep_format: ``'npy'`` for a pickled list of dicts, ``'columnar'`` for :class:`RFDepthArray`,
+        defaults to 'npy'
+    :type rfdep_format: str, optional
+    :param dtype: Data type of amplitudes in columnar format, defaults to 'float32'
+    :type dtype: str, optional
+
+    RFdepth data of the other format at ``path`` are removed after saving, so that stale data are never read.
+    """
+    if rfdep_format == 'columnar':
+        RFDepthArray.from_list(rfdep, dtype=dtype).save(rfdep_dir(path))
+        for fname in pickled_paths(path):
+            os.remove(fname)
+    elif rfdep_format == 'npy':
+        np.save(path, rfdep)
+        for dname in columnar_paths(path):
+            shutil.rmtree(dname)
+    else:
+        raise ValueError('rfdep_format must be in \'npy\' or \'columnar\'')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
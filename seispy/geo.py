@@ -1,3 +1,4 @@
+from functools import lru_cache
 import numpy as np
 from seispy import distaz
 from pyproj import Geod
@@ -143,6 +144,17 @@ def snr(x, y):
     return 10 * np.log10(spow / npow)
 
 
+@lru_cache(maxsize=None)
+def get_geod(ellps="WGS84"):
+    """Get a cached :class:`pyproj.Geod` of the ellipsoid
+
+    :param ellps: Ellipsoids supported by ``pyproj``, defaults to "WGS84"
+    :type ellps: str, optional
+    :rtype: :class:`pyproj.Geod`
+    """
+    return Geod(ellps=ellps)
+
+
 def latlon_from(lat0, lon0, azimuth, gcarc_dist, ellps="WGS84"):
     """
     Determine position with given position of initial point, azimuth and distance
@@ -217,17 +229,42 @@ def latlon_from(lat0, lon0, azimuth, gcarc_dist, ellps="WGS84"):
         gcarc_dist = np.ones(lat0, lon0, npts)*gcarc_dist
         lat0, lon0 = init_lalo(lat0, lon0, npts)
 
-    g = Geod(ellps=ellps)
+    g = get_geod(ellps)
     lon, lat, _ = g.fwd(lon0, lat0, azimuth, deg2km(gcarc_dist)*1000)
     return lat, lon
 
 
 def geoproject(lat_p, lon_p, lat1, lon1, lat2, lon2):
+    """Project points onto the great circle through two points.
+    Points in arrays of any shape are projected in one call.
+
+    :param lat_p: Latitudes of points
+    :type lat_p: float or numpy.ndarray
+    :param lon_p: Longitudes of points
+    :type lon_p: float or numpy.ndarray
+    :param lat1: Latitude of the start point
+    :type lat1: float
+    :param lon1: Longitude of the start point
+    :type lon1: float
+    :param lat2: Latitude of the end point
+    :type lat2: float
+    :param lon2: Longitude of the end point
+    :type lon2: float
+    :return: Latitudes and longitudes of projected points in the same shape as ``lat_p``
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    if scalar_instance(lat_p) and scalar_instance(lon_p):
+        shape = None
+    else:
+        lat_p, lon_p = np.asarray(lat_p, dtype=float), np.asarray(lon_p, dtype=float)
+        shape = lat_p.shape
+        lat_p, lon_p = lat_p.ravel(), lon_p.ravel()
     azi = distaz(lat1, lon1, lat2, lon2).baz
-    dis_center = distaz(lat1, lon1, lat_p, lon_p).delta
-    azi_center = distaz(lat1, lon1, lat_p, lon_p).baz
-    dis_along = atand(tand(dis_center))*cosd(azi-azi_center)
+    daz = distaz(lat1, lon1, lat_p, lon_p)
+    dis_along = atand(tand(daz.delta))*cosd(azi-daz.baz)
     lat, lon = latlon_from(lat1, lon1, azi, dis_along)
+    if shape is not None:
+        lat, lon = np.reshape(lat, shape), np.reshape(lon, shape)
     return lat, lon
 
 
@@ -1,12 +1,16 @@
 import numpy as np
+import os
 import re
 from obspy.io.sac.sactrace import SACTrace
-import matplotlib.pyplot as plt
+from scipy.ndimage import label
 from os.path import join
 from seispy.rfcorrect import RFStation
-from seispy.hkpara import hkpara
+from seispy.hkpara import hkpara, HKPara
 from seispy.geo import srad2skm
+from seispy.bootstrap import Bootstrap
+from seispy.setuplog import setuplog
 import argparse
+from multiprocessing import Pool
 from seispy.utils import load_cyan_map, array_instance
 
 
@@ -44,7 +48,14 @@ def time2idx(times, ti0, dt):
     return ti.reshape(ti.size).astype(int)
 
 
-def hkstack(seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1)):
+def _hk_means(seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1), chunk_size=2**18, resample=None):
+    """Means and variances of amplitudes of three phases and of the weighted stack, see :func:`hkstack`.
+    With counts of events in bootstrap samples ``resample`` with shape of ``(n_samples, nrf)``,
+    weighted stacks of all samples with shape of ``(n_samples, nk, nh)`` are also returned.
+    """
+    h = np.asarray(h, dtype=float)
+    kappa = np.asarray(kappa, dtype=float)
+    p = np.asarray(p, dtype=float)
     # get dimensions
     nh = len(h)
     nk = len(kappa)
@@ -66,41 +77,95 @@ def hkstack(seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1)):
     ti0 = round(t0 / dt)
 
     # initialize stacks
-    tstack = np.zeros((nk, nh, 3))
     stack = np.zeros((nk, nh, 3))
     stack2 = np.zeros((nk, nh, 3))
-
-    allstack = np.zeros((nk, nh, nrf))
-
-    for i in range(nrf):
-        eta_p = vslow(vp, p[i])
-        eta_s = vslow(vs, p[i])
-
-        # get times of Ps for all combinations of vs and H
-        t1 = time2idx(tps(h, eta_p, eta_s), ti0, dt)
-        t2 = time2idx(tppps(h, eta_p, eta_s), ti0, dt)
-        t3 = time2idx(tpsps(h, eta_s), ti0, dt)
-
-        tstack[:, :, 0] = am_cor[i] * seis[i, t1].reshape(nk, nh)
-        tstack[:, :, 1] = am_cor[i] * seis[i, t2].reshape(nk, nh)
-        tstack[:, :, 2] = -am_cor[i] * seis[i, t3].reshape(nk, nh)
-
-        stack += tstack
-        stack2 += tstack ** 2
-
-        allstack[:, :, i] = weight[0] * tstack[:, :, 0] + weight[1] * tstack[:, :, 1] + weight[2] * tstack[:, :, 2]
+    allmean = np.zeros((nk, nh))
+    allm2 = np.zeros((nk, nh))
+
+    nt = seis.shape[1]
+    hmax = np.argmax(h)
+    step = max(1, chunk_size // (nk * nh))
+    times = np.empty((min(step, nrf), nk, nh))
+    boot = None if resample is None else np.zeros((resample.shape[0], nk, nh))
+    for b in range(0, nrf, step):
+        rayp = p[b:b+step]
+        ne = rayp.size
+        eta_p = vslow(vp, rayp)[:, np.newaxis, np.newaxis]
+        eta_s = vslow(vs, rayp[:, np.newaxis])[:, :, np.newaxis]
+        # amplitudes corrected for Ps in rows of the chunk, flattened for gathering
+        seis_cor = np.asarray(seis[b:b+step], dtype=float) * am_cor[b:b+step, np.newaxis]
+        offset = (np.arange(ne) * nt + ti0)[:, np.newaxis, np.newaxis]
+
+        # get indices of Ps, PpPs and PsPs+PpSs for all combinations of vs, H and events in the chunk
+        tall = np.zeros((ne, nk, nh))
+        for n, slow in enumerate((eta_s - eta_p, eta_s + eta_p, 2 * eta_s)):
+            if time2idx(slow[:, :, 0] * h[hmax], ti0, dt).max() >= nt:
+                raise IndexError('Arrivals exceed the end of RFs, please reduce the maximum H')
+            idx = times[:ne]
+            np.multiply(slow, h, out=idx)
+            np.divide(idx, dt, out=idx)
+            np.around(idx, out=idx)
+            idx = idx.astype(int)
+            idx += offset
+            tstack = np.take(seis_cor.ravel() if n < 2 else -seis_cor.ravel(), idx)
+            stack[:, :, n] += tstack.sum(axis=0)
+            stack2[:, :, n] += np.einsum('ijk,ijk->jk', tstack, tstack)
+            tall += weight[n] * tstack
+
+        if resample is not None:
+            boot += (resample[:, b:b+step] @ tall.reshape(ne, -1)).reshape(-1, nk, nh)
+
+        # merge means and sums of squared deviations of the chunk (Chan et al., 1979)
+        tmean = tall.mean(axis=0)
+        tall -= tmean
+        delta = tmean - allmean
+        allmean += delta * ne / (b + ne)
+        allm2 += np.einsum('ijk,ijk->jk', tall, tall) + delta ** 2 * b * ne / (b + ne)
 
     stack = stack / nrf
     stackvar = (stack2 - stack ** 2) / (nrf ** 2)
-
-    allstackvar = np.var(allstack, axis=2)
-    allstack = np.mean(allstack, axis=2)
-    Normed_stack = allstack - np.min(allstack)
+    if boot is not None:
+        boot /= nrf
+    return stack, stackvar, allmean, allm2 / nrf, boot
+
+
+def hkstack(seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1), chunk_size=2**18):
+    """H-k stacking of receiver functions.
+    Indices of Ps, PpPs and PsPs+PpSs for all combinations of H and kappa are calculated for a chunk of events
+    at once with broadcasting, and amplitudes of each phase are gathered with one fancy index.
+    Means and variances are accumulated over chunks, so the memory usage does not depend on the number of RFs.
+
+    :param seis: RFs with shape of ``(nrf, nt)`` or ``(nt, nrf)``
+    :type seis: numpy.ndarray
+    :param t0: Time shift before P
+    :type t0: float
+    :param dt: Sampling interval
+    :type dt: float
+    :param p: Ray parameters in s/km
+    :type p: numpy.ndarray
+    :param h: Moho depths
+    :type h: numpy.ndarray
+    :param kappa: Vp/Vs ratios
+    :type kappa: numpy.ndarray
+    :param vp: Average P-wave velocity of the crust, defaults to 6.3
+    :type vp: float, optional
+    :param weight: Weights of the three phases, defaults to (0.7, 0.2, 0.1)
+    :type weight: tuple, optional
+    :param chunk_size: Maximum number of amplitudes of a phase gathered at once, defaults to 2**18
+    :type chunk_size: int, optional
+    :return: Means of three phases with shape of ``(nk, nh, 3)``, their variances, normalized weighted stack and
+        variances of weighted stack over events with shape of ``(nk, nh)``
+    :rtype: tuple
+    """
+    stack, stackvar, allmean, allstackvar, _ = _hk_means(seis, t0, dt, p, h, kappa, vp=vp, weight=weight,
+                                                         chunk_size=chunk_size)
+    Normed_stack = allmean - np.min(allmean)
     Normed_stack = Normed_stack / np.max(Normed_stack)
     return stack, stackvar, Normed_stack, allstackvar
 
 
 def plot(stack, allstack, h, kappa, besth, bestk, cvalue, cmap=load_cyan_map(), title=None, path=None):
+    import matplotlib.pyplot as plt
     f, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(10, 8), sharex='col', sharey='row')
     xlim = (h[0], h[-1])
     ylim = (kappa[0], kappa[-1])
@@ -130,6 +195,7 @@ def plot(stack, allstack, h, kappa, besth, bestk, cvalue, cmap=load_cyan_map(),
         plt.show()
     else:
         f.savefig(path, format='png', dpi=400, bbox_inches='tight')
+        plt.close(f)
 
 
 def ci(allstack, h, kappa, ev_num):
@@ -147,14 +213,249 @@ def ci(allstack, h, kappa, ev_num):
     besth = h[j]
 
     cvalue = 1 - np.std(allstack.reshape(allstack.size)) / np.sqrt(ev_num)
-    cs = plt.contour(h, kappa, allstack, [cvalue])
-    cs_path = cs.collections[0].get_paths()[0].vertices
-    maxhsig = (np.max(cs_path[:, 0]) - np.min(cs_path[:, 0])) / 2
-    maxksig = (np.max(cs_path[:, 1]) - np.min(cs_path[:, 1])) / 2
-    plt.close()
+    maxhsig, maxksig = contour_sigma(allstack, h, kappa, cvalue)
     return besth, bestk, cvalue, maxhsig, maxksig
 
 
+def _crossings(allstack, region, x, cvalue):
+    """Lowest and highest ``x`` where ``allstack`` crosses ``cvalue`` on edges of ``region`` along the last axis,
+    interpolated linearly between grid points"""
+    dx = np.diff(x)
+    # entering the region from the outside, and leaving it
+    r, c = np.nonzero(~region[:, :-1] & region[:, 1:])
+    low = x[c] + (cvalue - allstack[r, c]) / (allstack[r, c + 1] - allstack[r, c]) * dx[c]
+    r, c = np.nonzero(region[:, :-1] & ~region[:, 1:])
+    high = x[c] + (allstack[r, c] - cvalue) / (allstack[r, c] - allstack[r, c + 1]) * dx[c]
+    # the region is open at edges of the grid
+    low = np.append(low, x[0]) if region[:, 0].any() else low
+    high = np.append(high, x[-1]) if region[:, -1].any() else high
+    return np.min(low), np.max(high)
+
+
+def contour_sigma(allstack, h, kappa, cvalue):
+    """Half extents in H and kappa of the super-level set of ``allstack`` at ``cvalue`` around the maximum.
+    The set is labelled with :func:`scipy.ndimage.label` on the grid, and its extents are interpolated
+    linearly between grid points like the contour at ``cvalue``.
+
+    :param allstack: Normalized weighted stack with shape of ``(nk, nh)``
+    :type allstack: numpy.ndarray
+    :param h: Moho depths
+    :type h: numpy.ndarray
+    :param kappa: Vp/Vs ratios
+    :type kappa: numpy.ndarray
+    :param cvalue: Level of the super-level set
+    :type cvalue: float
+    :return: Half extents in H and kappa
+    :rtype: (float, float)
+    """
+    # diagonal neighbors are connected like the contour around them
+    labels, _ = label(allstack >= cvalue, structure=np.ones((3, 3)))
+    region = labels == labels[np.unravel_index(np.argmax(allstack), allstack.shape)]
+    hmin, hmax = _crossings(allstack, region, np.asarray(h, dtype=float), cvalue)
+    kmin, kmax = _crossings(allstack.T, region.T, np.asarray(kappa, dtype=float), cvalue)
+    return (hmax - hmin) / 2, (kmax - kmin) / 2
+
+
+def hk_bootstrap(seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1), n_samples=200, seed=None,
+                 chunk_size=2**18):
+    """Bootstrap H and kappa by resampling events with replacement.
+    Weighted stacks of all bootstrap samples are accumulated in one pass over events,
+    as products of counts of events in samples and stacks of events,
+    so events are not stacked again for each sample. Standard deviations of the results are errors of H and kappa.
+
+    :param n_samples: Number of bootstrap samples, defaults to 200
+    :type n_samples: int, optional
+    :param seed: Seed of resampling, see :class:`seispy.bootstrap.Bootstrap`, defaults to None
+    :type seed: int, optional
+    :return: Best H and kappa of bootstrap samples
+    :rtype: (numpy.ndarray, numpy.ndarray)
+
+    Other parameters are the same as :func:`hkstack`.
+    """
+    resample = _resample_counts(n_samples, len(p), seed)
+    boot = _hk_means(seis, t0, dt, p, h, kappa, vp=vp, weight=weight, chunk_size=chunk_size, resample=resample)[-1]
+    return _boot_best(boot, h, kappa)[1:]
+
+
+def _resample_counts(n_samples, nrf, seed):
+    """Counts of events in bootstrap samples with shape of ``(n_samples, nrf)``"""
+    idx = Bootstrap(n_samples, seed=seed).indices(nrf)
+    resample = np.zeros((n_samples, nrf))
+    np.add.at(resample, (np.arange(n_samples)[:, np.newaxis], idx), 1)
+    return resample
+
+
+def _boot_best(boot, h, kappa):
+    """Maximum values of stacks of bootstrap samples and the H and kappa of them"""
+    flat = boot.reshape(boot.shape[0], -1)
+    idx = flat.argmax(axis=1)
+    i, j = np.unravel_index(idx, boot.shape[1:])
+    return flat[np.arange(flat.shape[0]), idx], np.asarray(h)[j], np.asarray(kappa)[i]
+
+
+def _lattice(start, stop, step, n):
+    """Indices from ``start`` to ``stop`` with ``step`` within ``[0, n)``, including both ends"""
+    start, stop = max(start, 0), min(stop, n - 1)
+    return np.union1d(np.arange(start, stop + 1, step), [stop])
+
+
+class AdaptiveHK(object):
+    """Coarse-to-fine H-k stacking on subsets of a dense grid of ``h`` and ``kappa``.
+
+    The weighted stack is calculated on a coarse grid with every ``2**levels``-th H and kappa.
+    Around the ``top`` highest points separated by the current spacing, the grid is refined by halves
+    until the spacing of the dense grid. The super-level set at ``cvalue`` around the maximum is then
+    stacked on the dense grid for uncertainties. Points stacked outside this window but within the
+    super-level set are refined on the dense grid as well, and the maximum is moved if a higher value is
+    found, which may happen with noisy data. Stacked values at a point are the same as :func:`hkstack`
+    on the dense grid, so the maximum is found at the dense resolution unless it is missed by all
+    refined neighborhoods, e.g. a spike narrower than the coarse spacing, for which a smaller ``levels``
+    is safer. ``cvalue`` is estimated from the coarse grid.
+    ``nevals`` counts points of the grid stacked, compared with ``h.size * kappa.size`` of the dense grid.
+    Errors can also be bootstrapped with :meth:`bootstrap` on the subsets stacked by :meth:`search`.
+    """
+    def __init__(self, seis, t0, dt, p, h, kappa, vp=6.3, weight=(0.7, 0.2, 0.1), chunk_size=2**18):
+        """
+        :param seis: RFs with shape of ``(nrf, nt)`` or ``(nt, nrf)``
+        :type seis: numpy.ndarray
+        :param t0: Time shift before P
+        :type t0: float
+        :param dt: Sampling interval
+        :type dt: float
+        :param p: Ray parameters in s/km
+        :type p: numpy.ndarray
+        :param h: Moho depths of the dense grid
+        :type h: numpy.ndarray
+        :param kappa: Vp/Vs ratios of the dense grid
+        :type kappa: numpy.ndarray
+        :param vp: Average P-wave velocity of the crust, defaults to 6.3
+        :type vp: float, optional
+        :param weight: Weights of the three phases, defaults to (0.7, 0.2, 0.1)
+        :type weight: tuple, optional
+        :param chunk_size: Maximum number of amplitudes of a phase gathered at once, defaults to 2**18
+        :type chunk_size: int, optional
+        """
+        self.seis = seis
+        self.t0 = t0
+        self.dt = dt
+        self.p = np.asarray(p, dtype=float)
+        self.h = np.asarray(h, dtype=float)
+        self.kappa = np.asarray(kappa, dtype=float)
+        self.kwargs = dict(vp=vp, weight=weight, chunk_size=chunk_size)
+        self.values = np.full((self.kappa.size, self.h.size), np.nan)
+        self.done = np.zeros(self.values.shape, dtype=bool)
+        self.nevals = 0
+
+    def evaluate(self, ki, hi):
+        """Stack on the grid of ``kappa[ki]`` and ``h[hi]``, skipping rows and columns already stacked"""
+        todo = ~self.done[np.ix_(ki, hi)]
+        ki, hi = ki[todo.any(axis=1)], hi[todo.any(axis=0)]
+        if ki.size == 0:
+            return None
+        stack, _, allmean, _, _ = _hk_means(self.seis, self.t0, self.dt, self.p, self.h[hi], self.kappa[ki],
+                                            **self.kwargs)
+        self.values[np.ix_(ki, hi)] = allmean
+        self.done[np.ix_(ki, hi)] = True
+        self.nevals += allmean.size
+        return stack
+
+    def centers(self, top, radius):
+        """Up to ``top`` highest stacked points, which are more than ``radius`` grid points away from each other"""
+        ki, hi = np.nonzero(self.done)
+        order = np.argsort(-self.values[ki, hi], kind='stable')
+        centers = []
+        for i, j in zip(ki[order], hi[order]):
+            if all(max(abs(i - ci), abs(j - cj)) > radius for ci, cj in centers):
+                centers.append((i, j))
+                if len(centers) == top:
+                    break
+        return centers
+
+    def search(self, levels=2, top=5):
+        """Search the maximum from the coarse grid to the dense grid and estimate uncertainties
+
+        :param levels: Number of refinements, the coarse grid takes every ``2**levels``-th H and kappa, defaults to 2
+        :type levels: int, optional
+        :param top: Number of neighborhoods refined at each level, defaults to 5
+        :type top: int, optional
+        """
+        nk, nh = self.values.shape
+        step = 2 ** levels
+        self.coarse_k, self.coarse_h = _lattice(0, nk - 1, step, nk), _lattice(0, nh - 1, step, nh)
+        self.stack = self.evaluate(self.coarse_k, self.coarse_h)
+        allmean = self.values[np.ix_(self.coarse_k, self.coarse_h)]
+        while step > 1:
+            centers = self.centers(top, step)
+            step //= 2
+            for i, j in centers:
+                self.evaluate(_lattice(i - 2 * step, i + 2 * step, step, nk), _lattice(j - 2 * step, j + 2 * step, step, nh))
+        vmin = np.nanmin(self.values)
+        step = 2 ** levels
+        i, j = np.unravel_index(np.nanargmax(self.values), self.values.shape)
+        while True:
+            vmax = self.values[i, j]
+            self.allstack = (allmean - vmin) / (vmax - vmin)
+            self.cvalue = 1 - np.std(self.allstack) / np.sqrt(self.p.size)
+            k0, k1, h0, h1 = self._grow_window(i, j, step, vmin, vmax)
+            # with noisy data the refinement may settle on a local maximum, so points stacked outside the window
+            # within the super-level set are refined on the dense grid as well
+            outside = self.done & ((self.values - vmin) / (vmax - vmin) >= self.cvalue)
+            outside[k0:k1 + 1, h0:h1 + 1] = False
+            for ci, cj in zip(*np.nonzero(outside)):
+                ki, hi = np.arange(max(ci - step, 0), min(ci + step, nk - 1) + 1), \
+                    np.arange(max(cj - step, 0), min(cj + step, nh - 1) + 1)
+                if not self.done[np.ix_(ki, hi)].all():
+                    self.evaluate(ki, hi)
+            # the dense window or the refined points may hold a higher value than the refined maximum
+            i, j = np.unravel_index(np.nanargmax(self.values), self.values.shape)
+            if self.values[i, j] <= vmax:
+                break
+        self.bestk, self.besth = self.kappa[i], self.h[j]
+        self.window = (k0, k1, h0, h1)
+        window = (self.values[k0:k1 + 1, h0:h1 + 1] - vmin) / (vmax - vmin)
+        self.maxhsig, self.maxksig = contour_sigma(window, self.h[h0:h1 + 1], self.kappa[k0:k1 + 1], self.cvalue)
+
+    def _grow_window(self, i, j, step, vmin, vmax):
+        """Stack the super-level set around ``(i, j)`` on the dense grid, growing the window until it is inside"""
+        nk, nh = self.values.shape
+        k0, k1, h0, h1 = max(i - step, 0), min(i + step, nk - 1), max(j - step, 0), min(j + step, nh - 1)
+        while True:
+            self.evaluate(np.arange(k0, k1 + 1), np.arange(h0, h1 + 1))
+            mask = (self.values[k0:k1 + 1, h0:h1 + 1] - vmin) / (vmax - vmin) >= self.cvalue
+            bounds = (max(k0 - (k1 - k0) * mask[0].any(), 0), min(k1 + (k1 - k0) * mask[-1].any(), nk - 1),
+                      max(h0 - (h1 - h0) * mask[:, 0].any(), 0), min(h1 + (h1 - h0) * mask[:, -1].any(), nh - 1))
+            if bounds == (k0, k1, h0, h1):
+                return bounds
+            k0, k1, h0, h1 = bounds
+
+    def bootstrap(self, n_samples=200, seed=None):
+        """Bootstrap H and kappa after :meth:`search`, see :func:`hk_bootstrap`.
+        Samples are stacked on the coarse grid and on the window of the dense grid around the maximum,
+        the best H and kappa of a sample are at the higher maximum of the two. Points stacked are added to ``nevals``.
+
+        :param n_samples: Number of bootstrap samples, defaults to 200
+        :type n_samples: int, optional
+        :param seed: Seed of resampling, see :class:`seispy.bootstrap.Bootstrap`, defaults to None
+        :type seed: int, optional
+        :return: Best H and kappa of bootstrap samples
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        resample = _resample_counts(n_samples, self.p.size, seed)
+        k0, k1, h0, h1 = self.window
+        best = None
+        for ki, hi in ((self.coarse_k, self.coarse_h), (np.arange(k0, k1 + 1), np.arange(h0, h1 + 1))):
+            boot = _hk_means(self.seis, self.t0, self.dt, self.p, self.h[hi], self.kappa[ki], resample=resample,
+                             **self.kwargs)[-1]
+            self.nevals += ki.size * hi.size
+            result = _boot_best(boot, self.h[hi], self.kappa[ki])
+            if best is None:
+                best = result
+            else:
+                higher = result[0] > best[0]
+                best = [np.where(higher, value, last) for value, last in zip(result, best)]
+        return best[1], best[2]
+
+
 def print_result(besth, bestk, maxhsig, maxksig, print_comment=True):
     header = 'H\tH_error\tk\tk_error\n'
     if print_comment:
@@ -164,23 +465,160 @@ def print_result(besth, bestk, maxhsig, maxksig, print_comment=True):
     print(msg)
 
 
+def _hk_station(stadata, hpara):
+    """H-k stacking of a station with parameters in ``hpara``, see :func:`hksta`"""
+    hrange, krange = hpara.hrange, hpara.krange
+    rayp = srad2skm(stadata.rayp)
+    nevals = None
+    if hpara.adaptive:
+        hk = AdaptiveHK(stadata.datar, stadata.shift, stadata.sampling, rayp, hrange, krange, vp=hpara.vp,
+                        weight=hpara.weight)
+        hk.search()
+        stack, allstack, hrange, krange = hk.stack, hk.allstack, hrange[hk.coarse_h], krange[hk.coarse_k]
+        besth, bestk, cvalue, maxhsig, maxksig = hk.besth, hk.bestk, hk.cvalue, hk.maxhsig, hk.maxksig
+        if hpara.boot_samples is not None:
+            boot_h, boot_k = hk.bootstrap(n_samples=hpara.boot_samples, seed=hpara.boot_seed)
+            maxhsig, maxksig = np.std(boot_h), np.std(boot_k)
+        nevals = hk.nevals
+    else:
+        stack, _, allstack, _ = hkstack(stadata.datar, stadata.shift, stadata.sampling, rayp,
+                                        hrange, krange, vp=hpara.vp, weight=hpara.weight)
+        besth, bestk, cvalue, maxhsig, maxksig = ci(allstack, hrange, krange, stadata.ev_num)
+        if hpara.boot_samples is not None:
+            boot_h, boot_k = hk_bootstrap(stadata.datar, stadata.shift, stadata.sampling, rayp,
+                                          hrange, krange, vp=hpara.vp, weight=hpara.weight,
+                                          n_samples=hpara.boot_samples, seed=hpara.boot_seed)
+            maxhsig, maxksig = np.std(boot_h), np.std(boot_k)
+    return {'stack': stack, 'allstack': allstack, 'h': hrange, 'kappa': krange, 'besth': besth, 'bestk': bestk,
+            'cvalue': cvalue, 'maxhsig': maxhsig, 'maxksig': maxksig, 'nevals': nevals}
+
+
+def _hk_line(staname, stla, stlo, result):
+    return '{}\t{:.3f}\t{:.3f}\t{:.1f}\t{:.2f}\t{:.2f}\t{:.3f}\n'.format(
+        staname, stla, stlo, result['besth'], result['maxhsig'], result['bestk'], result['maxksig'])
+
+
+def _hk_title(staname, result):
+    return '{}\nMoho depth = ${:.1f}\\pm{:.2f}$ km\n$V_P/V_S$ = ${:.2f}\\pm{:.3f}$'.format(
+        staname, result['besth'], result['maxhsig'], result['bestk'], result['maxksig'])
+
+
+def _plot_result(result, title, path=None):
+    plot(result['stack'], result['allstack'], result['h'], result['kappa'], result['besth'], result['bestk'],
+         result['cvalue'], title=title, path=path)
+
+
 def hksta(hpara, isplot=False, isdisplay=False):
     stadata = RFStation(hpara.rfpath, only_r=True)
-    stack, _, allstack, _ = hkstack(stadata.datar, stadata.shift, stadata.sampling, srad2skm(stadata.rayp),
-                                    hpara.hrange, hpara.krange, vp=hpara.vp, weight=hpara.weight)
-    besth, bestk, cvalue, maxhsig, maxksig = ci(allstack, hpara.hrange, hpara.krange, stadata.ev_num)
+    result = _hk_station(stadata, hpara)
+    if isdisplay and result['nevals'] is not None:
+        # bootstrap samples on the dense grid would be stacked in another pass
+        ndense = hpara.hrange.size * hpara.krange.size * (1 if hpara.boot_samples is None else 2)
+        print('Stacked {} of {} grid points, {:.1%} saved'.format(result['nevals'], ndense,
+                                                                   1 - result['nevals'] / ndense))
     with open(hpara.hklist, 'a') as f:
-        f.write('{}\t{:.3f}\t{:.3f}\t{:.1f}\t{:.2f}\t{:.2f}\t{:.3f}\n'.format(stadata.staname, stadata.stla, stadata.stlo,
-                                                                              besth, maxhsig, bestk, maxksig))
-    title = '{}\nMoho depth = ${:.1f}\pm{:.2f}$ km\n$V_P/V_S$ = ${:.2f}\pm{:.3f}$'.format(stadata.staname, besth,
-                                                                                     maxhsig, bestk, maxksig)
+        f.write(_hk_line(stadata.staname, stadata.stla, stadata.stlo, result))
     if isdisplay:
-        print_result(besth, bestk, maxhsig, maxksig, print_comment=True)
+        print_result(result['besth'], result['bestk'], result['maxhsig'], result['maxksig'], print_comment=True)
     if isplot:
         img_path = join(hpara.hkpath, stadata.staname+'_Hk.png')
-        plot(stack, allstack, hpara.hrange, hpara.krange, besth, bestk, cvalue, title=title, path=img_path)
+        _plot_result(result, _hk_title(stadata.staname, result), path=img_path)
+    else:
+        _plot_result(result, _hk_title(stadata.staname, result))
+
+
+_worker = {}
+
+
+def _init_batch_worker(hpara, rfroot, stack_path):
+    _worker['hpara'] = hpara
+    _worker['rfroot'] = rfroot
+    _worker['stack_path'] = stack_path
+
+
+def _run_batch_worker(staname):
+    """H-k stacking of a station in the batch. Errors are returned instead of raised to keep other stations running"""
+    try:
+        stadata = RFStation(join(_worker['rfroot'], staname), only_r=True)
+        result = _hk_station(stadata, _worker['hpara'])
+        if _worker['stack_path'] is not None:
+            np.savez(join(_worker['stack_path'], staname + '_Hk.npz'), title=_hk_title(staname, result),
+                     **{key: value for key, value in result.items() if value is not None})
+    except Exception as e:
+        return staname, None, '{}'.format(e)
+    return staname, _hk_line(staname, stadata.stla, stadata.stlo, result), stadata.ev_num
+
+
+def hk_stations(stations, rfroot, hpara, out, workers=1, stack_path=None, log=None):
+    """H-k stacking of stations with a pool of ``workers`` processes.
+    Results of all stations are written into ``out`` at once, in the order of ``stations``,
+    through a temporary file replacing ``out``, so the table is never left partially written.
+    Stations failed are logged and skipped.
+
+    :param stations: Station names, RFs of each station are in a folder named after it in ``rfroot``
+    :type stations: list
+    :param rfroot: Root path to RFs of stations
+    :type rfroot: str
+    :param hpara: Parameters of H-k stacking
+    :type hpara: :class:`seispy.hkpara.HKPara`
+    :param out: Path to the table of results
+    :type out: str
+    :param workers: Number of processes, defaults to 1
+    :type workers: int, optional
+    :param stack_path: Folder saving stacked H-k grids of stations as ``staname_Hk.npz`` for :func:`plot_stations`, created
+        if missing, defaults to None for not saving
+    :type stack_path: str, optional
+    :param log: A logger instance, defaults to None for :class:`seispy.setuplog.setuplog`
+    :type log: :class:`seispy.setuplog.setuplog`, optional
+    :return: Names of stations succeeded
+    :rtype: list
+    """
+    if log is None:
+        log = setuplog()
+    if stack_path is not None:
+        os.makedirs(stack_path, exist_ok=True)
+    initargs = (hpara, rfroot, stack_path)
+    if workers > 1 and len(stations) > 1:
+        pool = Pool(workers, initializer=_init_batch_worker, initargs=initargs)
+        results = pool.imap(_run_batch_worker, stations)
     else:
-        plot(stack, allstack, hpara.hrange, hpara.krange, besth, bestk, cvalue, title=title)
+        pool = None
+        _init_batch_worker(*initargs)
+        results = map(_run_batch_worker, stations)
+    lines, done = [], []
+    try:
+        for i, (staname, line, info) in enumerate(results):
+            if line is None:
+                log.HKlog.error('Skip station {}: {}'.format(staname, info))
+                continue
+            log.HKlog.info('the {}th/{} station {} with {} events'.format(i + 1, len(stations), staname, info))
+            lines.append(line)
+            done.append(staname)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    tmpname = '{}.{}'.format(out, os.getpid())
+    with open(tmpname, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmpname, out)
+    return done
+
+
+def plot_stations(stations, stack_path, img_path=None):
+    """Plot stacked H-k grids saved by :func:`hk_stations`, as a pass separated from stacking
+
+    :param stations: Station names
+    :type stations: list
+    :param stack_path: Folder of ``staname_Hk.npz``
+    :type stack_path: str
+    :param img_path: Folder of images, defaults to None for ``stack_path``
+    :type img_path: str, optional
+    """
+    img_path = stack_path if img_path is None else img_path
+    for staname in stations:
+        with np.load(join(stack_path, staname + '_Hk.npz')) as data:
+            result = {key: data[key] for key in data.files}
+        _plot_result(result, str(result['title']), path=join(img_path, staname + '_Hk.png'))
 
 
 def hk():
@@ -188,11 +626,59 @@ def hk():
     parser.add_argument('cfg_file', type=str, help='Path to HK configure file')
     parser.add_argument('-v', help='Display results to standard output',
                         dest='isdisplay', action='store_true')
+    parser.add_argument('-a', '--adaptive', help='Search H and kappa from a coarse grid to the grid in cfg_file, '
+                        'images are plotted on the coarse grid', action='store_true')
+    parser.add_argument('-b', help='Errors of H and kappa are standard deviations of n_samples bootstrap samples '
+                        'of events instead of extents of the contour. With -a, samples are stacked on the coarse '
+                        'grid and the dense grid around the maximum', type=int, default=None, metavar='n_samples')
+    parser.add_argument('--seed', help='Seed of bootstrap resampling for reproducible errors', type=int,
+                        default=None)
     arg = parser.parse_args()
     hpara = hkpara(arg.cfg_file)
+    if arg.adaptive:
+        hpara.adaptive = True
+    if arg.b is not None:
+        hpara.boot_samples = arg.b
+    if arg.seed is not None:
+        hpara.boot_seed = arg.seed
     hksta(hpara, isplot=True, isdisplay=arg.isdisplay)
 
 
+def hk_batch():
+    parser = argparse.ArgumentParser(description="HK stacking for stations in a list with a pool of processes")
+    parser.add_argument('stalist', type=str, help='Station list with station names in the first column')
+    parser.add_argument('rfroot', type=str, help='Root path to RFs, RFs of each station are in a folder named after it')
+    parser.add_argument('-c', help='Path to HK configure file for parameters of stacking. '
+                        'hklst and hkpath in it are used as the output table and the folder of images',
+                        metavar='cfg_file', type=str, default=None)
+    parser.add_argument('-o', help='Output table of results, defaults to hklst in cfg_file or hk.dat',
+                        metavar='out', type=str, default=None)
+    parser.add_argument('-j', '--workers', help='Number of processes, defaults to 1', type=int, default=1,
+                        metavar='workers')
+    parser.add_argument('-a', '--adaptive', help='Search H and kappa from a coarse grid', action='store_true')
+    parser.add_argument('-b', help='Errors of H and kappa are standard deviations of n_samples bootstrap samples '
+                        'of events instead of extents of the contour. With -a, samples are stacked on the coarse '
+                        'grid and the dense grid around the maximum', type=int, default=None, metavar='n_samples')
+    parser.add_argument('--seed', help='Seed of bootstrap resampling for reproducible errors', type=int,
+                        default=None)
+    parser.add_argument('-p', help='Save stacked grids to hkpath and plot them after all stations are stacked',
+                        dest='isplot', action='store_true')
+    arg = parser.parse_args()
+    hpara = HKPara() if arg.c is None else hkpara(arg.c)
+    if arg.adaptive:
+        hpara.adaptive = True
+    if arg.b is not None:
+        hpara.boot_samples = arg.b
+    if arg.seed is not None:
+        hpara.boot_seed = arg.seed
+    out = hpara.hklist if arg.o is None else arg.o
+    stations = np.loadtxt(arg.stalist, dtype=str, usecols=0, ndmin=1).tolist()
+    stack_path = hpara.hkpath if arg.isplot else None
+    done = hk_stations(stations, arg.rfroot, hpara, out, workers=arg.workers, stack_path=stack_path)
+    if arg.isplot:
+        plot_stations(done, stack_path)
+
+
 def hktest():
     h = np.arange(40, 80, 0.1)
     kappa = np.arange(1.6, 1.9, 0.01)
@@ -13,6 +13,9 @@ class HKPara(object):
         self.krange = np.arange(1.6, 1.9, 0.01)
         self.vp = 6.3
         self.weight = (0.7, 0.2, 0.1)
+        self.adaptive = False
+        self.boot_samples = None
+        self.boot_seed = None
     
     def __str__(self):
         head = ['{}: {}'.format(k, v) for k, v in self.__dict__.items()]
@@ -69,4 +72,11 @@ def hkpara(cfg_file):
     w2 = cf.getfloat('hk', 'weight2')
     w3 = cf.getfloat('hk', 'weight3')
     hpara.weight = (w1, w2, w3)
+    hpara.adaptive = cf.getboolean('hk', 'adaptive', fallback=False)
+    boot_samples = cf.get('hk', 'boot_samples', fallback='')
+    if boot_samples != '':
+        hpara.boot_samples = int(boot_samples)
+    boot_seed = cf.get('hk', 'boot_seed', fallback='')
+    if boot_seed != '':
+        hpara.boot_seed = int(boot_seed)
     return hpara
@@ -1,6 +1,6 @@
-from seispy.ccp3d import CCP3D
+from seispy.ccp3d import CCP3D, search_peaks, peak_stats
 from seispy.geo import extrema, latlon_from
-from seispy.signal import smooth
+from seispy.signal import smooth, smooth_rows
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -49,24 +49,14 @@ class GoodDepth():
            depmax < self.ccp_data.cpara.stack_range[0] or \
            depmax < depmin:
            raise ValueError('Depth range is out of stacking range.')
-        for i, bin_stack in enumerate(self.ccp_data.stack_data):
-            tr = smooth(bin_stack['mu'], self.smooth_val, 'hanning')
-            dep_moho = search_peak(tr, self.ccp_data.cpara, depmin, depmax)
-            if np.isnan(dep_moho):
-                stackamp = np.nan
-                count = np.nan
-                ci_low = np.nan
-                ci_high = np.nan
-            else:
-                idx = int((dep_moho - self.ccp_data.cpara.stack_range[0])/self.ccp_data.cpara.stack_val)
-                stackamp = bin_stack['mu'][idx]
-                count = bin_stack['count'][idx]
-                ci_low = bin_stack['ci'][idx, 0]
-                ci_high = bin_stack['ci'][idx, 1]
-            this_df = pd.DataFrame([[dep_moho, stackamp, count, ci_low, ci_high]],
-                                   columns=['depth', 'amp', 'count', 'ci_low', 'ci_high'])
-            self.good_depth = pd.concat([self.good_depth, this_df], ignore_index=True)
-    
+        cpara = self.ccp_data.cpara
+        tr = smooth_rows(self.ccp_data.stack_data.mu, self.smooth_val, 'hanning')
+        depths = np.arange(tr.shape[1]) * cpara.stack_val + cpara.stack_range[0]
+        dep_moho = search_peaks(tr, depths, depmin, depmax)
+        stats = peak_stats(self.ccp_data.stack_data, dep_moho, cpara.stack_range[0], cpara.stack_val)
+        stats['depth'] = dep_moho
+        self.good_depth = pd.DataFrame(stats, columns=['depth', 'amp', 'count', 'ci_low', 'ci_high'])
+
     def _get_adjacent_lim(self):
         offset = self.ccp_data.cpara.center_bin[-1]*self.val+0.1
         lat, lon = self.ccp_data.bin_loca[self.bin_idx]
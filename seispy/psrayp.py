@@ -1,21 +1,89 @@
 import os
+import time
 import numpy as np
-from scipy.interpolate import interpn
-import subprocess
+from scipy.interpolate import interpn, RegularGridInterpolator
+from multiprocessing import Pool
+from obspy.taup import TauPyModel
+from obspy.taup.seismic_phase import SeismicPhase
+from obspy.taup.helper_classes import TauModelError
 import argparse
 import sys
 
 
+_worker_model = None
+
+
+def _init_worker(velmod):
+    global _worker_model
+    _worker_model = TauPyModel(velmod).model
+
+
+def _calc_rayp(tau_model, this_dep, dis, real_layers):
+    """Ray-parameters in s/deg of Pds phases from a source depth to distances.
+    Phases are built once for the depth-corrected model and evaluated for all distances.
+    """
+    tau_model = tau_model.depth_correct(this_dep)
+    if this_dep != 0:
+        tau_model = tau_model.split_branch(0.0)
+    rayp = np.full((len(dis), len(real_layers)), np.nan)
+    for k, lay in enumerate(real_layers):
+        try:
+            phase = SeismicPhase('P{}s'.format(lay), tau_model, 0.0)
+        except TauModelError:
+            continue
+        for i, this_dis in enumerate(dis):
+            arrivals = phase.calc_time(this_dis)
+            if arrivals:
+                rayp[i, k] = min(arrivals, key=lambda arr: arr.time).ray_param_sec_degree
+    return rayp
+
+
+def _fill_missing(rayp):
+    """Fill ray-parameters of missing arrivals with shape of ``(dis.size, layers.size)``.
+    Gaps are interpolated along distances and then along layers, beyond the ends the nearest values are used,
+    e.g., distances in the shadow zone take ray-parameters at the last distance with arrivals.
+    All cells are left NaN if no arrival is found at all.
+    """
+    rayp = np.array(rayp, dtype=float)
+    for rows in (rayp.T, rayp):
+        for row in rows:
+            valid = ~np.isnan(row)
+            if valid.any() and not valid.all():
+                idx = np.arange(row.size)
+                row[~valid] = np.interp(idx[~valid], idx[valid], row[valid])
+    return rayp
+
+
+def _calc_rayp_worker(task):
+    j, this_dep, dis, real_layers = task
+    return j, _calc_rayp(_worker_model, this_dep, dis, real_layers)
+
+
 class PsRayp(object):
-    def __init__(self, dis, dep, laymin=0, laymax=800):
+    def __init__(self, dis, dep, laymin=0, laymax=800, velmod='iasp91'):
+        """Ray-parameter library of Pds phases calculated with :mod:`obspy.taup`
+
+        :param dis: Epicentral distances in degree
+        :type dis: numpy.ndarray
+        :param dep: Focal depths in km
+        :type dep: numpy.ndarray
+        :param laymin: Minimum depth of conversion layers in km, defaults to 0
+        :type laymin: int, optional
+        :param laymax: Maximum depth of conversion layers in km, defaults to 800
+        :type laymax: int, optional
+        :param velmod: 1D velocity model supported by :class:`obspy.taup.TauPyModel`, defaults to 'iasp91'
+        :type velmod: str, optional
+        """
         self.dis = dis
         self.dep = dep
+        self.velmod = velmod
         self.layers = np.arange(laymin, laymax)
         self.real_layers = np.array([])
         self.fake_layers = np.array([])
         self.real_idx = np.array([])
         self.fake_idx = np.array([])
         self.rayp = np.zeros((len(dis), len(dep), len(self.layers)))
+        self.done = np.zeros(len(dep), dtype=bool)
 
     def make_phase_list(self):
         self.real_idx = np.where(self.layers >= 11)[0]
@@ -24,35 +92,83 @@ class PsRayp(object):
             raise ValueError('Max layer must greater than 8 km')
         self.real_layers = self.layers[self.real_idx]
         self.fake_layers = self.layers[self.fake_idx]
-        with open('/tmp/tmp_phlst.txt', 'w+') as f:
-            for lay in self.real_layers:
-                f.write('P{}s\n'.format(lay))
+        self.phase_list = ['P{}s'.format(lay) for lay in self.real_layers]
 
-    def taup_rayp(self, this_dis=50, this_dep=10, taup='taup_time'):
-        """
-        :param taup: Path to taup_time
-        :return:
+    def _set_rayp(self, j, rayp):
+        rayp = _fill_missing(rayp)
+        self.rayp[:, j, self.real_idx] = rayp
+        self.rayp[:, j, self.fake_idx] = rayp[:, 0:1]
+        self.done[j] = True
+
+    def taup_rayp(self, this_dis=50, this_dep=10):
+        """Calculate ray-parameters of Pds phases for a pair of distance and depth
+
+        :return: Layers and ray-parameters in s/deg with shape of ``(2, layers.size)``
         """
-        if not os.path.exists('/tmp/tmp_phlst.txt'):
-            raise FileNotFoundError('Please excute \'make_phase_list\' first')
-        cmd = '{} -h {} -pf {} -deg {} --rayp'.format(taup, this_dep, '/tmp/tmp_phlst.txt', this_dis)
-        s = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        # s.communicate(cmd.encode())
-        rayp = np.array(s.stdout.read().decode().strip().split())
+        if self.real_idx.size == 0:
+            raise ValueError('Please excute \'make_phase_list\' first')
+        rayp = _calc_rayp(TauPyModel(self.velmod).model, this_dep, [this_dis], self.real_layers)[0]
         out_rayp = np.zeros([2, self.layers.shape[0]])
-        for lay in self.fake_idx:
-            out_rayp[0, lay] = self.layers[lay]
-            out_rayp[1, lay] = rayp[0]
-        for lay in self.real_idx:
-            out_rayp[0, lay] = self.layers[lay]
-            out_rayp[1, lay] = rayp[lay-11]
+        out_rayp[0] = self.layers
+        out_rayp[1, self.fake_idx] = rayp[0]
+        out_rayp[1, self.real_idx] = rayp
         return out_rayp
 
-    def get_rayp(self):
-        for i in range(self.dis.shape[0]):
-            print('{}'.format(self.dis[i]))
-            for j in range(self.dep.shape[0]):
-                self.rayp[i, j, :] = self.taup_rayp(this_dis=self.dis[i], this_dep=self.dep[j])[1]
+    def load_partial(self, path):
+        """Load a partial grid saved by :meth:`PsRayp.get_rayp` to resume the calculation
+
+        :param path: Path to the partial grid
+        :type path: str
+        """
+        part = np.load(path)
+        for key in ('dis', 'dep', 'layers'):
+            if not np.array_equal(part[key], self.__dict__[key]):
+                raise ValueError('The grid of {} in {} does not match, please remove it'.format(key, path))
+        self.rayp = part['rayp']
+        self.done = part['done']
+
+    def save_partial(self, path):
+        tmpname = '{}.{}.npz'.format(path[:-4] if path.endswith('.npz') else path, os.getpid())
+        np.savez(tmpname, dis=self.dis, dep=self.dep, layers=self.layers, rayp=self.rayp, done=self.done)
+        os.replace(tmpname, path)
+
+    def get_rayp(self, workers=1, checkpoint=None, checkpoint_interval=60):
+        """Calculate ray-parameters of the grid. Each focal depth is calculated in a process
+        with its own :class:`obspy.taup.TauPyModel`.
+
+        :param workers: Number of processes, defaults to 1
+        :type workers: int, optional
+        :param checkpoint: Path to a partial grid, which is resumed if it exists
+            and updated every ``checkpoint_interval`` seconds, defaults to None
+        :type checkpoint: str, optional
+        :param checkpoint_interval: Interval of saving the partial grid in seconds, defaults to 60
+        :type checkpoint_interval: float, optional
+        """
+        if self.real_idx.size == 0:
+            self.make_phase_list()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_partial(checkpoint)
+        tasks = [(j, self.dep[j], self.dis, self.real_layers) for j in np.where(~self.done)[0]]
+        last_save = time.time()
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(self.velmod,))
+            results = pool.imap_unordered(_calc_rayp_worker, tasks)
+        else:
+            pool = None
+            _init_worker(self.velmod)
+            results = map(_calc_rayp_worker, tasks)
+        try:
+            for j, rayp in results:
+                self._set_rayp(j, rayp)
+                print('{}/{} depth of {} km'.format(self.done.sum(), self.dep.size, self.dep[j]))
+                if checkpoint is not None and time.time() - last_save > checkpoint_interval:
+                    self.save_partial(checkpoint)
+                    last_save = time.time()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if checkpoint is not None and tasks:
+                self.save_partial(checkpoint)
 
     def save(self, path='Ps_rayp'):
         np.savez(path, dis=self.dis, dep=self.dep, layers=self.layers, rayp=self.rayp)
@@ -66,6 +182,10 @@ def gen_rayp_lib():
                         metavar='min_dep/max_dep/interval', required=True, dest='dep_str', type=str)
     parser.add_argument('-l', help='layers range as in km, defaults to 0/800',
                         dest='lay_str', metavar='min_layer/man_layer', type=str, default='0/800')
+    parser.add_argument('-m', help='1D velocity model supported by obspy.taup, defaults to iasp91',
+                        dest='velmod', metavar='velmod', type=str, default='iasp91')
+    parser.add_argument('-j', help='Number of processes, defaults to 1',
+                        dest='workers', metavar='workers', type=int, default=1)
     parser.add_argument('-o', help='Out path to Pds ray parameter lib',
                         metavar='outpath', type=str, default='./Ps_rayp', dest='out_path')
 
@@ -80,17 +200,69 @@ def gen_rayp_lib():
     laymin = int(arg.lay_str.split('/')[0])
     laymax = int(arg.lay_str.split('/')[1])
 
-    pr = PsRayp(dis, dep, laymin=laymin, laymax=laymax)
+    out_path = arg.out_path[:-4] if arg.out_path.endswith('.npz') else arg.out_path
+    checkpoint = out_path + '.part.npz'
+    pr = PsRayp(dis, dep, laymin=laymin, laymax=laymax, velmod=arg.velmod)
     pr.make_phase_list()
-    pr.get_rayp()
-    pr.save(path=arg.out_path)
+    pr.get_rayp(workers=arg.workers, checkpoint=checkpoint)
+    pr.save(path=out_path)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+class PsRaypLib(object):
+    def __init__(self, rayp_lib):
+        """Ray-parameter library of Pds phases generated by ``gen_rayp_lib``.
+        The library is loaded once and interpolated for all events of a station in one call.
+
+        :param rayp_lib: Path to the library or the loaded ``.npz`` file
+        :type rayp_lib: str or numpy.lib.npyio.NpzFile
+        """
+        if isinstance(rayp_lib, str):
+            if not os.path.exists(rayp_lib):
+                raise FileNotFoundError('Ps rayp lib file not found')
+            rayp_lib = np.load(rayp_lib)
+        self.dis = rayp_lib['dis']
+        self.dep = rayp_lib['dep']
+        self.layers = rayp_lib['layers']
+        self.rayp = rayp_lib['rayp']
+        if np.isnan(self.rayp).any():
+            # libraries with missing arrivals left as NaN
+            self.rayp = np.stack([_fill_missing(self.rayp[:, j]) for j in range(self.dep.size)], axis=1)
+        self._interp = RegularGridInterpolator((self.dis, self.dep, self.layers), self.rayp,
+                                               bounds_error=False, fill_value=None)
+
+    def get_psrayp(self, dis, dep, layers):
+        """Interpolate ray-parameters of Pds phases for events
+
+        :param dis: Epicentral distances of events in degree
+        :type dis: float or numpy.ndarray
+        :param dep: Focal depths of events in km
+        :type dep: float or numpy.ndarray
+        :param layers: Depths of conversion layers in km
+        :type layers: numpy.ndarray
+        :return: Ray-parameters in s/deg with shape of ``(ev_num, layers.size)``
+        :rtype: numpy.ndarray
+        :raises ValueError: If focal depths near events have no arrivals in the library
+        """
+        dis = np.atleast_1d(dis).astype(float)
+        dep = np.atleast_1d(dep).astype(float)
+        points = np.empty((dis.size, layers.size, 3))
+        points[:, :, 0] = dis[:, np.newaxis]
+        points[:, :, 1] = dep[:, np.newaxis]
+        points[:, :, 2] = layers
+        rayp = self._interp(points)
+        if np.isnan(rayp).any():
+            ev = np.where(np.isnan(rayp).any(axis=1))[0][0]
+            raise ValueError('No Pds arrivals in the library around the event at {:.2f} deg '
+                             'and {:.1f} km'.format(dis[ev], dep[ev]))
+        return rayp
 
 
 def get_psrayp(rayp_lib, dis, dep, layers):
-    # x_layers = np.zeros([len(layers), 3])
-    # for i in range(len(layers)):
-    #     x_layers[i] = np.array([dis, dep, layers[i]])
-    x_layers = np.array([[dis, dep, lay]for lay in layers])
+    if isinstance(rayp_lib, PsRaypLib):
+        return rayp_lib.get_psrayp(dis, dep, layers)[0]
+    x_layers = np.column_stack((np.full(len(layers), dis), np.full(len(layers), dep), layers))
     return interpn((rayp_lib['dis'], rayp_lib['dep'], rayp_lib['layers']), rayp_lib['rayp'], x_layers,
                    bounds_error=False, fill_value=None)
 
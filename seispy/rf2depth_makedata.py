@@ -4,7 +4,16 @@ import numpy as np
 from seispy.ccppara import ccppara
 from seispy.setuplog import setuplog
 from seispy.geo import latlon_from, rad2deg
-from os.path import join, exists
+from seispy.psrayp import PsRaypLib
+from seispy.core.rfdepth import save_rfdep, hash_path
+from seispy.utils import read_rfdep
+from os.path import join, exists, abspath
+from multiprocessing import Pool
+import os
+import json
+import hashlib
+import tempfile
+import shutil
 import argparse
 import sys
 import glob
@@ -50,7 +59,224 @@ def _load_mod(datapath, staname):
         return modfiles[0]
 
 
-def makedata(cpara, velmod3d=None, modfolder1d=None, log=setuplog()):
+def _makedata_station(cpara, sta_info, i, velmod=None, modfolder1d=None, srayp=None):
+    rfdep = {}
+    rfpath = join(cpara.rfpath, sta_info.station[i])
+    stadatar = RFStation(rfpath, only_r=True)
+    stadatar.stel = sta_info.stel[i]
+    stadatar.stla = sta_info.stla[i]
+    stadatar.stlo = sta_info.stlo[i]
+    piercelat = np.zeros([stadatar.ev_num, cpara.depth_axis.shape[0]])
+    piercelon = np.zeros([stadatar.ev_num, cpara.depth_axis.shape[0]])
+    if stadatar.prime_phase == 'P':
+        sphere = True
+    else:
+        sphere = False
+    if velmod is None:
+        if modfolder1d is not None:
+            velmod = _load_mod(modfolder1d, sta_info.station[i])
+        else:
+            velmod = cpara.velmod
+    PS_RFdepth, end_index, x_s, _ = psrf2depth(stadatar, cpara.depth_axis,
+                        velmod=velmod, srayp=srayp, sphere=sphere, phase=cpara.phase)
+    for j in range(stadatar.ev_num):
+        piercelat[j], piercelon[j] = latlon_from(sta_info.stla[i], sta_info.stlo[i],
+                                                 stadatar.bazi[j], rad2deg(x_s[j]))
+    rfdep['station'] = sta_info.station[i]
+    rfdep['stalat'] = sta_info.stla[i]
+    rfdep['stalon'] = sta_info.stlo[i]
+    rfdep['depthrange'] = cpara.depth_axis
+    # rfdep['events'] = _convert_str_mat(stadatar.event)
+    rfdep['bazi'] = stadatar.bazi
+    rfdep['rayp'] = stadatar.rayp
+    # rfdep['phases'] = stadatar.phase[i]
+    rfdep['moveout_correct'] = PS_RFdepth
+    rfdep['piercelat'] = piercelat
+    rfdep['piercelon'] = piercelon
+    rfdep['stopindex'] = end_index
+    return rfdep
+
+
+def _makedata3d_station(cpara, sta_info, i, mod3d, srayp=None, raytracing3d=True):
+    rfdep = {}
+    rfpath = join(cpara.rfpath, sta_info.station[i])
+    stadatar = RFStation(rfpath, only_r=True)
+    stadatar.stel = sta_info.stel[i]
+    stadatar.stla = sta_info.stla[i]
+    stadatar.stlo = sta_info.stlo[i]
+    if stadatar.prime_phase == 'P':
+        sphere = True
+    else:
+        sphere = False
+    if raytracing3d:
+        pplat_s, pplon_s, pplat_p, pplon_p, newtpds = psrf_3D_raytracing(stadatar, cpara.depth_axis, mod3d, srayp=srayp, sphere=sphere)
+    else:
+        pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps = psrf_1D_raytracing(
+            stadatar, cpara.depth_axis, srayp=srayp, sphere=sphere, phase=cpara.phase)
+        newtpds = psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p,
+                                    tps, cpara.depth_axis, mod3d)
+    amp3d, end_index = time2depth(stadatar, cpara.depth_axis, newtpds)
+    rfdep['station'] = sta_info.station[i]
+    rfdep['stalat'] = sta_info.stla[i]
+    rfdep['stalon'] = sta_info.stlo[i]
+    rfdep['depthrange'] = cpara.depth_axis
+    # rfdep['events'] = _convert_str_mat(stadatar.event)
+    rfdep['bazi'] = stadatar.bazi
+    rfdep['rayp'] = stadatar.rayp
+    # rfdep['phases'] = _convert_str_mat(stadatar.phase)
+    rfdep['moveout_correct'] = amp3d
+    rfdep['piercelat'] = pplat_s
+    rfdep['piercelon'] = pplon_s
+    rfdep['stopindex'] = end_index
+    return rfdep
+
+
+_worker = {}
+
+
+def _init_worker(func, kwargs):
+    """Load the Ps rayp lib and the memory-mapped 3D model once in each worker"""
+    kwargs = kwargs.copy()
+    if isinstance(kwargs.get('srayp'), str):
+        kwargs['srayp'] = PsRaypLib(kwargs['srayp'])
+    if isinstance(kwargs.get('mod3d'), str):
+        kwargs['mod3d'] = Mod3DPerturbation(kwargs['mod3d'], kwargs['cpara'].depth_axis,
+                                            velmod=kwargs['cpara'].velmod, mmap=True)
+    _worker['func'] = func
+    _worker['kwargs'] = kwargs
+
+
+def _run_worker(i):
+    return _worker['func'](i=i, **_worker['kwargs'])
+
+
+def _run_stations(func, indices, sta_num, log, workers=1, **kwargs):
+    """Process stations of ``indices`` serially or with a pool of ``workers`` processes.
+    Results are kept in the order of ``indices``.
+    """
+    if workers > 1 and len(indices) > 1:
+        pool = Pool(workers, initializer=_init_worker, initargs=(func, kwargs))
+        results = pool.imap(_run_worker, indices)
+    else:
+        pool = None
+        _init_worker(func, kwargs)
+        results = map(_run_worker, indices)
+    RFdepth = []
+    try:
+        for i, rfdep in zip(indices, results):
+            log.RF2depthlog.info('the {}th/{} station with {} events'.format(i + 1, sta_num, rfdep['bazi'].size))
+            RFdepth.append(rfdep)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return RFdepth
+
+
+def _file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return '{} {} {}'.format(abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def _config_digest(cpara, **kwargs):
+    """Parameters shared by all stations which affect the RFdepth data"""
+    config = {'depth_axis': hashlib.sha1(np.asarray(cpara.depth_axis, dtype=float).tobytes()).hexdigest(),
+              'phase': cpara.phase,
+              'velmod': _file_sha1(cpara.velmod) if exists(cpara.velmod) else cpara.velmod,
+              'rayp_lib': _file_stat(cpara.rayp_lib) if cpara.rayp_lib is not None else None}
+    config.update(kwargs)
+    return json.dumps(config, sort_keys=True)
+
+
+def station_hashes(cpara, sta_info, config, modfolder1d=None):
+    """Hashes of inputs of each station, including the finallist, sizes and modification times of SAC files,
+    position of the station and parameters in ``config``
+
+    :param cpara: Parameters of CCP
+    :type cpara: :class:`seispy.ccppara.CCPPara`
+    :param sta_info: Station list
+    :type sta_info: :class:`Station`
+    :param config: Parameters shared by all stations
+    :type config: str
+    :param modfolder1d: Folder path to 1d vel model files with staname.vel as the file name, defaults to None
+    :type modfolder1d: str, optional
+    :return: Hashes of stations in ``sta_info``
+    :rtype: list
+    """
+    hashes = []
+    for i in range(sta_info.sta_num):
+        sha = hashlib.sha1(config.encode())
+        sha.update('{} {:.6f} {:.6f} {:.6f}'.format(sta_info.station[i], sta_info.stla[i],
+                                                    sta_info.stlo[i], sta_info.stel[i]).encode())
+        rfpath = join(cpara.rfpath, sta_info.station[i])
+        for fname in sorted(glob.glob(join(rfpath, '*finallist.dat'))):
+            sha.update(_file_sha1(fname).encode())
+        for fname in sorted(glob.glob(join(rfpath, '*.sac'))):
+            sha.update(_file_stat(fname).encode())
+        if modfolder1d is not None:
+            try:
+                sha.update(_file_sha1(_load_mod(modfolder1d, sta_info.station[i])).encode())
+            except (FileNotFoundError, ValueError):
+                pass
+        hashes.append(sha.hexdigest())
+    return hashes
+
+
+def _reuse_stations(cpara, sta_info, hashes, log):
+    """Load RFdepth data of stations whose inputs are unchanged since the last run"""
+    hash_file = hash_path(cpara.depthdat)
+    if not exists(hash_file):
+        log.RF2depthlog.warning('No hashes of stations found in {}, all stations will be converted'.format(hash_file))
+        return {}
+    try:
+        old_rfdep = read_rfdep(cpara.depthdat)
+    except FileNotFoundError:
+        log.RF2depthlog.warning('No RFdepth data found in {}, all stations will be converted'.format(cpara.depthdat))
+        return {}
+    with open(hash_file) as f:
+        old_hashes = json.load(f)['stations']
+    old_idx = {str(sta['station']): k for k, sta in enumerate(old_rfdep)}
+    reused = {}
+    for i, staname in enumerate(sta_info.station):
+        if staname in old_idx and old_hashes.get(staname) == hashes[i]:
+            # copy arrays, because memory-mapped files will be overwritten
+            reused[i] = {key: np.array(val) if isinstance(val, np.ndarray) else val
+                         for key, val in old_rfdep[old_idx[staname]].items()}
+    return reused
+
+
+def _convert_stations(cpara, sta_info, func, kwargs, log, workers=1, update=False, config='',
+                      modfolder1d=None, init_kwargs=None):
+    """Convert stations with ``func(**kwargs)`` and save RFdepth data with hashes of stations.
+    With ``update=True``, only stations with changed inputs are converted and spliced into the existing data.
+    """
+    hashes = station_hashes(cpara, sta_info, config, modfolder1d=modfolder1d)
+    if update:
+        reused = _reuse_stations(cpara, sta_info, hashes, log)
+        log.RF2depthlog.info('{} unchanged stations are reused, {} stations will be converted'.format(
+                             len(reused), sta_info.sta_num - len(reused)))
+    else:
+        reused = {}
+    indices = [i for i in range(sta_info.sta_num) if i not in reused]
+    if indices and init_kwargs is not None:
+        kwargs.update(init_kwargs())
+    results = dict(zip(indices, _run_stations(func, indices, sta_info.sta_num, log, workers=workers, **kwargs)))
+    results.update(reused)
+    RFdepth = [results[i] for i in range(sta_info.sta_num)]
+    # savemat(cpara.depthdat, {'RFdepth': RFdepth})
+    save_rfdep(cpara.depthdat, RFdepth, rfdep_format=cpara.rfdep_format)
+    with open(hash_path(cpara.depthdat), 'w') as f:
+        json.dump({'stations': dict(zip(sta_info.station.tolist(), hashes))}, f, indent=1)
+
+
+def makedata(cpara, velmod3d=None, modfolder1d=None, log=setuplog(), workers=1, update=False):
     ismod1d = False
     if velmod3d is not None:
         if isinstance(velmod3d, str):
@@ -67,93 +293,49 @@ def makedata(cpara, velmod3d=None, modfolder1d=None, log=setuplog()):
             ValueError('Path to 1d velocity model files should be in str')
     else:
         ismod1d = True
+    if ismod1d:
+        velmod = None
 
     # cpara = ccppara(cfg_file)
     sta_info = Station(cpara.stalist)
-    RFdepth = []
-    for i in range(sta_info.stla.shape[0]):
-        rfdep = {}
-        rfpath = join(cpara.rfpath, sta_info.station[i])
-        stadatar = RFStation(rfpath, only_r=True)
-        stadatar.stel = sta_info.stel[i]
-        stadatar.stla = sta_info.stla[i]
-        stadatar.stlo = sta_info.stlo[i]
-        log.RF2depthlog.info('the {}th/{} station with {} events'.format(i + 1, sta_info.stla.shape[0], stadatar.ev_num))
-        piercelat = np.zeros([stadatar.ev_num, cpara.depth_axis.shape[0]])
-        piercelon = np.zeros([stadatar.ev_num, cpara.depth_axis.shape[0]])
-        if stadatar.prime_phase == 'P':
-            sphere = True
-        else:
-            sphere = False
-        if ismod1d:
-            if modfolder1d is not None:
-                velmod = _load_mod(modfolder1d, sta_info.station[i])
-            else:
-                velmod = cpara.velmod
-        PS_RFdepth, end_index, x_s, _ = psrf2depth(stadatar, cpara.depth_axis,
-                            velmod=velmod, srayp=cpara.rayp_lib, sphere=sphere, phase=cpara.phase)
-        for j in range(stadatar.ev_num):
-            piercelat[j], piercelon[j] = latlon_from(sta_info.stla[i], sta_info.stlo[i],
-                                                     stadatar.bazi[j], rad2deg(x_s[j]))
-        rfdep['station'] = sta_info.station[i]
-        rfdep['stalat'] = sta_info.stla[i]
-        rfdep['stalon'] = sta_info.stlo[i]
-        rfdep['depthrange'] = cpara.depth_axis
-        # rfdep['events'] = _convert_str_mat(stadatar.event)
-        rfdep['bazi'] = stadatar.bazi
-        rfdep['rayp'] = stadatar.rayp
-        # rfdep['phases'] = stadatar.phase[i]
-        rfdep['moveout_correct'] = PS_RFdepth
-        rfdep['piercelat'] = piercelat
-        rfdep['piercelon'] = piercelon
-        rfdep['stopindex'] = end_index
-        RFdepth.append(rfdep)
-    # savemat(cpara.depthdat, {'RFdepth': RFdepth})
-    np.save(cpara.depthdat, RFdepth)
+    if cpara.rayp_lib is not None and workers > 1:
+        srayp = cpara.rayp_lib
+    elif cpara.rayp_lib is not None:
+        srayp = PsRaypLib(cpara.rayp_lib)
+    else:
+        srayp = None
+    config = _config_digest(cpara, velmod3d=_file_stat(velmod) if velmod is not None and exists(velmod) else velmod)
+    kwargs = dict(cpara=cpara, sta_info=sta_info, velmod=velmod, modfolder1d=modfolder1d, srayp=srayp)
+    _convert_stations(cpara, sta_info, _makedata_station, kwargs, log, workers=workers, update=update,
+                      config=config, modfolder1d=modfolder1d)
 
 
-def makedata3d(cpara, velmod3d, log=setuplog(), raytracing3d=True):
-    mod3d = Mod3DPerturbation(velmod3d, cpara.depth_axis, velmod=cpara.velmod)
+def makedata3d(cpara, velmod3d, log=setuplog(), raytracing3d=True, workers=1, update=False):
     sta_info = Station(cpara.stalist)
-    if cpara.rayp_lib is not None:
-        srayp = np.load(cpara.rayp_lib)
+    if cpara.rayp_lib is not None and workers > 1:
+        srayp = cpara.rayp_lib
+    elif cpara.rayp_lib is not None:
+        srayp = PsRaypLib(cpara.rayp_lib)
     else:
         srayp = None
-    RFdepth = []
-    for i in range(sta_info.stla.shape[0]):
-        rfdep = {}
-        rfpath = join(cpara.rfpath, sta_info.station[i])
-        stadatar = RFStation(rfpath, only_r=True)
-        stadatar.stel = sta_info.stel[i]
-        stadatar.stla = sta_info.stla[i]
-        stadatar.stlo = sta_info.stlo[i]
-        if stadatar.prime_phase == 'P':
-            sphere = True
-        else:
-            sphere = False
-        log.RF2depthlog.info('the {}th/{} station with {} events'.format(i + 1, sta_info.stla.shape[0], stadatar.ev_num))
-        if raytracing3d:
-            pplat_s, pplon_s, pplat_p, pplon_p, newtpds = psrf_3D_raytracing(stadatar, cpara.depth_axis, mod3d, srayp=srayp, sphere=sphere)
-        else:
-            pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps = psrf_1D_raytracing(
-                stadatar, cpara.depth_axis, srayp=srayp, sphere=sphere, phase=cpara.phase)
-            newtpds = psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p,
-                                        tps, cpara.depth_axis, mod3d)
-        amp3d, end_index = time2depth(stadatar, cpara.depth_axis, newtpds)
-        rfdep['station'] = sta_info.station[i]
-        rfdep['stalat'] = sta_info.stla[i]
-        rfdep['stalon'] = sta_info.stlo[i]
-        rfdep['depthrange'] = cpara.depth_axis
-        # rfdep['events'] = _convert_str_mat(stadatar.event)
-        rfdep['bazi'] = stadatar.bazi
-        rfdep['rayp'] = stadatar.rayp
-        # rfdep['phases'] = _convert_str_mat(stadatar.phase)
-        rfdep['moveout_correct'] = amp3d
-        rfdep['piercelat'] = pplat_s
-        rfdep['piercelon'] = pplon_s
-        rfdep['stopindex'] = end_index
-        RFdepth.append(rfdep)
-    np.save(cpara.depthdat, RFdepth)
+    tmpdir = tempfile.mkdtemp()
+
+    def load_mod3d():
+        mod3d = Mod3DPerturbation(velmod3d, cpara.depth_axis, velmod=cpara.velmod)
+        if workers > 1:
+            # Workers share the model through a memory-mapped file instead of pickled copies
+            mod3d_path = join(tmpdir, 'mod3d.npz')
+            mod3d.save(mod3d_path)
+            return {'mod3d': mod3d_path}
+        return {'mod3d': mod3d}
+
+    config = _config_digest(cpara, velmod3d=_file_stat(velmod3d), raytracing3d=raytracing3d)
+    try:
+        kwargs = dict(cpara=cpara, sta_info=sta_info, srayp=srayp, raytracing3d=raytracing3d)
+        _convert_stations(cpara, sta_info, _makedata3d_station, kwargs, log, workers=workers, update=update,
+                          config=config, init_kwargs=load_mod3d)
+    finally:
+        shutil.rmtree(tmpdir)
 
 
 def rf2depth():
@@ -164,6 +346,10 @@ def rf2depth():
                         metavar='1d_velmodel_folder', type=str, default='')
     parser.add_argument('-r', help='Path to 3d vel model in npz file for 3D ray tracing',
                         metavar='3d_velmodel_path', type=str, default='')
+    parser.add_argument('-j', '--workers', help='Number of processes for converting stations in parallel, defaults to 1',
+                        metavar='workers', type=int, default=1)
+    parser.add_argument('-u', '--update', help='Only convert stations with changed inputs since the last run '
+                        'and update them in the existing RFdepth data', action='store_true')
     parser.add_argument('cfg_file', type=str, help='Path to configure file')
     arg = parser.parse_args()
     if len(sys.argv) == 1:
@@ -173,13 +359,13 @@ def rf2depth():
     if arg.d != '' and arg.r != '':
         raise ValueError('Specify only 1 argument in \'-d\' and \'-r\'')
     elif arg.d != '' and arg.r == '' and arg.m == '':
-        makedata3d(cpara, arg.d, raytracing3d=False)
+        makedata3d(cpara, arg.d, raytracing3d=False, workers=arg.workers, update=arg.update)
     elif arg.d == '' and arg.r != '' and arg.m == '':
-        makedata3d(cpara, arg.r, raytracing3d=True)
+        makedata3d(cpara, arg.r, raytracing3d=True, workers=arg.workers, update=arg.update)
     elif arg.d == '' and arg.r == '' and arg.m != '':
-        makedata(cpara, modfolder1d=arg.m)
+        makedata(cpara, modfolder1d=arg.m, workers=arg.workers, update=arg.update)
     else:
-        makedata(cpara)
+        makedata(cpara, workers=arg.workers, update=arg.update)
 
 
 if __name__ == '__main__':
@@ -6,8 +6,8 @@ from os.path import dirname, join, exists, isfile, abspath
 
 import seispy.core.depmodel
 from seispy.geo import skm2srad, sdeg2skm, rad2deg, latlon_from, \
-                       asind, tand, srad2skm, km2deg
-from seispy.psrayp import get_psrayp
+                       asind, tand, srad2skm, km2deg, deg2km, get_geod
+from seispy.psrayp import get_psrayp, PsRaypLib
 from seispy.rfani import RFAni
 from seispy.slantstack import SlantStack
 from seispy.harmonics import Harmonics
@@ -295,7 +295,7 @@ class RFStation(object):
                       The format is the same as in Taup, but the depth should be monotonically increasing, defaults to 'iasp91'
         :type velmod: str, optional
         :param srayp: Ray-parameter lib for Ps phases, If set up to None the rayp of direct is used, defaults to None
-        :type srayp: numpy.lib.npyio.NpzFile, optional
+        :type srayp: str, numpy.lib.npyio.NpzFile or :class:`seispy.psrayp.PsRaypLib`, optional
         :return: 2D array of RFs in depth
         :rtype: :meth:`np.ndarray`
         """
@@ -313,7 +313,7 @@ class RFStation(object):
                       The format is the same as in Taup, but the depth should be monotonically increasing, defaults to 'iasp91'
         :type velmod: str, optional
         :param srayp: Ray-parameter lib for Ps phases, If set up to None the rayp of direct is used, defaults to None
-        :type srayp: numpy.lib.npyio.NpzFile, optional
+        :type srayp: str, numpy.lib.npyio.NpzFile or :class:`seispy.psrayp.PsRaypLib`, optional
         :return pplat_s: Latitude of conversion points
         :return pplon_s: Longitude of conversion points
         :return tps: Time difference of Ps at each depth
@@ -418,12 +418,41 @@ class SACStation(RFStation):
 
 
 def _imag2nan(arr):
-    StopIndex = np.where(np.imag(arr) == 1)[0]
-    if StopIndex.size != 0:
-        arr[StopIndex[0]:] = np.nan
+    StopIndex = np.logical_or.accumulate(np.imag(arr) == 1, axis=-1)
+    arr[StopIndex] = np.nan
     return arr
 
 
+def _latlon_events(stla, stlo, bazi, gcarc):
+    """Positions of all events and depths with a single geodesic calculation
+
+    :param stla: Latitude of the station
+    :type stla: float
+    :param stlo: Longitude of the station
+    :type stlo: float
+    :param bazi: Back-azimuths of events with shape of (nev,)
+    :type bazi: numpy.ndarray
+    :param gcarc: Distances in degree with shape of (nev, ndepth)
+    :type gcarc: numpy.ndarray
+    :return: Latitudes and longitudes with shape of (nev, ndepth)
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    lat0 = np.full(gcarc.shape, stla, dtype=float)
+    lon0 = np.full(gcarc.shape, stlo, dtype=float)
+    azimuth = np.repeat(np.asarray(bazi, dtype=float)[:, np.newaxis], gcarc.shape[1], axis=1)
+    lon, lat, _ = get_geod().fwd(lon0, lat0, azimuth, deg2km(gcarc)*1000)
+    return lat, lon
+
+
+def _load_rayp_lib(srayp):
+    if isinstance(srayp, PsRaypLib):
+        return srayp
+    elif isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
+        return PsRaypLib(srayp)
+    else:
+        raise TypeError('srayp should be path to Ps rayp lib')
+
+
 def moveoutcorrect_ref(stadatar, raypref, YAxisRange, 
                        chan='r', velmod='iasp91', sphere=True, phase=1):
     """Moveout correction refer to a specified ray-parameter
@@ -449,11 +478,7 @@ def moveoutcorrect_ref(stadatar, raypref, YAxisRange,
     else:
         raise ValueError('Field \'datar\' or \'datal\' must be in the SACStation')
     dep_mod = DepModel(YAxisRange, velmod, stadatar.stel)
-    # x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    # x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    for i in range(stadatar.ev_num):
-        tps[i], _, _ = xps_tps_map(dep_mod, stadatar.rayp[i], stadatar.rayp[i], sphere=sphere, phase=phase)
+    tps, _, _ = xps_tps_events(dep_mod, stadatar.rayp, stadatar.rayp, sphere=sphere, phase=phase)
     Tpds_ref, _, _ = xps_tps_map(dep_mod, raypref, raypref, sphere=sphere, phase=phase)
     Newdatar = np.zeros([stadatar.ev_num, stadatar.rflength])
     EndIndex = np.zeros(stadatar.ev_num)
@@ -498,7 +523,7 @@ def psrf2depth(stadatar, YAxisRange, velmod='iasp91', srayp=None, normalize='sin
     :param velmod: Velocity for conversion, whcih can be a path to velocity file, defaults to 'iasp91'
     :type velmod: str, optional
     :param srayp: ray-parameter library of conversion phases. See :meth:`seispy.psrayp` in detail, defaults to None
-    :type srayp: str or :meth:`seispy.psrayp.PsRayp`, optional
+    :type srayp: str or :class:`seispy.psrayp.PsRaypLib`, optional
     :param normalize: method of normalization, defaults to 'single'. Please refer to :meth:`RFStation.normalize`
     :type normalize: str, optional
     :param sphere: Wether do earth-flattening transformation, defaults to True
@@ -534,28 +559,13 @@ def psrf2depth(stadatar, YAxisRange, velmod='iasp91', srayp=None, normalize='sin
         except:
             raise ValueError('Cannot recognize the velocity model of \'{}\''.format(velmod))
 
-    x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
     if srayp is None:
-        for i in range(stadatar.ev_num):
-            tps[i], x_s[i], x_p[i] = xps_tps_map(dep_mod, stadatar.rayp[i], 
-                stadatar.rayp[i], sphere=sphere, phase=phase)
-    elif isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
-        if isinstance(srayp, str):
-            if not exists(srayp):
-                raise FileNotFoundError('Ps rayp lib file was not found')
-            else:
-                rayp_lib = np.load(srayp)
-        else:
-            rayp_lib = srayp
-        for i in range(stadatar.ev_num):
-            rayp = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
-            rayp = skm2srad(sdeg2skm(rayp))
-            tps[i], x_s[i], x_p[i] = xps_tps_map(dep_mod,
-                rayp, stadatar.rayp[i], sphere=sphere, phase=phase)
+        tps, x_s, x_p = xps_tps_events(dep_mod, stadatar.rayp, stadatar.rayp, sphere=sphere, phase=phase)
     else:
-        raise TypeError('srayp should be path to Ps rayp lib')
+        rayp_lib = _load_rayp_lib(srayp)
+        rayps = rayp_lib.get_psrayp(stadatar.dis, stadatar.evdp, dep_mod.depths_elev)
+        rayps = skm2srad(sdeg2skm(rayps))
+        tps, x_s, x_p = xps_tps_events(dep_mod, rayps, stadatar.rayp, sphere=sphere, phase=phase)
     ps_rfdepth, endindex = time2depth(stadatar, dep_mod.depths, tps, normalize=normalize)
     return ps_rfdepth, endindex, x_s, x_p
 
@@ -568,9 +578,9 @@ def xps_tps_map(dep_mod: seispy.core.depmodel.DepModel
     :param dep_mod: 1D velocity model class 
     :type dep_mod: :meth:`seispy.util.DepModel`
     :param srayp: conversion phase ray-parameters
-    :type srayp: float
+    :type srayp: float or numpy.ndarray
     :param prayp: S-wave ray-parameters
-    :type prayp: float
+    :type prayp: float or numpy.ndarray
     :param is_raylen: Wether calculate ray length at depths, defaults to False
     :type is_raylen: bool, optional
     :param sphere: Wether do earth-flattening transformation, defaults to True, defaults to True
@@ -610,63 +620,69 @@ def xps_tps_map(dep_mod: seispy.core.depmodel.DepModel
         tps = dep_mod.tpspds(srayp, sphere=sphere)
     else:
         raise ValueError('Phase must be in 1 for Ps, 2 for PpPs, 3 for PsPs+PpSs')
-    if dep_mod.elevation != 0:
-        x_s = interp1d(dep_mod.depths_elev, x_s, bounds_error=False, fill_value=(np.nan, x_s[-1]))(dep_mod.depths)
-        x_p = interp1d(dep_mod.depths_elev, x_p, bounds_error=False, fill_value=(np.nan, x_p[-1]))(dep_mod.depths)
-        tps = interp1d(dep_mod.depths_elev, tps, bounds_error=False, fill_value=(np.nan, tps[-1]))(dep_mod.depths)
-        if is_raylen:
-            raylength_s = interp1d(dep_mod.depths_elev, raylength_s, bounds_error=False, fill_value=(np.nan, raylength_s[-1]))(dep_mod.depths)
-            raylength_p = interp1d(dep_mod.depths_elev, raylength_p, bounds_error=False, fill_value=(np.nan, raylength_p[-1]))(dep_mod.depths)
+    x_s = dep_mod.elev2depth(x_s)
+    x_p = dep_mod.elev2depth(x_p)
+    tps = dep_mod.elev2depth(tps)
+    if is_raylen:
+        raylength_s = dep_mod.elev2depth(raylength_s)
+        raylength_p = dep_mod.elev2depth(raylength_p)
     if is_raylen:
         return tps, x_s, x_p, raylength_s, raylength_p
     else:
         return tps, x_s, x_p
 
 
+def xps_tps_events(dep_mod, srayp, prayp, is_raylen=False, sphere=True, phase=1):
+    """Calculate horizontal distance and time difference at depths for all events of a station at once.
+
+    :param dep_mod: 1D velocity model class
+    :type dep_mod: :meth:`seispy.core.depmodel.DepModel`
+    :param srayp: conversion phase ray-parameters in s/rad with shape of ``(ev_num,)``
+                  or ``(ev_num, dep_mod.depths_elev.size)`` for ray-parameters varied with depths
+    :type srayp: numpy.ndarray
+    :param prayp: ray-parameters of direct phases in s/rad with shape of ``(ev_num,)``
+    :type prayp: numpy.ndarray
+    :param is_raylen: Wether calculate ray length at depths, defaults to False
+    :type is_raylen: bool, optional
+    :param sphere: Wether do earth-flattening transformation, defaults to True
+    :type sphere: bool, optional
+    :param phase: Phases to calculate 1 for ``Ps``, 2 for ``PpPs``, 3 for ``PsPs+PpSs``, defaults to 1
+    :type phase: int, optional
+
+    Returns
+    -----------
+    The same as :meth:`xps_tps_map` but in 2-D arrays with shape of ``(ev_num, dep_mod.depths.size)``
+    """
+    srayp = np.asarray(srayp)
+    if srayp.ndim == 1:
+        srayp = srayp[:, np.newaxis]
+    return list(xps_tps_map(dep_mod, srayp, np.asarray(prayp)[:, np.newaxis],
+                            is_raylen=is_raylen, sphere=sphere, phase=phase))
+
+
 def psrf_1D_raytracing(stadatar, YAxisRange, velmod='iasp91', srayp=None, sphere=True, phase=1):
     dep_mod = DepModel(YAxisRange, velmod, stadatar.stel)
 
-    # x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    raylength_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    # x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    raylength_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
     if srayp is None:
-        for i in range(stadatar.ev_num):
-            tps[i], x_s, x_p, raylength_s[i], raylength_p[i] = xps_tps_map(
-                dep_mod, stadatar.rayp[i], stadatar.rayp[i], is_raylen=True, sphere=sphere, phase=phase)
-            print(type(stadatar.bazi[i]), type(rad2deg(x_s)))
-            pplat_s[i], pplon_s[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_s))
-            pplat_p[i], pplon_p[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_p))
-    elif isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
-        if isinstance(srayp, str):
-            if not exists(srayp):
-                raise FileNotFoundError('Ps rayp lib file not found')
-            else:
-                rayp_lib = np.load(srayp)
-        else:
-            rayp_lib = srayp
-        for i in range(stadatar.ev_num):
-            rayp = get_psrayp(rayp_lib, stadatar.dis[i], stadatar.evdp[i], dep_mod.depths_elev)
-            rayp = skm2srad(sdeg2skm(rayp))
-            tps[i], x_s, x_p, raylength_s[i], raylength_p[i] = xps_tps_map(dep_mod, rayp, 
-                                        stadatar.rayp[i], is_raylen=True, sphere=sphere, phase=phase)
-            x_s = _imag2nan(x_s)
-            x_p = _imag2nan(x_p)
-            pplat_s[i], pplon_s[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_s))
-            pplat_p[i], pplon_p[i] = latlon_from(stadatar.stla, stadatar.stlo, stadatar.bazi[i], rad2deg(x_p))
+        tps, x_s, x_p, raylength_s, raylength_p = xps_tps_events(
+            dep_mod, stadatar.rayp, stadatar.rayp, is_raylen=True, sphere=sphere, phase=phase)
     else:
-        raise TypeError('srayp should be path to Ps rayp lib')
+        rayp_lib = _load_rayp_lib(srayp)
+        rayps = rayp_lib.get_psrayp(stadatar.dis, stadatar.evdp, dep_mod.depths_elev)
+        rayps = skm2srad(sdeg2skm(rayps))
+        tps, x_s, x_p, raylength_s, raylength_p = xps_tps_events(
+            dep_mod, rayps, stadatar.rayp, is_raylen=True, sphere=sphere, phase=phase)
+        x_s = _imag2nan(x_s)
+        x_p = _imag2nan(x_p)
+    pplat_s, pplon_s = _latlon_events(stadatar.stla, stadatar.stlo, stadatar.bazi, rad2deg(x_s))
+    pplat_p, pplon_p = _latlon_events(stadatar.stla, stadatar.stlo, stadatar.bazi, rad2deg(x_p))
     return pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength_p, tps
 
 
 def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sphere=True):
     """
     Back ray trace the S wavs with a assumed ray parameter of P.
+    All events are traced together depth by depth.
 
     :param stadatar: The data class including PRFs and more parameters
     :type stadatar: object RFStation
@@ -685,65 +701,49 @@ def psrf_3D_raytracing(stadatar, YAxisRange, mod3d, srayp=None, elevation=0, sph
     else:
         R = 6371.0 + elevation
     dep_range = YAxisRange.copy()
-    YAxisRange -= elevation
+    YAxisRange = YAxisRange - elevation
     ddepth = np.mean(np.diff(YAxisRange))
-    pplat_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplat_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    pplon_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    x_s = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    x_p = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
-    tps = np.zeros([stadatar.ev_num, YAxisRange.shape[0]])
+    ev_num = stadatar.ev_num
+    pplat_s = np.zeros([ev_num, YAxisRange.shape[0]])
+    pplon_s = np.zeros([ev_num, YAxisRange.shape[0]])
+    pplat_p = np.zeros([ev_num, YAxisRange.shape[0]])
+    pplon_p = np.zeros([ev_num, YAxisRange.shape[0]])
+    x_s = np.zeros([ev_num, YAxisRange.shape[0]])
+    x_p = np.zeros([ev_num, YAxisRange.shape[0]])
+    vs = np.zeros([ev_num, YAxisRange.shape[0]])
+    vp = np.zeros([ev_num, YAxisRange.shape[0]])
     rayps = srad2skm(stadatar.rayp)
 
-    if isinstance(srayp, str) or isinstance(srayp, np.lib.npyio.NpzFile):
-        if isinstance(srayp, str):
-            if not exists(srayp):
-                raise FileNotFoundError('Ps rayp lib file not found')
-            else:
-                rayp_lib = np.load(srayp)
-        else:
-            rayp_lib = srayp
-    elif srayp is None:
-        pass
+    if srayp is None:
+        srayps = stadatar.rayp[:, np.newaxis]
     else:
-        raise TypeError('srayp should be path to Ps rayp lib')
-
-    for i in range(stadatar.ev_num):
-        if srayp is None:
-            srayps = stadatar.rayp[i]
-        else:
-            srayps = get_psrayp(rayp_lib, stadatar.dis[i],
-                                stadatar.evdp[i], YAxisRange)
-            srayps = skm2srad(sdeg2skm(srayps))
-        pplat_s[i][0] = pplat_p[i][0] = stadatar.stla
-        pplon_s[i][0] = pplon_p[i][0] = stadatar.stlo
-        x_s[i][0] = 0
-        x_p[i][0] = 0
-        vs = np.zeros_like(YAxisRange)
-        vp = np.zeros_like(YAxisRange)
-        for j, dep in enumerate(YAxisRange[:-1]):
-            vs[j] = interpn((mod3d.model['dep'], mod3d.model['lat'], mod3d.model['lon']),
-                            mod3d.model['vs'], (dep, pplat_s[i, j], pplon_s[i, j]),
-                            bounds_error=False, fill_value=None)
-            vp[j] = interpn((mod3d.model['dep'], mod3d.model['lat'], mod3d.model['lon']),
-                            mod3d.model['vp'], (dep, pplat_p[i, j], pplon_p[i, j]),
-                            bounds_error=False, fill_value=None)
-            x_s[i, j+1] = ddepth*tand(asind(vs[j]*rayps[i])) + x_s[i, j]
-            x_p[i, j+1] = ddepth*tand(asind(vp[j]*rayps[i])) + x_p[i, j]
-            pplat_s[i, j+1], pplon_s[i, j+1] = latlon_from(stadatar.stla,
-                                                           stadatar.stlo,
-                                                           stadatar.bazi[i],
-                                                           km2deg(x_s[i, j+1]))
-            pplat_p[i, j+1], pplon_p[i, j+1] = latlon_from(stadatar.stla,
-                                                           stadatar.stlo,
-                                                           stadatar.bazi[i],
-                                                           km2deg(x_p[i, j+1]))
-        tps_corr = np.cumsum((np.sqrt((R / vs) ** 2 - srayps ** 2) -
-                            np.sqrt((R / vp) ** 2 - stadatar.rayp[i] ** 2))
-                            * (ddepth / R))
-        if elevation != 0:
-            tps[i] = interp1d(YAxisRange, tps_corr)(dep_range)
+        rayp_lib = _load_rayp_lib(srayp)
+        srayps = rayp_lib.get_psrayp(stadatar.dis, stadatar.evdp, YAxisRange)
+        srayps = skm2srad(sdeg2skm(srayps))
+
+    geod = get_geod()
+    stla = np.full(2 * ev_num, stadatar.stla, dtype=float)
+    stlo = np.full(2 * ev_num, stadatar.stlo, dtype=float)
+    bazi = np.tile(stadatar.bazi, 2)
+    pplat_s[:, 0] = pplat_p[:, 0] = stadatar.stla
+    pplon_s[:, 0] = pplon_p[:, 0] = stadatar.stlo
+    for j, dep in enumerate(YAxisRange):
+        depth = np.full(ev_num, dep)
+        vs[:, j] = mod3d.interpvs(np.column_stack((depth, pplat_s[:, j], pplon_s[:, j])))
+        vp[:, j] = mod3d.interpvp(np.column_stack((depth, pplat_p[:, j], pplon_p[:, j])))
+        if j == YAxisRange.shape[0] - 1:
+            break
+        x_s[:, j+1] = ddepth*tand(asind(vs[:, j]*rayps)) + x_s[:, j]
+        x_p[:, j+1] = ddepth*tand(asind(vp[:, j]*rayps)) + x_p[:, j]
+        lon, lat, _ = geod.fwd(stlo, stla, bazi, np.concatenate((x_s[:, j+1], x_p[:, j+1])) * 1000)
+        pplat_s[:, j+1], pplat_p[:, j+1] = lat[:ev_num], lat[ev_num:]
+        pplon_s[:, j+1], pplon_p[:, j+1] = lon[:ev_num], lon[ev_num:]
+    tps = np.cumsum((np.sqrt((R / vs) ** 2 - srayps ** 2) -
+                     np.sqrt((R / vp) ** 2 - stadatar.rayp[:, np.newaxis] ** 2))
+                    * (ddepth / R), axis=1)
+    if elevation != 0:
+        tps = interp1d(YAxisRange, tps, bounds_error=False,
+                       fill_value=(np.nan, tps[:, -1]))(dep_range)
     return pplat_s, pplon_s, pplat_p, pplon_p, tps
 
 
@@ -752,8 +752,8 @@ def interp_depth_model(model, lat, lon, new_dep):
 
     Parameters
     ----------
-    mod3d : :meth:`np.lib.npyio.NpzFile`
-        3D velocity loaded from a ``.npz`` file
+    model : :meth:`np.lib.npyio.NpzFile` or :class:`seispy.utils.Mod3DPerturbation`
+        3D velocity loaded from a ``.npz`` file. Prebuilt interpolators are used for ``Mod3DPerturbation``.
     lat : float
         Latitude of position in 3D velocity model
     lon : float
@@ -769,7 +769,9 @@ def interp_depth_model(model, lat, lon, new_dep):
         Vs in ``new_dep``
     """
     #  model = np.load(modpath)
-    points = [[depth, lat, lon] for depth in new_dep]
+    points = np.column_stack((new_dep, np.full(new_dep.shape, lat), np.full(new_dep.shape, lon)))
+    if isinstance(model, Mod3DPerturbation):
+        return model.interpvp(points), model.interpvs(points)
     vp = interpn((model['dep'], model['lat'], model['lon']), model['vp'], points, bounds_error=False, fill_value=None)
     vs = interpn((model['dep'], model['lat'], model['lon']), model['vs'], points, bounds_error=False, fill_value=None)
     return vp, vs
@@ -805,18 +807,14 @@ def psrf_3D_migration(pplat_s, pplon_s, pplat_p, pplon_p, raylength_s, raylength
     :meth:`np.ndarray`
         Corrected time difference in dep_range
     """
-    ev_num, _ = raylength_p.shape
-    timecorrections = np.zeros_like(raylength_p)
-    for i in range(ev_num):
-        points = np.array([dep_range, pplat_p[i], pplon_p[i]]).T
-        dvp = mod3d.interpdvp(points)
-        points = np.array([dep_range, pplat_s[i], pplon_s[i]]).T
-        dvs = mod3d.interpdvs(points)
-        dlp = raylength_p[i]
-        dls = raylength_s[i]
-        tmpds = (dls / (mod3d.cvs * (1 + dvs)) - dls / mod3d.cvs) - (dlp / (mod3d.cvp * (1 + dvp)) - dlp / mod3d.cvp)
-        tmpds[np.isnan(tmpds)] = 0
-        timecorrections[i] = np.cumsum(tmpds)
+    depths = np.broadcast_to(dep_range, raylength_p.shape)
+    dvp = mod3d.interpdvp(np.stack((depths, pplat_p, pplon_p), axis=-1))
+    dvs = mod3d.interpdvs(np.stack((depths, pplat_s, pplon_s), axis=-1))
+    dlp = raylength_p
+    dls = raylength_s
+    tmpds = (dls / (mod3d.cvs * (1 + dvs)) - dls / mod3d.cvs) - (dlp / (mod3d.cvp * (1 + dvp)) - dlp / mod3d.cvp)
+    tmpds[np.isnan(tmpds)] = 0
+    timecorrections = np.cumsum(tmpds, axis=1)
     return Tpds + timecorrections
 
 
@@ -1,5 +1,6 @@
 import numpy as np
 import argparse
+from os.path import exists
 from seispy.rfcorrect import RFStation
 from scipy.interpolate import interp1d
 from seispy.utils import read_rfdep
@@ -68,11 +69,27 @@ def ccp3d():
     parser.add_argument('cfg_file', type=str, help='Path to CCP configure file')
     parser.add_argument('-s', help='Range for searching depth of D410 and D660, The results would be saved to \'peakfile\' in cfg_file',
                         metavar='d410min/d410max/d660min/d660max', default=None)
+    parser.add_argument('-j', '--workers', help='Number of processes stacking chunks of bins, defaults to 1',
+                        type=int, default=1, metavar='workers')
+    parser.add_argument('--tile', help='Stack bins by tiles of tile_size by tile_size bins and write them to disk, '
+                        'for grids too large to be stacked in memory', type=int, default=None, metavar='tile_size')
+    parser.add_argument('--update', help='Add new stations in RFdepth data to existing stacked data in \'stackfile\', '
+                        'only bins around new stations are stacked. Stacked data are loaded into memory, '
+                        'so it cannot be used with --tile', action='store_true')
     arg = parser.parse_args()
+    if arg.update and arg.tile is not None:
+        parser.error('--update loads the whole grid into memory and cannot be used with --tile')
     ccp = CCP3D(arg.cfg_file)
     ccp.initial_grid()
-    ccp.stack()
-    ccp.save_stack_data(ccp.cpara.stackfile)
+    stackfile = ccp.cpara.stackfile if ccp.cpara.stackfile.endswith('.npz') else ccp.cpara.stackfile + '.npz'
+    if arg.update and exists(stackfile):
+        ccp.update_stack(stackfile, workers=arg.workers)
+        ccp.save_stack_data(stackfile)
+    elif arg.tile is None:
+        ccp.stack(workers=arg.workers)
+        ccp.save_stack_data(ccp.cpara.stackfile)
+    else:
+        ccp.stack_tiles(ccp.cpara.stackfile, tile_size=arg.tile, workers=arg.workers)
     if arg.s:
         search_range = np.array(arg.s.split('/')).astype(float)
         ccp.search_good_410_660(*search_range)
@@ -80,18 +97,26 @@ def ccp3d():
 
 
 def ccp_profile():
-    from seispy.ccpprofile import CCPProfile
+    from seispy.ccpprofile import CCPProfile, read_profile_list, stack_profiles
     parser = argparse.ArgumentParser(description="Stack PRFS along a profile")
     parser.add_argument('cfg_file', type=str, help='Path to CCP configure file')
     parser.add_argument('-t', help='Output as a text file', dest='isdat', action='store_true')
+    parser.add_argument('-j', '--workers', help='Number of processes stacking chunks of bins, defaults to 1',
+                        type=int, default=1, metavar='workers')
+    parser.add_argument('-l', help='List file of profiles with \'lat1 lon1 lat2 lon2 stackfile\' in each line. '
+                        'All profiles are stacked with RFdepth data loaded once instead of the line in cfg_file',
+                        dest='profile_list', default=None, metavar='profile_list')
     arg = parser.parse_args()
     if arg.isdat:
         typ = 'dat'
     else:
         typ = 'npz'
     ccp = CCPProfile(arg.cfg_file)
+    if arg.profile_list is not None:
+        stack_profiles(ccp, read_profile_list(arg.profile_list), workers=arg.workers, format=typ)
+        return
     ccp.initial_profile()
-    ccp.stack()
+    ccp.stack(workers=arg.workers)
     ccp.save_stack_data(format=typ)
 
 
@@ -9,7 +9,8 @@ class setuplog(object):
         "Batlog":("Bat","INFO","stream_handler","file_handler"),
         "CCPlog":("CCP","INFO","stream_handler"),
         "ModCreatorlog":("ModCreator","INFO","stream_handler"),
-        "PickDepthlog": ("PickDepth", "INFO","stream_handler")
+        "PickDepthlog": ("PickDepth", "INFO","stream_handler"),
+        "HKlog": ("HK", "INFO", "stream_handler")
     }
     def __init__(self, filename=join(expanduser('~'), '.RF.log')):
         """
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.ndimage import convolve1d
 
 
 def smooth(x, half_len=5, window='flat'):
@@ -57,6 +58,40 @@ def smooth(x, half_len=5, window='flat'):
     return y[half_len:-half_len]
 
 
+def smooth_rows(x, half_len=5, window='flat'):
+    """Smooth each row of a 2-D array in one convolution along the second axis.
+    Rows are extended with reflected copies at both ends as :func:`smooth`,
+    so that each row is the same as that smoothed by :func:`smooth`.
+
+    :param x: Data with shape of ``(nrow, npts)``
+    :type x: numpy.ndarray
+    :param half_len: The half length of the smoothing window, defaults to 5
+    :type half_len: int, optional
+    :param window: Type of the window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman', defaults to 'flat'
+    :type window: str, optional
+    :return: Smoothed data
+    :rtype: numpy.ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    window_len = 2*half_len+1
+    if x.ndim != 2:
+        raise ValueError("smooth_rows only accepts 2 dimension arrays.")
+    if x.shape[1] < window_len:
+        raise ValueError("Input vector needs to be bigger than window size.")
+    if window_len < 3:
+        return x
+    if window not in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError("Window is on of 'flat', 'hanning', 'hamming',"
+                         "'bartlett', 'blackman'")
+    if window == 'flat':
+        w = np.ones(window_len, 'd')
+    else:
+        w = getattr(np, window)(window_len)
+    s = np.concatenate([x[:, window_len-1:0:-1], x, x[:, -1:-window_len:-1]], axis=1)
+    y = convolve1d(s, w/w.sum(), axis=1)
+    return y[:, window_len-1:window_len-1+x.shape[1]]
+
+
 def whiten(data, Nfft, delta, f1, f2, f3, f4):
     """This function takes 1-dimensional *data* timeseries array,
     goes to frequency domain using fft, whitens the amplitude of the spectrum
@@ -1,11 +1,14 @@
 from os.path import join, dirname, exists
 import array
+import struct
+import zipfile
 
 from scipy.io import loadmat
 from matplotlib.colors import ListedColormap
 import numpy as np
-from scipy.interpolate import interp1d, interpn
+from scipy.interpolate import interp1d, interpn, RegularGridInterpolator
 import pandas as pd
+from seispy.core.rfdepth import RFDepthArray, columnar_paths, pickled_paths
 
 #from seispy.core.depmodel import DepModel
 
@@ -36,38 +39,173 @@ def check_stack_val(stack_val, dep_val):
         raise ValueError('stack_val must be a multiple of dep_val')
 
 
-def read_rfdep(path):
-    try:
-        return np.load(path, allow_pickle=True)
-    except:
+def read_rfdep(path, mmap_mode='r'):
+    """Read RFdepth data in the pickled ``.npy`` format or the columnar format.
+
+    :param path: Path to RFdepth data
+    :type path: str
+    :param mmap_mode: Memory-map mode for the columnar format, defaults to 'r'
+    :type mmap_mode: str, optional
+    :return: RFdepth data supporting ``rfdep[k]['field']``
+    :rtype: numpy.ndarray or :class:`seispy.core.rfdepth.RFDepthArray`
+    :raises ValueError: RFdepth data in both formats exist for ``path``
+    """
+    dnames, fnames = columnar_paths(path), pickled_paths(path)
+    if dnames and fnames:
+        raise ValueError('RFdepth data in both the columnar format ({}) and the npy format ({}) are found, '
+                         'please remove the stale one'.format(dnames[0], fnames[0]))
+    if dnames:
+        return RFDepthArray.load(dnames[0], mmap_mode=mmap_mode)
+    for fname in fnames:
         try:
-            return np.load(path+'.npy', allow_pickle=True)
-        except Exception as e:
-            raise FileNotFoundError('Cannot open file of {}'.format(path))
+            return np.load(fname, allow_pickle=True)
+        except Exception:
+            continue
+    raise FileNotFoundError('Cannot open file of {}'.format(path))
+
+
+def load_npz_mmap(path):
+    """Load arrays in an uncompressed ``.npz`` file as read-only memory maps,
+    so that large models can be shared among processes without copying.
+    Compressed members are loaded into memory.
+
+    :param path: Path to ``.npz`` file
+    :type path: str
+    :return: Arrays in the file
+    :rtype: dict
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            key = info.filename[:-4]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member)
+                continue
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or not shape:
+                with zf.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member)
+                continue
+            arrays[key] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                    order='F' if fortran_order else 'C')
+    return arrays
 
 
 class Mod3DPerturbation:
-    def __init__(self, modpath, YAxisRange, velmod='iasp91'):
+    """3D velocity model and its perturbations relative to a 1D model.
+    Interpolators of ``vp``, ``vs``, ``dvp`` and ``dvs`` are built once and shared by all calls.
+
+    The model file should include fields of ``dep``, ``lat``, ``lon``, ``vp`` and ``vs``,
+    where the shape of ``vp`` and ``vs`` is ``(dep.size, lat.size, lon.size)``.
+    Perturbations ``dvp`` and ``dvs`` saved by :meth:`Mod3DPerturbation.save` with the same 1D model are reused.
+    """
+    fields = ('vp', 'vs', 'dvp', 'dvs')
+
+    def __init__(self, modpath, YAxisRange, velmod='iasp91', dtype=None, mmap=False):
+        """
+        :param modpath: Path to 3D velocity model in ``.npz`` file, or a dict-like model
+        :type modpath: str or dict
+        :param YAxisRange: Depth axis of the 1D reference model
+        :type YAxisRange: numpy.ndarray
+        :param velmod: 1D reference velocity model, defaults to 'iasp91'
+        :type velmod: str, optional
+        :param dtype: Data type of velocities and perturbations, e.g., ``'float32'`` to halve the memory,
+                      defaults to None for the type in the file
+        :type dtype: str or numpy.dtype, optional
+        :param mmap: Wether memory-map arrays of an uncompressed ``.npz`` file, defaults to False
+        :type mmap: bool, optional
+        """
+        from seispy.core.depmodel import DepModel
         dep_mod = DepModel(YAxisRange, velmod=velmod)
-        self.model = np.load(modpath)
-        new1dvp = interp1d(dep_mod.depthsraw, dep_mod.vpraw)(self.model['dep'])
-        new1dvs = interp1d(dep_mod.depthsraw, dep_mod.vsraw)(self.model['dep'])
-        new1dvp, _, _ = np.meshgrid(new1dvp, self.model['lat'], self.model['lon'], indexing='ij')
-        new1dvs, _, _ = np.meshgrid(new1dvs, self.model['lat'], self.model['lon'], indexing='ij')
-        self.dvp = (self.model['vp'] - new1dvp) / new1dvp
-        self.dvs = (self.model['vs'] - new1dvs) / new1dvs
+        if isinstance(modpath, str):
+            if mmap:
+                model = load_npz_mmap(modpath)
+            else:
+                with np.load(modpath) as data:
+                    model = {key: data[key] for key in data.files}
+        else:
+            model = {key: modpath[key] for key in modpath.keys()}
+        self.velmod = velmod
+        self.model = model
+        self._check_model()
+        if dtype is not None:
+            for key in ('vp', 'vs'):
+                self.model[key] = self.model[key].astype(dtype, copy=False)
+        if 'dvp' in model and 'dvs' in model and str(model.get('velmod', '')) == str(velmod):
+            self.dvp = model['dvp']
+            self.dvs = model['dvs']
+        else:
+            new1dvp = interp1d(dep_mod.model_array[:, 0], dep_mod.model_array[:, 1], bounds_error=False,
+                               fill_value=(dep_mod.model_array[0, 1], dep_mod.model_array[-1, 1]))(self.model['dep'])
+            new1dvs = interp1d(dep_mod.model_array[:, 0], dep_mod.model_array[:, 2], bounds_error=False,
+                               fill_value=(dep_mod.model_array[0, 2], dep_mod.model_array[-1, 2]))(self.model['dep'])
+            new1dvp = new1dvp[:, np.newaxis, np.newaxis].astype(self.model['vp'].dtype)
+            new1dvs = new1dvs[:, np.newaxis, np.newaxis].astype(self.model['vs'].dtype)
+            self.dvp = (self.model['vp'] - new1dvp) / new1dvp
+            self.dvs = (self.model['vs'] - new1dvs) / new1dvs
+        if dtype is not None:
+            self.dvp = self.dvp.astype(dtype, copy=False)
+            self.dvs = self.dvs.astype(dtype, copy=False)
         self.cvp = dep_mod.vp
         self.cvs = dep_mod.vs
+        grid = (self.model['dep'], self.model['lat'], self.model['lon'])
+        self._interp = {}
+        for key, values in zip(self.fields, (self.model['vp'], self.model['vs'], self.dvp, self.dvs)):
+            self._interp[key] = RegularGridInterpolator(grid, values, bounds_error=False, fill_value=None)
+
+    def _check_model(self):
+        for key in ('dep', 'lat', 'lon', 'vp', 'vs'):
+            if key not in self.model:
+                raise KeyError('Field \'{}\' not found in the 3D velocity model'.format(key))
+        shape = []
+        for key in ('dep', 'lat', 'lon'):
+            axis = np.asarray(self.model[key], dtype=float)
+            if axis.ndim != 1 or axis.size < 2:
+                raise ValueError('Field \'{}\' of the 3D velocity model must be a 1D array with at least 2 points'.format(key))
+            if np.any(np.diff(axis) <= 0):
+                raise ValueError('Field \'{}\' of the 3D velocity model must be strictly ascending'.format(key))
+            self.model[key] = axis
+            shape.append(axis.size)
+        for key in ('vp', 'vs'):
+            if self.model[key].shape != tuple(shape):
+                raise ValueError('Shape of \'{}\' {} does not match (dep, lat, lon) {}'.format(
+                                 key, self.model[key].shape, tuple(shape)))
+            if not np.issubdtype(self.model[key].dtype, np.floating):
+                self.model[key] = self.model[key].astype(float)
+
+    def save(self, path):
+        """Save the model and perturbations into an uncompressed ``.npz`` file,
+        which can be loaded with ``mmap=True`` without recalculating perturbations.
+
+        :param path: Path to the output file
+        :type path: str
+        """
+        np.savez(path, dep=self.model['dep'], lat=self.model['lat'], lon=self.model['lon'],
+                 vp=self.model['vp'], vs=self.model['vs'], dvp=self.dvp, dvs=self.dvs,
+                 velmod=str(self.velmod))
+
+    def interpvp(self, points):
+        return self._interp['vp'](points)
+
+    def interpvs(self, points):
+        return self._interp['vs'](points)
 
     def interpdvp(self, points):
-        dvp = interpn((self.model['dep'], self.model['lat'], self.model['lon']), self.dvp, points,
-                      bounds_error=False, fill_value=None)
-        return dvp
+        return self._interp['dvp'](points)
 
     def interpdvs(self, points):
-        dvs = interpn((self.model['dep'], self.model['lat'], self.model['lon']), self.dvs, points,
-                      bounds_error=False, fill_value=None)
-        return dvs
+        return self._interp['dvs'](points)
 
 
 def scalar_instance(v):
@@ -24,7 +24,6 @@ setup(name='python-seispy',
                 'pandas>=1.0.0',
                 'obspy>=1.2.1',
                 'pyside6>=6.2.0',
-                'scikits.bootstrap>=1.0.0',
                 'pyproj'],
       entry_points={'console_scripts': ['gen_rayp_lib=seispy.psrayp:gen_rayp_lib',
                                         'prf=seispy.scripts:prf',
@@ -36,6 +35,7 @@ setup(name='python-seispy',
                                         'download_catalog=seispy.catalog:main',
                                         'ccp_profile=seispy.scripts:ccp_profile',
                                         'hk=seispy.hk:hk',
+                                        'hk_batch=seispy.hk:hk_batch',
                                         'pickrf=seispy.pickrf.pickui:main',
                                         'pickdepth=seispy.pickdepth.pickdepthui:main',
                                         'rfani=seispy.scripts:rfani',
@@ -0,0 +1,96 @@
+from seispy.core.depmodel import DepModel
+from seispy.rfcorrect import xps_tps_map, xps_tps_events
+from seispy.geo import skm2srad
+from seispy.psrayp import PsRayp, PsRaypLib, get_psrayp
+from obspy.taup import TauPyModel
+import numpy as np
+import pytest
+
+
+def test_sub01():
+    dep_mod = DepModel(np.arange(0, 300.), elevation=1.5)
+    rayp = skm2srad(np.array([0.045, 0.0612, 0.0789]))
+    tps, x_s, x_p = xps_tps_events(dep_mod, rayp, rayp)
+    for i, p in enumerate(rayp):
+        tps_ex, x_s_ex, x_p_ex = xps_tps_map(dep_mod, p, p)
+        assert np.allclose(tps[i], tps_ex, equal_nan=True)
+        assert np.allclose(x_s[i], x_s_ex, equal_nan=True)
+        assert np.allclose(x_p[i], x_p_ex, equal_nan=True)
+
+
+def test_sub02():
+    dis = np.arange(30, 91, 5.)
+    dep = np.arange(0, 301, 50.)
+    layers = np.arange(0, 100)
+    rayp = 8.5 - 0.05 * dis[:, None, None] - 0.001 * dep[None, :, None] + 0.002 * layers[None, None, :]
+    rayp_lib = {'dis': dis, 'dep': dep, 'layers': layers, 'rayp': rayp}
+    lib = PsRaypLib(rayp_lib)
+    ev_dis = np.array([42.3, 67.8, 88.1])
+    ev_dep = np.array([10., 123.4, 280.])
+    rayps = lib.get_psrayp(ev_dis, ev_dep, np.arange(0, 80, 0.5))
+    assert rayps.shape == (3, 160)
+    for i in range(3):
+        assert np.allclose(rayps[i], get_psrayp(rayp_lib, ev_dis[i], ev_dep[i], np.arange(0, 80, 0.5)))
+
+    # cells without arrivals are filled, queries on depths without any arrival are rejected
+    rayp_lib['rayp'] = rayp.copy()
+    rayp_lib['rayp'][-3:, 0, 20:] = np.nan
+    rayp_lib['rayp'][:, -1] = np.nan
+    lib = PsRaypLib(rayp_lib)
+    assert np.array_equal(lib.rayp[-3:, 0, 20:], np.repeat(rayp[-4:-3, 0, 20:], 3, axis=0))
+    assert not np.isnan(lib.get_psrayp(ev_dis[:2], ev_dep[:2], np.arange(0, 80, 0.5))).any()
+    with pytest.raises(ValueError):
+        lib.get_psrayp(ev_dis, ev_dep, np.arange(0, 80, 0.5))
+
+
+def test_sub03():
+    dis, dep = np.array([30., 60., 100.]), np.array([10., 100.])
+    pr = PsRayp(dis, dep, laymin=0, laymax=40)
+    pr.get_rayp()
+    model = TauPyModel('iasp91')
+    for j, this_dep in enumerate(dep):
+        for lay in (11, 25, 39):
+            arrivals = model.get_travel_times(this_dep, dis[1], ['P{}s'.format(lay)])
+            rayp = min(arrivals, key=lambda arr: arr.time).ray_param_sec_degree
+            assert np.isclose(pr.rayp[1, j, lay], rayp)
+        assert np.array_equal(pr.rayp[1, j, :11], np.full(11, pr.rayp[1, j, 11]))
+        # no P arrivals in the shadow zone, the nearest distance is used
+        assert not model.get_travel_times(this_dep, dis[2], ['P11s'])
+        assert np.array_equal(pr.rayp[2, j], pr.rayp[1, j])
+
+
+class _Interrupted(PsRayp):
+    def _set_rayp(self, j, rayp):
+        if self.done.any():
+            raise KeyboardInterrupt
+        super()._set_rayp(j, rayp)
+
+
+def test_sub04(tmp_path):
+    dis, dep = np.array([40., 70.]), np.array([10., 50., 200.])
+    checkpoint = str(tmp_path / 'Ps_rayp.part.npz')
+    pr = _Interrupted(dis, dep, laymin=0, laymax=30)
+    with pytest.raises(KeyboardInterrupt):
+        pr.get_rayp(workers=2, checkpoint=checkpoint)
+    part = dict(np.load(checkpoint))
+    assert part['done'].sum() == 1
+    # depths done in the checkpoint are not calculated again
+    part['rayp'][:, part['done']] = -1.
+    np.savez(checkpoint, **part)
+    pr = PsRayp(dis, dep, laymin=0, laymax=30)
+    pr.get_rayp(workers=2, checkpoint=checkpoint)
+    assert pr.done.all()
+    assert (pr.rayp[:, part['done']] == -1.).all()
+    full = PsRayp(dis, dep, laymin=0, laymax=30)
+    full.get_rayp()
+    assert np.array_equal(pr.rayp[:, ~part['done']], full.rayp[:, ~part['done']])
+    with pytest.raises(ValueError):
+        PsRayp(dis, dep[:2], laymin=0, laymax=30).get_rayp(checkpoint=checkpoint)
+
+
+if __name__ == '__main__':
+    import pathlib, tempfile
+    test_sub01()
+    test_sub02()
+    test_sub03()
+    test_sub04(pathlib.Path(tempfile.mkdtemp()))
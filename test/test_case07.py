@@ -0,0 +1,34 @@
+import numpy as np
+from seispy.utils import Mod3DPerturbation
+from seispy.core.depmodel import DepModel
+
+
+def gen_model(path):
+    dep = np.arange(0, 310, 10.)
+    lat = np.arange(20, 40.5, 0.5)
+    lon = np.arange(90, 110.5, 0.5)
+    dep_mod = DepModel(dep)
+    pert = 1 + 0.02 * np.sin(lat)[np.newaxis, :, np.newaxis] * np.cos(lon)[np.newaxis, np.newaxis, :]
+    np.savez(path, dep=dep, lat=lat, lon=lon,
+             vp=dep_mod.vp[:, np.newaxis, np.newaxis] * pert,
+             vs=dep_mod.vs[:, np.newaxis, np.newaxis] * pert)
+
+
+def test_sub01(tmp_path):
+    modpath = str(tmp_path / 'mod3d.npz')
+    gen_model(modpath)
+    dep_range = np.arange(0, 300)
+    mod3d = Mod3DPerturbation(modpath, dep_range)
+    points = np.array([[35., 30.2, 100.3], [120., 25.7, 95.1]])
+    assert np.all(np.abs(mod3d.interpdvs(points)) < 0.021)
+    savepath = str(tmp_path / 'mod3d_pert.npz')
+    Mod3DPerturbation(modpath, dep_range, dtype='float32').save(savepath)
+    mod3d_mmap = Mod3DPerturbation(savepath, dep_range, mmap=True, dtype='float32')
+    assert mod3d_mmap.dvs.filename is not None
+    assert np.allclose(mod3d_mmap.interpvs(points), mod3d.interpvs(points), rtol=1e-6)
+    assert np.allclose(mod3d_mmap.interpdvp(points), mod3d.interpdvp(points), atol=1e-6)
+
+
+if __name__ == '__main__':
+    import pathlib, tempfile
+    test_sub01(pathlib.Path(tempfile.mkdtemp()))
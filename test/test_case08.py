@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from seispy.core.rfdepth import save_rfdep, RFDepthArray
+from seispy.utils import read_rfdep
+from seispy.ccppara import CCPPara
+from seispy.rf2depth_makedata import Station, station_hashes
+import os
+
+
+def gen_rfdep(sta_num=3, ndep=50):
+    rfdep = []
+    for i in range(sta_num):
+        ev_num = i + 2
+        rfdep.append({'station': 'XX.S{:02d}'.format(i), 'stalat': 30. + i, 'stalon': 100. + i,
+                      'depthrange': np.arange(ndep, dtype=float),
+                      'bazi': np.linspace(0, 300, ev_num), 'rayp': np.linspace(6, 8, ev_num),
+                      'moveout_correct': np.random.randn(ev_num, ndep),
+                      'piercelat': 30. + i + np.random.rand(ev_num, ndep),
+                      'piercelon': 100. + i + np.random.rand(ev_num, ndep),
+                      'stopindex': np.full(ev_num, ndep - 1)})
+    return rfdep
+
+
+def test_sub01(tmp_path):
+    rfdep = gen_rfdep()
+    path = str(tmp_path / 'RFdepth.npy')
+    save_rfdep(path, rfdep, rfdep_format='columnar')
+    rfdep_col = read_rfdep(path)
+    assert isinstance(rfdep_col, RFDepthArray)
+    assert isinstance(rfdep_col.fields['moveout_correct'], np.memmap)
+    assert len(rfdep_col) == len(rfdep)
+    for sta, sta_col in zip(rfdep, rfdep_col):
+        assert sta['station'] == sta_col['station']
+        assert np.array_equal(sta['piercelat'], sta_col['piercelat'])
+        assert np.allclose(sta['moveout_correct'], sta_col['moveout_correct'], atol=1e-6)
+        assert np.array_equal(sta['stopindex'], sta_col['stopindex'])
+    assert np.isclose(rfdep_col.bbox[1, 0], rfdep[1]['piercelat'].min())
+    rfdep_col[0]['projlat'] = np.zeros(1)
+    assert 'projlat' in rfdep_col[0]
+
+
+def test_sub02(tmp_path):
+    cpara = CCPPara()
+    cpara.rfpath = str(tmp_path)
+    cpara.velmod = 'iasp91'
+    cpara.depth_axis = np.arange(0, 100.)
+    stalist = tmp_path / 'sta.lst'
+    stalist.write_text('XX.S00 30.0 100.0 0\nXX.S01 31.0 101.0 0\n')
+    sta_info = Station(str(stalist))
+    for sta in sta_info.station:
+        os.makedirs(tmp_path / sta)
+        (tmp_path / sta / '{}finallist.dat'.format(sta)).write_text('evt\n')
+        (tmp_path / sta / 'evt_P_R.sac').write_bytes(b'0' * 10)
+    hashes = station_hashes(cpara, sta_info, '')
+    assert station_hashes(cpara, sta_info, '') == hashes
+    (tmp_path / 'XX.S01' / 'evt_P_R.sac').write_bytes(b'0' * 20)
+    new_hashes = station_hashes(cpara, sta_info, '')
+    assert new_hashes[0] == hashes[0] and new_hashes[1] != hashes[1]
+    assert station_hashes(cpara, sta_info, 'phase=2') != new_hashes
+
+
+def test_sub03(tmp_path):
+    old, new = gen_rfdep(sta_num=2), gen_rfdep(sta_num=3)
+    for path in (str(tmp_path / 'RFdepth.npy'), str(tmp_path / 'RFdepth2')):
+        save_rfdep(path, old, rfdep_format='npy')
+        save_rfdep(path, new, rfdep_format='columnar')
+        assert len(read_rfdep(path)) == 3
+        save_rfdep(path, old, rfdep_format='npy')
+        assert len(read_rfdep(path)) == 2
+    # stale data written by previous versions
+    RFDepthArray.from_list(new).save(str(tmp_path / 'RFdepth'))
+    with pytest.raises(ValueError):
+        read_rfdep(str(tmp_path / 'RFdepth.npy'))
+
+
+if __name__ == '__main__':
+    import pathlib, tempfile
+    test_sub01(pathlib.Path(tempfile.mkdtemp()))
+    test_sub02(pathlib.Path(tempfile.mkdtemp()))
+    test_sub03(pathlib.Path(tempfile.mkdtemp()))
@@ -0,0 +1,269 @@
+import numpy as np
+from seispy.distaz import distaz
+from seispy.core.pierceindex import PierceIndex, BinStack
+from seispy.ccp3d import stack_chunks, gen_center_bin, CCP3D, search_peaks, peak_stats, depth_err
+from seispy.signal import smooth, smooth_rows
+from seispy.geo import extrema, geoproject
+from seispy.ccpprofile import CCPProfile, prof_range, stack_profiles
+from seispy.bootstrap import Bootstrap
+from seispy.core.ccpstack import StackData
+from test_case08 import gen_rfdep
+
+
+def test_sub01():
+    rfdep = gen_rfdep(sta_num=5, ndep=20)
+    bin_lat, bin_lon = np.meshgrid(np.arange(30, 35, 0.25), np.arange(100, 105, 0.25))
+    bin_lat, bin_lon = bin_lat.ravel(), bin_lon.ravel()
+    stations = [np.array([3, 1, 4]) for _ in range(bin_lat.size)]
+    pierce = PierceIndex(rfdep, [1, 3, 4])
+    idx = 10
+    pierce.set_depth(idx)
+    amps = pierce.query(bin_lat, bin_lon, 0.3, stations=stations)
+    for i in range(bin_lat.size):
+        amp = np.array([])
+        for k in stations[i]:
+            stop_idx = np.where(rfdep[k]['stopindex'] >= idx)[0]
+            fall_idx = np.where(distaz(rfdep[k]['piercelat'][stop_idx, idx], rfdep[k]['piercelon'][stop_idx, idx],
+                                       bin_lat[i], bin_lon[i]).delta < 0.3)[0]
+            amp = np.append(amp, rfdep[k]['moveout_correct'][stop_idx[fall_idx], idx])
+        assert np.array_equal(amp, amps[i])
+
+
+def test_sub02():
+    rfdep = gen_rfdep(sta_num=5, ndep=20)
+    bin_lat, bin_lon = np.meshgrid(np.arange(30, 35, 0.25), np.arange(100, 105, 0.25))
+    bin_lat, bin_lon = bin_lat.ravel(), bin_lon.ravel()
+    depth_idx = np.arange(5, 20, 2)
+    radius = np.linspace(0.2, 0.4, depth_idx.size)
+    bin_stack = BinStack(bin_lat, bin_lon, radius, depth_idx)
+    for rfsta in rfdep:
+        bin_stack.add_station(rfsta)
+    pierce = PierceIndex(rfdep, np.arange(5))
+    for j, idx in enumerate(depth_idx):
+        pierce.set_depth(idx)
+        for i, amp in enumerate(pierce.query(bin_lat, bin_lon, radius[j])):
+            assert bin_stack.count[i, j] == amp.size
+            if amp.size > 1:
+                assert np.isclose(bin_stack.mu[i, j], np.mean(amp))
+                assert np.isclose(bin_stack.std_err[i, j], np.std(amp, ddof=1) / np.sqrt(amp.size))
+
+
+def test_sub03():
+    rfdep = gen_rfdep(sta_num=5, ndep=20)
+    bin_loca = np.array([[30 + i * 0.25, 100 + i * 0.25] for i in range(20)])
+    idxs = [np.arange(5) for _ in range(bin_loca.shape[0])]
+    depth_idx = np.arange(5, 20, 2)
+    fzone = np.ones(depth_idx.size) * 0.5
+    for boot_samples in (None, 200):
+        results = []
+        for workers, chunk_size in ((1, None), (1, 3), (2, 7)):
+            boot = None if boot_samples is None else Bootstrap(boot_samples, seed=1)
+            results.append(stack_chunks(rfdep, bin_loca, idxs, fzone, depth_idx, boot=boot,
+                                        workers=workers, chunk_size=chunk_size))
+        for result in results[1:]:
+            for n in range(3):
+                assert np.array_equal(results[0][n], result[n], equal_nan=True)
+
+
+def test_sub04(tmp_path):
+    bin_loca, bin_mat, bin_map = gen_center_bin(30., 100., 1., 2., 0.5)
+    assert bin_mat.shape == (5, 9, 2)
+    assert np.array_equal(bin_loca[bin_map[2, 4]], bin_mat[2, 4])
+    assert np.allclose(bin_mat[2, 4], [30., 100.])
+    ccp = CCP3D()
+    ccp.cpara.center_bin = [30., 100., 1., 2., 0.5]
+    ccp.bin_loca, ccp.bin_mat, ccp.bin_map = bin_loca, bin_mat, bin_map
+    ccp.stack_data = StackData(bin_loca[:, 0], bin_loca[:, 1], np.random.rand(bin_loca.shape[0], 3))
+    fname = str(tmp_path / 'stack.npz')
+    ccp.save_stack_data(fname)
+    new_ccp = CCP3D.read_stack_data(fname)
+    assert np.array_equal(new_ccp.bin_mat, bin_mat) and np.array_equal(new_ccp.bin_map, bin_map)
+    assert isinstance(new_ccp.stack_data.mu, np.memmap)
+    assert np.array_equal(new_ccp.stack_data[3]['mu'], ccp.stack_data.mu[3])
+    # stacked data pickled by previous versions
+    np.savez(fname, cpara=ccp.cpara, stack_data=list(ccp.stack_data))
+    old_ccp = CCP3D.read_stack_data(fname)
+    assert np.array_equal(old_ccp.stack_data.mu, ccp.stack_data.mu)
+    assert np.array_equal(old_ccp.bin_loca, bin_loca)
+
+
+def test_sub05():
+    rng = np.random.default_rng(0)
+    depths = np.arange(300., 702., 2.)
+    mu = np.cumsum(rng.normal(size=(30, depths.size)), axis=1) * 0.01
+    mu[2] = np.nan
+    tr = smooth_rows(mu, half_len=4)
+    for i in range(mu.shape[0]):
+        assert np.allclose(tr[i], smooth(mu[i], half_len=4), equal_nan=True)
+    peak_depth = search_peaks(tr, depths, 380, 440)
+    assert np.isnan(peak_depth[2])
+    for i in np.where(~np.isnan(peak_depth))[0]:
+        idx = extrema(tr[i])
+        idx = idx[(tr[i, idx] > 0) & (depths[idx] > 380) & (depths[idx] < 440)]
+        assert peak_depth[i] == depths[idx[np.argmax(tr[i, idx])]]
+    stack_data = StackData(np.zeros(30), np.zeros(30), mu, count=np.ones(mu.shape))
+    stats = peak_stats(stack_data, peak_depth, depths[0], 2.)
+    assert np.array_equal(np.isnan(stats['amp']), np.isnan(peak_depth))
+
+
+def test_sub06():
+    mu = np.array([[1, 0, 1, 2, 3, 2, 1, 0, 1, 2, 3.],
+                   [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10.]])
+    ccp = CCP3D()
+    ccp.cpara.stack_range = np.arange(11.)
+    ccp.bin_loca = np.zeros((2, 2))
+    ccp.stack_data = StackData(np.zeros(2), np.zeros(2), mu, ci_low=np.full(mu.shape, 1.5))
+    ccp.good_depth = np.array([4., 4.])
+    err = ccp.get_depth_err(type='ci')
+    assert np.array_equal(err, [[2.5, 5.5], [np.nan, np.nan]], equal_nan=True)
+    err = depth_err(mu, ccp.cpara.stack_range, np.array([4.2, np.nan]))
+    assert 2 < err[0, 0] < 4 < err[0, 1] < 6 and np.isnan(err[1]).all()
+
+
+def test_sub07():
+    rfdep = gen_rfdep(sta_num=1, ndep=20)
+    prof = CCPProfile()
+    prof.cpara.line = np.array([30., 100., 32., 103.])
+    prof._pierce_project(rfdep[0])
+    lat, lon = geoproject(rfdep[0]['piercelat'][:, 5], rfdep[0]['piercelon'][:, 5], *prof.cpara.line)
+    assert np.allclose(rfdep[0]['projlat'][:, 5], lat) and np.allclose(rfdep[0]['projlon'][:, 5], lon)
+    projlat = rfdep[0]['projlat']
+    prof._pierce_project(rfdep[0])
+    assert rfdep[0]['projlat'] is projlat
+    dis = prof_range(np.array([30., 30., 31.]), np.array([100., 101., 101.]))
+    assert dis[0] == 0 and np.allclose(np.diff(dis), [distaz(30., 100., 30., 101.).degreesToKilometers(),
+                                                       distaz(30., 101., 31., 101.).degreesToKilometers()])
+
+
+def test_sub08(tmp_path):
+    lines = [np.array([30., 100., 32., 102.]), np.array([32., 100., 30., 102.])]
+    base = CCPProfile()
+    base.rfdep = gen_rfdep(sta_num=3, ndep=20)
+    base.stack_mul = 1
+    base.cpara.stack_range = np.arange(2., 18.)
+    base.cpara.slide_val = 30
+    for shape in ('circle', 'rect'):
+        base.cpara.shape = shape
+        profs = stack_profiles(base, [(line, str(tmp_path / '{}{}.npz'.format(shape, i))) for i, line in enumerate(lines)])
+        for line, prof in zip(lines, profs):
+            single = base.profile(line, '')
+            single.initial_bins()
+            single.stack()
+            assert np.array_equal(prof.stack_data.mu, single.stack_data.mu, equal_nan=True)
+            assert np.array_equal(prof.stack_data.count, single.stack_data.count)
+    # processes of rect profiles read the RFdepth file
+    from seispy.core.rfdepth import save_rfdep
+    base.cpara.depthdat = str(tmp_path / 'RFdepth')
+    save_rfdep(base.cpara.depthdat, base.rfdep, rfdep_format='columnar')
+    base.read_rfdep()
+    files = [(line, str(tmp_path / 'pool{}.npz'.format(i))) for i, line in enumerate(lines)]
+    profs = stack_profiles(base, files)
+    pooled = stack_profiles(base, files, workers=2)
+    for prof, pool_prof in zip(profs, pooled):
+        assert np.array_equal(pool_prof.stack_data.mu, prof.stack_data.mu, equal_nan=True)
+        assert np.array_equal(pool_prof.stack_data.count, prof.stack_data.count)
+
+
+def test_sub09(tmp_path):
+    from seispy.core.rfdepth import save_rfdep
+    path = str(tmp_path / 'RFdepth')
+    save_rfdep(path, gen_rfdep(sta_num=4, ndep=20), rfdep_format='columnar')
+    ccps = []
+    for _ in range(2):
+        ccp = CCP3D()
+        ccp.cpara.depthdat = path
+        ccp.cpara.center_bin = [31.5, 101.5, 1.5, 1.5, 0.25]
+        ccp.cpara.stack_range = np.arange(2., 18.)
+        ccp.stack_mul = 1
+        ccp.initial_grid()
+        ccps.append(ccp)
+    ccps[0].stack()
+    ccps[1].stack_tiles(str(tmp_path / 'stack'), tile_size=4)
+    assert isinstance(ccps[1].stack_data.mu, np.memmap)
+    assert np.nansum(ccps[0].stack_data.count) > 0
+    for key, value in ccps[0].stack_data.fields.items():
+        assert np.array_equal(value, ccps[1].stack_data.fields[key], equal_nan=True)
+
+
+def test_sub10(tmp_path):
+    from seispy.core.rfdepth import save_rfdep
+    rfdep = gen_rfdep(sta_num=4, ndep=20)
+    save_rfdep(str(tmp_path / 'old'), rfdep[:3], rfdep_format='columnar')
+    save_rfdep(str(tmp_path / 'new'), rfdep, rfdep_format='columnar')
+    fname = str(tmp_path / 'stack.npz')
+    for boot_samples in (None, 50):
+        ccps = []
+        for depthdat in ('old', 'new', 'new'):
+            ccp = CCP3D()
+            ccp.cpara.depthdat = str(tmp_path / depthdat)
+            ccp.cpara.center_bin = [31.5, 101.5, 1.5, 1.5, 0.25]
+            ccp.cpara.stack_range = np.arange(2., 18.)
+            ccp.cpara.boot_samples = boot_samples
+            ccp.cpara.boot_seed = 1
+            ccp.stack_mul = 1
+            ccp.initial_grid()
+            ccps.append(ccp)
+        ccps[0].stack()
+        ccps[0].save_stack_data(fname)
+        ccps[1].update_stack(fname)
+        ccps[2].stack()
+        assert np.array_equal(ccps[1].stack_sta[0], ccps[2].stack_sta[0])
+        for key, value in ccps[2].stack_data.fields.items():
+            assert np.allclose(value, ccps[1].stack_data.fields[key], equal_nan=True)
+
+
+def test_sub11(tmp_path):
+    import json
+    from seispy.core.rfdepth import save_rfdep, hash_path
+    rfdep = gen_rfdep(sta_num=4, ndep=20)
+    save_rfdep(str(tmp_path / 'old'), rfdep[:3], rfdep_format='columnar')
+    # the same numbers of events with changed events in a station
+    rfdep[1] = dict(rfdep[1], rayp=rfdep[1]['rayp'] + 0.1, moveout_correct=rfdep[1]['moveout_correct'] * 2)
+    save_rfdep(str(tmp_path / 'new'), rfdep, rfdep_format='columnar')
+    fname = str(tmp_path / 'stack.npz')
+
+    def gen_ccp(depthdat):
+        ccp = CCP3D()
+        ccp.cpara.depthdat = str(tmp_path / depthdat)
+        ccp.cpara.center_bin = [31.5, 101.5, 1.5, 1.5, 0.25]
+        ccp.cpara.stack_range = np.arange(2., 18.)
+        ccp.stack_mul = 1
+        ccp.initial_grid()
+        return ccp
+
+    old, new, full = gen_ccp('old'), gen_ccp('new'), gen_ccp('new')
+    old.stack()
+    old.save_stack_data(fname)
+    arrays = {'stations': old.stack_sta[0], 'station_digests': old.stack_sta[2]}
+    names, _, digests = new._station_info()
+    assert new._update_conflict(old.stack_data, old.cpara, arrays, names, digests) == \
+        'Station XX.S01 is removed or changed'
+    new.update_stack(fname)
+    full.stack()
+    for key, value in full.stack_data.fields.items():
+        assert np.allclose(value, new.stack_data.fields[key], equal_nan=True)
+    # hashes of inputs recorded by makedata are preferred
+    for depthdat, changed in (('old', 'a'), ('new', 'b')):
+        with open(hash_path(str(tmp_path / depthdat)), 'w') as f:
+            json.dump({'stations': {'XX.S00': changed, 'XX.S01': 'a', 'XX.S02': 'a'}}, f)
+    old, new = gen_ccp('old'), gen_ccp('new')
+    old.stack()
+    arrays = {'stations': old.stack_sta[0], 'station_digests': old.stack_sta[2]}
+    names, _, digests = new._station_info()
+    assert new._update_conflict(old.stack_data, old.cpara, arrays, names, digests) == \
+        'Station XX.S00 is removed or changed'
+
+
+if __name__ == '__main__':
+    import pathlib, tempfile
+    test_sub01()
+    test_sub02()
+    test_sub03()
+    test_sub04(pathlib.Path(tempfile.mkdtemp()))
+    test_sub05()
+    test_sub06()
+    test_sub07()
+    test_sub08(pathlib.Path(tempfile.mkdtemp()))
+    test_sub09(pathlib.Path(tempfile.mkdtemp()))
+    test_sub10(pathlib.Path(tempfile.mkdtemp()))
+    test_sub11(pathlib.Path(tempfile.mkdtemp()))
@@ -0,0 +1,32 @@
+import numpy as np
+from seispy.bootstrap import Bootstrap
+
+
+def test_sub01():
+    rng = np.random.default_rng(0)
+    samples = [rng.standard_normal(n) for n in (0, 1, 5, 5, 30, 200)]
+    for method in ('bca', 'pi'):
+        cci = Bootstrap(2000, method=method, seed=10, chunk_size=1000).ci_batch(samples)
+        assert np.isnan(cci[:2]).all()
+        assert np.array_equal(cci, Bootstrap(2000, method=method, seed=10).ci_batch(samples), equal_nan=True)
+        assert np.all(cci[2:, 0] < [np.mean(s) for s in samples[2:]])
+        assert np.all(cci[2:, 1] > [np.mean(s) for s in samples[2:]])
+    boot = Bootstrap(2000, seed=10)
+    assert np.array_equal(boot.ci_batch(samples)[4], boot.ci(samples[4]))
+
+
+def test_sub02():
+    data = np.random.default_rng(1).standard_normal((7, 30))
+    means = Bootstrap(500, seed=3).boot_means(data)
+    idx = Bootstrap(500, seed=3).indices(30)
+    assert np.allclose(means, np.sort(data[:, idx].mean(axis=-1), axis=-1))
+    # the same bits whatever the chunks of samples and bootstrap means
+    for chunk_size in (1, 100, 5000):
+        boot = Bootstrap(500, seed=3, chunk_size=chunk_size)
+        assert np.array_equal(boot.boot_means(data), means)
+        assert np.array_equal(boot.boot_means(data[3:4])[0], means[3])
+
+
+if __name__ == '__main__':
+    test_sub01()
+    test_sub02()
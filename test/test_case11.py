@@ -0,0 +1,141 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from seispy.hk import hkstack, vslow, ci, AdaptiveHK, contour_sigma, hk_bootstrap, hk_stations
+from seispy.hkpara import HKPara
+from seispy.bootstrap import Bootstrap
+
+
+def gen_rfs(ev_num=20, h=40., kappa=1.75, vp=6.3, dt=0.1, shift=5., npts=600, seed=0):
+    rng = np.random.default_rng(seed)
+    rayp = rng.uniform(0.04, 0.08, ev_num)
+    seis = rng.normal(scale=0.02, size=(ev_num, npts))
+    time = np.arange(npts) * dt - shift
+    for i, p in enumerate(rayp):
+        eta_p, eta_s = vslow(vp, p), vslow(vp / kappa, p)
+        for t, amp in ((h * (eta_s - eta_p), 0.3), (h * (eta_s + eta_p), 0.1), (2 * h * eta_s, -0.1)):
+            seis[i] += amp * np.exp(-((time - t) / 0.3) ** 2)
+    return seis, rayp
+
+
+def test_sub01():
+    seis, rayp = gen_rfs()
+    h, kappa = np.arange(30., 50., 0.5), np.arange(1.6, 1.9, 0.02)
+    stack, stackvar, allstack, allstackvar = hkstack(seis, 5., 0.1, rayp, h, kappa, chunk_size=1000)
+    amps = np.zeros((rayp.size, kappa.size, h.size, 3))
+    for i, p in enumerate(rayp):
+        eta_p, eta_s = vslow(6.3, p), vslow(6.3 / kappa, p)[:, np.newaxis]
+        am_cor = 151.5478 * p ** 2 + 3.2896 * p + 0.2618
+        for n, (t, sign) in enumerate((((eta_s - eta_p) * h, 1), ((eta_s + eta_p) * h, 1), (2 * eta_s * h, -1))):
+            amps[i, :, :, n] = sign * am_cor * seis[i, 50 + np.around(t / 0.1).astype(int)]
+    weighted = amps @ np.array([0.7, 0.2, 0.1])
+    assert np.allclose(stack, amps.mean(axis=0))
+    assert np.allclose(allstackvar, weighted.var(axis=0))
+    normed = weighted.mean(axis=0) - weighted.mean(axis=0).min()
+    assert np.allclose(allstack, normed / normed.max())
+    i, j = np.unravel_index(allstack.argmax(), allstack.shape)
+    assert abs(h[j] - 40) <= 1 and abs(kappa[i] - 1.75) <= 0.04
+
+
+def test_sub02():
+    seis, rayp = gen_rfs(ev_num=50, h=42.3, kappa=1.77, npts=1000)
+    seis = gaussian_filter1d(seis, 3, axis=1)
+    h, kappa = np.arange(25., 65., 0.1), np.arange(1.6, 1.9, 0.01)
+    _, _, allstack, _ = hkstack(seis, 5., 0.1, rayp, h, kappa)
+    besth, bestk, cvalue, maxhsig, maxksig = ci(allstack, h, kappa, rayp.size)
+    hk = AdaptiveHK(seis, 5., 0.1, rayp, h, kappa)
+    hk.search()
+    assert hk.besth == besth and hk.bestk == bestk
+    assert hk.nevals < allstack.size / 4
+    assert np.isclose(hk.cvalue, cvalue, atol=0.005)
+    assert np.isclose(hk.maxhsig, maxhsig, rtol=0.1) and np.isclose(hk.maxksig, maxksig, rtol=0.1)
+    # noisy data with a higher peak outside the window refined first
+    seis_n, rayp_n = gen_rfs(ev_num=50, seed=11, npts=1000)
+    seis_n = gaussian_filter1d(seis_n + np.random.default_rng(11).normal(scale=0.5, size=seis_n.shape), 3, axis=1)
+    _, _, allstack_n, _ = hkstack(seis_n, 5., 0.1, rayp_n, h, kappa)
+    besth, bestk, cvalue, _, _ = ci(allstack_n, h, kappa, rayp_n.size)
+    hk = AdaptiveHK(seis_n, 5., 0.1, rayp_n, h, kappa)
+    hk.search()
+    assert hk.besth == besth and hk.bestk == bestk
+    assert hk.nevals < allstack_n.size / 4
+    assert np.isclose(hk.cvalue, cvalue, atol=0.005)
+    # bootstrap on the grids of the adaptive search
+    seis = gaussian_filter1d(seis + np.random.default_rng(1).normal(scale=0.15, size=seis.shape), 3, axis=1)
+    hk = AdaptiveHK(seis[:15], 5., 0.1, rayp[:15], h, kappa)
+    hk.search()
+    boot_h, boot_k = hk.bootstrap(n_samples=50, seed=2)
+    assert hk.nevals < allstack.size
+    dense_h, dense_k = hk_bootstrap(seis[:15], 5., 0.1, rayp[:15], h, kappa, n_samples=50, seed=2)
+    assert np.array_equal(boot_h, dense_h) and np.array_equal(boot_k, dense_k)
+
+
+def test_sub03():
+    h, kappa = np.arange(30., 50., 0.1), np.arange(1.6, 1.9, 0.005)
+    hh, kk = np.meshgrid(h, kappa)
+    allstack = np.exp(-((hh - 40) / 2) ** 2 - ((kk - 1.75) / 0.05) ** 2)
+    # a separate peak above cvalue is not in the extents
+    allstack += 0.8 * np.exp(-((hh - 47) / 0.5) ** 2 - ((kk - 1.65) / 0.01) ** 2)
+    maxhsig, maxksig = contour_sigma(allstack, h, kappa, 0.5)
+    assert np.isclose(maxhsig, 2 * np.sqrt(np.log(2)), rtol=1e-3)
+    assert np.isclose(maxksig, 0.05 * np.sqrt(np.log(2)), rtol=1e-3)
+
+    seis, rayp = gen_rfs(ev_num=30)
+    h, kappa = np.arange(30., 50., 0.5), np.arange(1.6, 1.9, 0.02)
+    boot_h, boot_k = hk_bootstrap(seis, 5., 0.1, rayp, h, kappa, n_samples=20, seed=1)
+    idx = Bootstrap(20, seed=1).indices(rayp.size)
+    for b in (0, 7):
+        allstack = hkstack(seis[idx[b]], 5., 0.1, rayp[idx[b]], h, kappa)[2]
+        i, j = np.unravel_index(allstack.argmax(), allstack.shape)
+        assert boot_h[b] == h[j] and boot_k[b] == kappa[i]
+
+
+def write_station(path, staname, seis, rayp, shift=5., dt=0.1):
+    from obspy.io.sac.sactrace import SACTrace
+    path.mkdir()
+    net, sta = staname.split('.')
+    with open(path / '{}finallist.dat'.format(sta), 'w') as f:
+        for i, p in enumerate(rayp):
+            evt = '2020.{:03d}.00.00.00'.format(i + 1)
+            f.write('{} P 10.0 120.0 30.0 60.0 {:.1f} {:.8f} 6.0 2.0\n'.format(evt, i * 10., p))
+            sac = SACTrace(data=seis[i], delta=dt, b=-shift, knetwk=net, kstnm=sta, stla=30., stlo=100.)
+            sac.write(str(path / '{}_P_R.sac'.format(evt)))
+
+
+def test_sub04(tmp_path):
+    hpara = HKPara()
+    hpara.hrange, hpara.krange = np.arange(30., 50., 0.5), np.arange(1.6, 1.9, 0.02)
+    results = {}
+    for i, staname in enumerate(('XX.A', 'XX.B')):
+        seis, rayp = gen_rfs(ev_num=10, h=35. + i * 5, seed=i)
+        write_station(tmp_path / staname, staname, seis, rayp)
+        _, _, allstack, _ = hkstack(seis.astype(np.float32), 5., 0.1, rayp, hpara.hrange, hpara.krange)
+        results[staname] = ci(allstack, hpara.hrange, hpara.krange, rayp.size)
+    stations = ['XX.B', 'XX.C', 'XX.A']
+    for workers in (1, 2):
+        out = str(tmp_path / 'hk{}.dat'.format(workers))
+        done = hk_stations(stations, str(tmp_path), hpara, out, workers=workers, stack_path=str(tmp_path / 'stack'))
+        assert done == ['XX.B', 'XX.A']
+        table = np.loadtxt(out, dtype=str, ndmin=2)
+        assert table[:, 0].tolist() == done
+        for row in table:
+            besth, bestk, _, maxhsig, maxksig = results[row[0]]
+            assert np.allclose(row[3:].astype(float), [besth, maxhsig, bestk, maxksig], atol=0.01)
+    assert (tmp_path / 'stack' / 'XX.A_Hk.npz').exists()
+    # a missing nested folder for stacked grids is created
+    out = str(tmp_path / 'hk.dat')
+    done = hk_stations(stations, str(tmp_path), hpara, out, workers=2, stack_path=str(tmp_path / 'new' / 'stack'))
+    assert done == ['XX.B', 'XX.A']
+    assert (tmp_path / 'new' / 'stack' / 'XX.B_Hk.npz').exists()
+    # stations failed in saving stacked grids are skipped, the table is still written
+    (tmp_path / 'new' / 'stack' / 'XX.A_Hk.npz').unlink()
+    (tmp_path / 'new' / 'stack' / 'XX.A_Hk.npz').mkdir()
+    done = hk_stations(stations, str(tmp_path), hpara, out, stack_path=str(tmp_path / 'new' / 'stack'))
+    assert done == ['XX.B']
+    assert np.loadtxt(out, dtype=str, ndmin=2)[:, 0].tolist() == done
+
+
+if __name__ == '__main__':
+    import pathlib, tempfile
+    test_sub01()
+    test_sub02()
+    test_sub03()
+    test_sub04(pathlib.Path(tempfile.mkdtemp()))